@@ -1,39 +1,96 @@
-from neo4j import GraphDatabase
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
 
 load_dotenv()
 
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USER = os.getenv("NEO4J_USERNAME")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
-print(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD)
-
-# Tạo driver kết nối
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+# Pool Neo4j (driver được tạo lười trong app.services.connection_manager)
+NEO4J_MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", "50"))
+NEO4J_CONNECTION_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", "30"))
+NEO4J_CONNECTION_TIMEOUT = float(os.getenv("NEO4J_CONNECTION_TIMEOUT", "10"))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600"))
 
 # MongoDB Configuration
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 MONGODB_DB = os.getenv("MONGODB_DB", "test")
+# Cấu hình pool dùng chung cho client sync (pymongo) và async (AsyncMongoClient)
+# Pool tính theo từng worker: tổng kết nối = số worker uvicorn x maxPoolSize
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+    "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000")),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "10000")),
+}
+
+# Redis / Cache Configuration
+# Để trống REDIS_URL thì cache chỉ chạy ở tầng L1 trong process
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "kltn")
+CACHE_L1_MAX_ENTRIES = int(os.getenv("CACHE_L1_MAX_ENTRIES", "2048"))
+# TTL (giây) của cache hồ sơ user, 0 = chỉ dùng memo trong request
+USER_PROFILE_CACHE_TTL = int(os.getenv("USER_PROFILE_CACHE_TTL", "60"))
+# TTL (giây) của cache DishRecord theo id
+DISH_CACHE_TTL = int(os.getenv("DISH_CACHE_TTL", "600"))
+# TTL (giây) của cache danh sách nguyên liệu
+INGREDIENT_CACHE_TTL = int(os.getenv("INGREDIENT_CACHE_TTL", "3600"))
+# Theo dõi thay đổi MongoDB để xóa cache (change stream, fallback polling theo lastUpdateDate)
+CACHE_WATCH_ENABLED = os.getenv("CACHE_WATCH_ENABLED", "true").lower() == "true"
+CACHE_WATCH_POLL_INTERVAL = float(os.getenv("CACHE_WATCH_POLL_INTERVAL", "10"))
+# Chu kỳ (giây) flush hàng đợi ghi kết quả BMI xuống MongoDB
+BMI_WRITE_FLUSH_INTERVAL = float(os.getenv("BMI_WRITE_FLUSH_INTERVAL", "5"))
+
+# Nơi lưu session workflow (checkpoint LangGraph): "redis" (mặc định khi có REDIS_URL), "memory" (dev, một worker) hoặc "fake" (test)
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", REDIS_URL)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "redis" if SESSION_REDIS_URL else "memory").lower()
+SESSION_REDIS_MAX_CONNECTIONS = int(os.getenv("SESSION_REDIS_MAX_CONNECTIONS", "50"))
+# Chu kỳ (giây) đếm lại số session trên Redis cho /metrics (SCAN cả keyspace)
+SESSION_REDIS_STATS_INTERVAL = float(os.getenv("SESSION_REDIS_STATS_INTERVAL", "30"))
+# Giới hạn của backend memory: số session, tổng byte (LRU) và chu kỳ (giây) xóa session hết hạn
+SESSION_MEMORY_MAX_SESSIONS = int(os.getenv("SESSION_MEMORY_MAX_SESSIONS", "1000"))
+SESSION_MEMORY_MAX_BYTES = int(os.getenv("SESSION_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+
+# Checkpoint LangGraph (pause/resume chờ lựa chọn): "session" (checkpoint mới nhất của mỗi session, lưu qua SESSION_BACKEND) hoặc "sqlite"
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "session").lower()
+CHECKPOINT_SQLITE_PATH = os.getenv("CHECKPOINT_SQLITE_PATH", "checkpoints.sqlite")
+CHECKPOINT_TTL_MINUTES = int(os.getenv("CHECKPOINT_TTL_MINUTES", "60"))
+
+# LLM (OpenAI): timeout (giây) mỗi lần gọi, dùng chung cho client sync và async
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Endpoint tương thích OpenAI (proxy, gateway nội bộ, server giả lập khi test); None = api.openai.com
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+# Retry lỗi tạm thời (429/5xx/timeout): số lần gọi lại, backoff = random(0, base * 2^lần), tối đa max (giây)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+# Circuit breaker theo model: mở sau số lỗi liên tiếp này, thử lại sau số giây này
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", "30"))
+# Lời gọi cần độ trễ thấp (phân loại câu hỏi): chưa xong sau số giây này thì gửi thêm một request (0 = tắt)
+LLM_HEDGE_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "2"))
+# Lời gọi LLM giống hệt nhau dùng chung một request; kết quả được dùng lại thêm số giây này sau khi xong (0 = tắt)
+LLM_SINGLE_FLIGHT_WINDOW_SECONDS = float(os.getenv("LLM_SINGLE_FLIGHT_WINDOW_SECONDS", "2"))
+# Số lời gọi LLM phân tích dị ứng chạy song song tối đa trong một request
+ALLERGY_LLM_CONCURRENCY = int(os.getenv("ALLERGY_LLM_CONCURRENCY", "8"))
+# Deadline (giây) cho cả request, timeout từng lời gọi LLM lấy theo phần còn lại (0 = không giới hạn)
+PROCESS_DEADLINE_SECONDS = float(os.getenv("PROCESS_DEADLINE_SECONDS", "15"))
+PROCESS_SELECTIONS_DEADLINE_SECONDS = float(os.getenv("PROCESS_SELECTIONS_DEADLINE_SECONDS", "8"))
+# Còn ít hơn số giây này thì node bỏ LLM, dùng đường xử lý cục bộ
+LLM_MIN_BUDGET_SECONDS = float(os.getenv("LLM_MIN_BUDGET_SECONDS", "1.5"))
+# Câu trả lời tự nhiên: "llm" (template chỉ khi hết thời gian), "template" (luôn dựng sẵn, không gọi LLM)
+# hoặc "combined" (rerank và câu trả lời trong một lần gọi LLM, structured output)
+NATURAL_RESPONSE_MODE = os.getenv("NATURAL_RESPONSE_MODE", "llm").lower()
+# Số món tối đa đưa vào prompt rerank sau bước chấm điểm cục bộ (0 = không giới hạn)
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "30"))
+
+# Tracing OpenTelemetry (tùy chọn): endpoint OTLP/HTTP của collector, ví dụ http://localhost:4318
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "nutrition-assistant")
 
 # JWT Configuration
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
-
-print(f"MongoDB URI: {MONGODB_URI}")
-print(f"MongoDB Database: {MONGODB_DB}")
-
-# Tạo MongoDB client
-try:
-    mongo_client = MongoClient(MONGODB_URI)
-    # Test kết nối
-    mongo_client.admin.command('ping')
-    print("✅ MongoDB kết nối thành công!")
-    
-    mongo_db = mongo_client[MONGODB_DB]
-    print(f"✅ Database '{MONGODB_DB}' đã sẵn sàng")
-    
-except Exception as e:
-    print(f"❌ Lỗi kết nối MongoDB: {e}")
-    mongo_client = None
-    mongo_db = None
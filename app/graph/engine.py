@@ -1,21 +1,28 @@
 from langgraph.graph import StateGraph, END
+from langgraph.types import Command, interrupt
 from typing import Dict, Any, TypedDict, Annotated, Optional, List
-from app.graph.nodes.classify_topic_node import check_mode
-from app.graph.nodes.calculate_bmi_node import calculate_bmi_from_user_id
+from app.graph.nodes.classify_topic_node import acheck_mode
+from app.graph.nodes.calculate_bmi_node import calculate_bmi_from_user_id, calculate_bmi_from_user_data
 from app.graph.nodes.query_neo4j_node import query_neo4j_for_foods
 from app.graph.nodes.aggregate_suitable_foods_node import aggregate_suitable_foods
-from app.graph.nodes.rerank_foods_node import rerank_foods
-from app.graph.nodes.filter_allergies_node import filter_foods_by_allergies
-from app.graph.nodes.generate_natural_response_node import generate_natural_response
+from app.graph.nodes.rerank_foods_node import arerank_foods
+from app.graph.nodes.filter_allergies_node import afilter_foods_by_allergies
+from app.graph.nodes.generate_natural_response_node import agenerate_natural_response
 # from app.graph.nodes.llm_check_food_suitability_node import check_food_suitability
 from app.graph.nodes.fallback_query_node import create_fallback_query
 from app.graph.nodes.process_cooking_request_node import process_cooking_request
-from app.services.mongo_service import mongo_service
+from app.services.async_mongo_service import async_mongo_service
+from app.services.metrics import instrument_node
+from app.services.user_profile_cache import request_scope as user_profile_request_scope
+import operator
+import uuid
 import jwt
 import os
 from datetime import datetime
 from app.graph.nodes.select_cooking_method_node import select_cooking_method_node
-from app.utils.session_store import save_state_to_redis, load_state_from_redis
+from app.utils.checkpointer import get_checkpointer
+from app.utils.bitset import cook_methods, ExclusionSet
+from app.utils.session_schema import PERSISTED_FIELDS
 from fastapi import HTTPException
 # Định nghĩa state cho LangGraph
 class WorkflowState(TypedDict):
@@ -42,26 +49,30 @@ class WorkflowState(TypedDict):
     weather: str
     time_of_day: str
     previous_food_ids: Optional[List[str]]
-    analysis_steps: Optional[List[Dict[str, str]]]
+    previous_food_names: Optional[List[str]]
+    selected_emotion: Optional[str]
+    # Reducer: các node chỉ trả về bước phân tích mới, LangGraph nối vào danh sách
+    analysis_steps: Annotated[List[Dict[str, str]], operator.add]
     analysis_shown: Optional[bool]
     cooking_request_warning: Optional[str]
     context_analysis_shown: Optional[bool]
     ignore_context_filter: Optional[bool]
     natural_response: Optional[str]
+    response_mode: Optional[str]  # "llm" | "template" | "combined", None = theo NATURAL_RESPONSE_MODE
 
 # Node kiểm tra session đầu workflow
 
 def check_session(state: WorkflowState) -> WorkflowState:
     """
     Kiểm tra state được truyền vào để quyết định luồng đi.
-    State này đã được nạp từ Redis ở entry point nếu có session.
+    Nếu có session, state đã được checkpointer nạp lại theo thread_id = session_id.
     """
     # Nếu state đã có cooking method (trường hợp tiếp tục luồng)
     if state.get("selected_cooking_methods"):
-        return {**state, "step": "session_complete"}
+        return {"step": "session_complete"}
 
     # Nếu không, đây là một lượt hỏi mới.
-    return {**state, "step": "session_not_found"}
+    return {"step": "session_not_found"}
 
 def generate_selection_prompts(state: WorkflowState) -> WorkflowState:
     """
@@ -74,12 +85,13 @@ def generate_selection_prompts(state: WorkflowState) -> WorkflowState:
         bmi_result = state.get("bmi_result", {})
         from app.services.graph_schema_service import GraphSchemaService
 
-        # Phân tích ban đầu
+        # Phân tích ban đầu: lấy chế độ ăn và phương pháp nấu của tất cả bệnh trong một truy vấn
         medical_conditions = [c for c in user_data.get("medicalConditions", []) if c not in ["Không có", "Bình thường"]]
+        diet_analysis = GraphSchemaService.get_diet_analysis_by_diseases(medical_conditions)
         if medical_conditions:
             for condition in medical_conditions:
-                diet_recs = GraphSchemaService.get_diet_recommendations_by_disease(condition)
-                diet_details_msg = [f"{d['name']}: {d.get('description', '(Không có mô tả)')}" for d_name in diet_recs if (d := GraphSchemaService.get_diet_details_by_name(d_name))]
+                diets = diet_analysis.get(condition, {}).get("diets", [])
+                diet_details_msg = [f"{d['name']}: {d.get('description') or '(Không có mô tả)'}" for d in diets]
                 analysis_steps.append({"step": "disease_analysis", "message": f"Đối với bệnh '{condition}', các chế độ ăn được khuyến nghị là: {'; '.join(diet_details_msg) if diet_details_msg else 'Chưa có.'}"})
         else:
             analysis_steps.append({"step": "disease_analysis", "message": "Bạn không có bệnh lý nền nào được ghi nhận."})
@@ -95,16 +107,15 @@ def generate_selection_prompts(state: WorkflowState) -> WorkflowState:
         }
 
         # Tạo cooking method prompt (dựa trên phân tích ban đầu)
-        cooking_methods_filtered = set(GraphSchemaService.get_all_cooking_methods())
-        # Lọc theo bệnh
-        medical_conditions = [c for c in user_data.get("medicalConditions", []) if c not in ["Không có", "Bình thường"]]
-        methods_from_disease = set()
+        # Các tập phương pháp nấu được biểu diễn bằng bitset để giao bằng phép toán bit
+        all_methods_bits = cook_methods.to_bitset(GraphSchemaService.get_all_cooking_methods())
+        cooking_methods_filtered = all_methods_bits
+        # Lọc theo bệnh (dùng lại kết quả phân tích ở trên)
+        methods_from_disease = 0
         if medical_conditions:
             for condition in medical_conditions:
-                methods = GraphSchemaService.get_cook_methods_by_disease(condition)
-                if methods:
-                    methods_from_disease.update(methods)
-            cooking_methods_filtered.intersection_update(methods_from_disease)
+                methods_from_disease |= cook_methods.to_bitset(diet_analysis.get(condition, {}).get("cook_methods", []))
+            cooking_methods_filtered &= methods_from_disease
 
         # Lọc theo nguyên liệu đã chọn
         selected_ingredients = state.get("selected_ingredients", [])
@@ -114,17 +125,17 @@ def generate_selection_prompts(state: WorkflowState) -> WorkflowState:
                 "step": "cooking_method_filter_ingredients",
                 "message": f"Với các nguyên liệu bạn đã chọn ({', '.join(selected_ingredients)}), các phương pháp chế biến phù hợp là: {', '.join(methods_for_ingredients) if methods_for_ingredients else 'Không có.'}"
             })
-            cooking_methods_filtered.intersection_update(methods_for_ingredients)
+            cooking_methods_filtered &= cook_methods.to_bitset(methods_for_ingredients)
 
         # Lọc theo BMI
         bmi_category = bmi_result.get("bmi_category")
-        bmi_methods = set()
+        bmi_methods = 0
         if bmi_category:
             methods_for_bmi = GraphSchemaService.get_cook_methods_by_bmi(bmi_category)
             if methods_for_bmi:
-                original_methods_before_bmi = cooking_methods_filtered.copy()
-                cooking_methods_filtered.intersection_update(methods_for_bmi)
-                analysis_steps.append({"step": "bmi_analysis", "message": f"Sau khi lọc theo BMI {bmi_category}, các phương pháp nấu còn lại: {', '.join(cooking_methods_filtered) if cooking_methods_filtered else 'Không có.'}"})
+                cooking_methods_filtered &= cook_methods.to_bitset(methods_for_bmi)
+                remaining_methods = cook_methods.values_of(cooking_methods_filtered)
+                analysis_steps.append({"step": "bmi_analysis", "message": f"Sau khi lọc theo BMI {bmi_category}, các phương pháp nấu còn lại: {', '.join(remaining_methods) if remaining_methods else 'Không có.'}"})
 
         # Lọc theo context
         weather = state.get("weather")
@@ -138,42 +149,38 @@ def generate_selection_prompts(state: WorkflowState) -> WorkflowState:
             context_name, suggested_methods = GraphSchemaService.get_context_and_cook_methods(weather, time_of_day)
             if context_name and suggested_methods:
                 analysis_steps.append({"step": "context_analysis", "message": f"Dựa theo nhiệt độ hiện tại {context_name} gợi ý các cách chế biến phù hợp là: {', '.join(suggested_methods)}."})
-                cooking_methods_filtered.intersection_update(suggested_methods)
+                cooking_methods_filtered &= cook_methods.to_bitset(suggested_methods)
             else:
                 analysis_steps.append({"step": "context_analysis_failed", "message": f"Không tìm thấy gợi ý đặc biệt cho thời tiết '{weather}' và thời điểm '{time_of_day}'. Giữ nguyên danh sách trước đó."})
 
         # Thêm mục tổng hợp chung: giao giữa bệnh lý, BMI và bối cảnh (không tính nguyên liệu)
-        all_methods = set(GraphSchemaService.get_all_cooking_methods())
-        general_methods = set(all_methods)
+        general_methods = all_methods_bits
         if methods_from_disease:
-            general_methods.intersection_update(methods_from_disease)
+            general_methods &= methods_from_disease
         if bmi_methods:
-            general_methods.intersection_update(bmi_methods)
+            general_methods &= bmi_methods
         if suggested_methods:
-            general_methods.intersection_update(set(suggested_methods))
+            general_methods &= cook_methods.to_bitset(suggested_methods)
+        general_method_names = sorted(cook_methods.values_of(general_methods))
         analysis_steps.append({
             "step": "general_summary",
-            "message": f"Các cách chế biến phù hợp dựa trên bệnh lý, BMI và bối cảnh: {', '.join(sorted(general_methods)) if general_methods else 'Không có.'}"
+            "message": f"Các cách chế biến phù hợp dựa trên bệnh lý, BMI và bối cảnh: {', '.join(general_method_names) if general_method_names else 'Không có.'}"
         })
         
         cooking_method_prompt = {
             "prompt_type": "select_cooking_methods",
             "message": "Dựa trên phân tích, hãy chọn phương pháp chế biến bạn muốn:",
-            "options": list(cooking_methods_filtered),
+            "options": cook_methods.values_of(cooking_methods_filtered),
         }
 
-        current_state = {
-            **state,
+        # State được checkpointer lưu theo thread_id = session_id, await_selections dừng workflow chờ lựa chọn
+        session_id = state.get("session_id")
+
+        return {
             "analysis_steps": analysis_steps,
             "ingredient_prompt": ingredient_prompt,
             "cooking_method_prompt": cooking_method_prompt,
             "step": "awaiting_selections",
-        }
-        session_id = save_state_to_redis(current_state)
-        current_state["session_id"] = session_id
-
-        return {
-            **current_state,
             "final_result": {
                 "status": "awaiting_selections",
                 "analysis_steps": analysis_steps,
@@ -183,9 +190,9 @@ def generate_selection_prompts(state: WorkflowState) -> WorkflowState:
             }
         }
     except Exception as e:
-        return {**state, "error": f"Lỗi trong bước tạo prompt: {str(e)}", "step": "prompt_generation_error"}
+        return {"error": f"Lỗi trong bước tạo prompt: {str(e)}", "step": "prompt_generation_error"}
 
-def filter_by_ingredients(state: WorkflowState) -> WorkflowState:
+async def filter_by_ingredients(state: WorkflowState) -> WorkflowState:
     """
     Node này lọc kết quả từ Neo4j dựa trên nguyên liệu đã chọn,
     sử dụng MongoDB.
@@ -197,7 +204,7 @@ def filter_by_ingredients(state: WorkflowState) -> WorkflowState:
         if not selected_ingredients:
             # Nếu không có nguyên liệu nào được chọn, bỏ qua bước lọc
             print("[DEBUG] Bước filter_by_ingredients: Bỏ qua vì không có nguyên liệu nào được chọn.")
-            return {**state, "step": "ingredient_filter_skipped"}
+            return {"step": "ingredient_filter_skipped"}
 
         neo4j_result = state.get("neo4j_result", {})
         all_foods = neo4j_result.get("foods", {})
@@ -212,30 +219,27 @@ def filter_by_ingredients(state: WorkflowState) -> WorkflowState:
         print(f"[DEBUG] Bước filter_by_ingredients: Tìm thấy {len(all_dish_ids)} món ăn từ bước trước để lọc.")
         
         # Lọc các ID này bằng MongoDB
-        filtered_dish_ids = mongo_service.filter_dishes_by_ingredients(all_dish_ids, selected_ingredients)
+        filtered_dish_ids = set(await async_mongo_service.filter_dishes_by_ingredients(all_dish_ids, selected_ingredients))
         print(f"[DEBUG] Bước filter_by_ingredients: Sau khi lọc với MongoDB, còn lại {len(filtered_dish_ids)} món ăn.")
 
-        # Cập nhật lại neo4j_result, chỉ giữ lại các món ăn có ID đã được lọc
+        # Tạo neo4j_result mới (không sửa object của state), chỉ giữ lại các món ăn có ID đã được lọc
         filtered_foods = {}
         for key, value in all_foods.items():
             filtered_advanced = [food for food in value.get("advanced", []) if food.get("dish_id") in filtered_dish_ids]
             if filtered_advanced:
                 filtered_foods[key] = {**value, "advanced": filtered_advanced}
         
-        neo4j_result["foods"] = filtered_foods
-        
-        return {**state, "neo4j_result": neo4j_result, "step": "ingredients_filtered"}
+        return {"neo4j_result": {**neo4j_result, "foods": filtered_foods}, "step": "ingredients_filtered"}
     except Exception as e:
-        return {**state, "error": f"Lỗi khi lọc theo nguyên liệu: {str(e)}", "step": "ingredient_filter_error"}
+        return {"error": f"Lỗi khi lọc theo nguyên liệu: {str(e)}", "step": "ingredient_filter_error"}
 
-def identify_user(state: WorkflowState) -> WorkflowState:
+async def identify_user(state: WorkflowState) -> WorkflowState:
     """Node 1: Xác định user từ user_id """
     try:
         # Lấy user_id từ state (được truyền từ API)
         user_id = state.get("user_id")
         if not user_id:
             return {
-                **state,
                 "error": "Không có user_id được cung cấp",
                 "step": "user_identification_failed"
             }
@@ -243,46 +247,41 @@ def identify_user(state: WorkflowState) -> WorkflowState:
         # Kiểm tra format user_id (phải là ObjectId hợp lệ)
         if "@" in user_id:
             return {
-                **state,
                 "error": "Chỉ chấp nhận user_id, không chấp nhận email",
                 "step": "invalid_user_format"
             }
         
         # Lấy thông tin user đầy đủ bằng user_id
-        user_data = mongo_service.get_user_health_data(user_id)
+        user_data = await async_mongo_service.get_user_health_data(user_id)
         
         if not user_data:
             return {
-                **state,
                 "error": f"Không tìm thấy user với ID: {user_id}",
                 "step": "user_not_found"
             }
         
         return {
-            **state,
             "user_data": user_data,
             "step": "user_identified"
         }
         
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi xác định user: {str(e)}",
             "step": "user_identification_error"
         }
 
-def classify_topic(state: WorkflowState) -> WorkflowState:
+async def classify_topic(state: WorkflowState) -> WorkflowState:
     """Node 2: Phân loại chủ đề câu hỏi"""
     try:
         question = state.get("question", "")
         if not question:
             return {
-                **state,
                 "error": "Không có câu hỏi được cung cấp",
                 "step": "topic_classification_failed"
             }
         # Phân loại chủ đề
-        classification = check_mode(question)
+        classification = await acheck_mode(question)
         # Nếu là cooking_request thì reset selected_cooking_methods nếu detect được phương pháp nấu mới
         if classification == "cooking_request":
             from app.graph.nodes.classify_topic_node import extract_cooking_methods
@@ -290,19 +289,16 @@ def classify_topic(state: WorkflowState) -> WorkflowState:
             # Nếu detect được phương pháp nấu mới hoặc user hỏi "tất cả", reset selected_cooking_methods
             if new_methods or (isinstance(new_methods, list) and new_methods == ["ALL"]):
                 return {
-                    **state,
                     "topic_classification": classification,
                     "selected_cooking_methods": None,  # Reset để process_cooking_request xử lý lại
                     "step": "topic_classified"
                 }
         return {
-            **state,
             "topic_classification": classification,
             "step": "topic_classified"
         }
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi phân loại chủ đề: {str(e)}",
             "step": "topic_classification_error"
         }
@@ -313,29 +309,29 @@ def calculate_bmi(state: WorkflowState) -> WorkflowState:
         user_id = state.get("user_id")
         if not user_id:
             return {
-                **state,
                 "error": "Không có user_id để tính BMI",
                 "step": "bmi_calculation_failed"
             }
         
-        # Tính BMI
-        bmi_result = calculate_bmi_from_user_id(user_id)
+        # Tính BMI từ user_data đã lấy ở bước identify_user, chỉ đọc lại MongoDB nếu state chưa có
+        user_data = state.get("user_data")
+        if user_data:
+            bmi_result = calculate_bmi_from_user_data(user_data)
+        else:
+            bmi_result = calculate_bmi_from_user_id(user_id)
         if "error" in bmi_result:
             return {
-                **state,
                 "error": f"Lỗi tính BMI: {bmi_result['error']}",
                 "step": "bmi_calculation_error"
             }
         
         return {
-            **state,
             "bmi_result": bmi_result,
             "step": "bmi_calculated"
         }
         
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi tính BMI: {str(e)}",
             "step": "bmi_calculation_error"
         }
@@ -346,7 +342,6 @@ def query_neo4j(state: WorkflowState) -> WorkflowState:
         user_data = state.get("user_data", {})
         if not user_data:
             return {
-                **state,
                 "error": "Không có thông tin user để truy vấn Neo4j",
                 "step": "neo4j_query_failed"
             }
@@ -372,7 +367,6 @@ def query_neo4j(state: WorkflowState) -> WorkflowState:
                 }
             else:
                 return {
-                    **state,
                     "error": f"Lỗi tạo fallback query: {fallback_result['message']}",
                     "step": "fallback_query_error"
                 }
@@ -383,36 +377,32 @@ def query_neo4j(state: WorkflowState) -> WorkflowState:
             neo4j_result = query_result.get("query_result", query_result)
         
         return {
-            **state,
             "neo4j_result": neo4j_result,
             "step": "neo4j_queried"
         }
         
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi truy vấn Neo4j: {str(e)}",
             "step": "neo4j_query_error"
         }
 
-def filter_allergies(state: WorkflowState) -> WorkflowState:
+async def filter_allergies(state: WorkflowState) -> WorkflowState:
     """ Node 7: Lọc món ăn theo dị ứng của người dùng """
     try:
         # Gọi node lọc dị ứng
-        filter_result = filter_foods_by_allergies(state)
+        filter_result = await afilter_foods_by_allergies(state)
         
         # Lấy filtered_result từ kết quả
         filtered_result = filter_result.get("filtered_result", {})
         
         return {
-            **state,
             "filtered_result": filtered_result,
             "step": "allergies_filtered"
         }
         
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi lọc món ăn theo dị ứng: {str(e)}",
             "step": "allergy_filter_error"
         }
@@ -420,12 +410,6 @@ def filter_allergies(state: WorkflowState) -> WorkflowState:
 def aggregate_foods(state: WorkflowState) -> WorkflowState:
     """ Node 8: Tổng hợp các món ăn phù hợp """
     try:
-        # Sử dụng filtered_result thay vì neo4j_result
-        filtered_result = state.get("filtered_result", {})
-        if filtered_result:
-            # Cập nhật state để sử dụng filtered_result
-            state["query_result"] = filtered_result
-        
         # Gọi node tổng hợp
         aggregate_result = aggregate_suitable_foods(state)
         
@@ -433,22 +417,20 @@ def aggregate_foods(state: WorkflowState) -> WorkflowState:
         aggregated_result = aggregate_result.get("aggregated_result", {})
         
         return {
-            **state,
             "aggregated_result": aggregated_result,
             "step": "foods_aggregated"
         }
         
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi tổng hợp món ăn: {str(e)}",
             "step": "aggregation_error"
         }
 
-def rerank_foods_wrapper(state: WorkflowState) -> WorkflowState:
+async def rerank_foods_wrapper(state: WorkflowState) -> WorkflowState:
     """ Node 9: Rerank các món ăn sử dụng LLM """
     try:
-        rerank_result_from_node = rerank_foods(state)
+        rerank_result_from_node = await arerank_foods(state)
         reranked_result = rerank_result_from_node.get("rerank_result", {})
 
         # Nếu LLM rerank và trả về danh sách rỗng, KHÔNG fallback sang aggregated foods nữa
@@ -458,31 +440,27 @@ def rerank_foods_wrapper(state: WorkflowState) -> WorkflowState:
             # KHÔNG fallback sang aggregated_foods
 
         return {
-            **state,
             "rerank_result": reranked_result,
             "step": "foods_reranked"
         }
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi rerank món ăn: {str(e)}",
             "step": "rerank_error"
         }
 
-def generate_natural_response_wrapper(state: WorkflowState) -> WorkflowState:
+async def generate_natural_response_wrapper(state: WorkflowState) -> WorkflowState:
     """ Node 10: Tạo câu trả lời tự nhiên bằng LLM """
     try:
-        natural_response_result = generate_natural_response(state)
+        natural_response_result = await agenerate_natural_response(state)
         natural_response = natural_response_result.get("natural_response", "")
         
         return {
-            **state,
             "natural_response": natural_response,
             "step": "natural_response_generated"
         }
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi tạo câu trả lời tự nhiên: {str(e)}",
             "step": "natural_response_error"
         }
@@ -497,7 +475,8 @@ def generate_final_result(state: WorkflowState) -> WorkflowState:
         topic_classification = state.get("topic_classification", "")
         bmi_result = state.get("bmi_result", {})
         rerank_result = state.get("rerank_result", {})
-        previous_food_ids = state.get("previous_food_ids", [])
+        # Các món đã gợi ý trong session (bitset id + set tên)
+        exclusion = ExclusionSet.from_state(state)
         session_id = state.get("session_id")
 
         # Sử dụng câu trả lời tự nhiên từ LLM nếu có
@@ -552,11 +531,6 @@ def generate_final_result(state: WorkflowState) -> WorkflowState:
                     "carbs": food.get("carbs", 0)
                 })
 
-            # Log kiểm tra duplicate trong foods trả về
-            for food in final_foods:
-                if food.get("id") in previous_food_ids:
-                    pass # Tạm thời vô hiệu hóa log
-
         # Tạo message cuối cùng
         if natural_response:
             # Sử dụng câu trả lời tự nhiên từ LLM
@@ -571,7 +545,7 @@ def generate_final_result(state: WorkflowState) -> WorkflowState:
                 food_names = [food.get("name", "Unknown") for food in final_foods]
                 message_parts.append(f"Đây là những món ăn phù hợp với yêu cầu của bạn: {', '.join(food_names)}")
             else:
-                if previous_food_ids:
+                if exclusion:
                     message_parts.append("Chúng tôi đã gợi ý hết các món ăn phù hợp với yêu cầu của bạn rồi.")
                 else:
                     message_parts.append("Xin lỗi, chúng tôi không tìm thấy món ăn nào phù hợp với yêu cầu của bạn")
@@ -603,53 +577,18 @@ def generate_final_result(state: WorkflowState) -> WorkflowState:
             "session_id": session_id
         }
 
-        previous_food_ids = set(state.get("previous_food_ids", []))
-        previous_food_names = set(state.get("previous_food_names", []))
         # Lọc lại final_foods để không trùng id, dish_id hoặc name
-        filtered_final_foods = []
-        for food in final_foods:
-            food_id = food.get("id")
-            dish_id = food.get("dish_id")
-            name = food.get("name")
-            if (
-                (food_id and food_id in previous_food_ids) or
-                (dish_id and dish_id in previous_food_ids) or
-                (name and name in previous_food_names)
-            ):
-                continue
-            filtered_final_foods.append(food)
-        # Cập nhật previous_food_ids và previous_food_names
-        newly_suggested_food_ids = []
-        newly_suggested_food_names = []
+        filtered_final_foods = [food for food in final_foods if not exclusion.excludes(food)]
+        # Cập nhật tập món đã gợi ý
         for food in filtered_final_foods:
-            if food.get("id"):
-                newly_suggested_food_ids.append(food.get("id"))
-            if food.get("dish_id"):
-                newly_suggested_food_ids.append(food.get("dish_id"))
-            if food.get("name"):
-                newly_suggested_food_names.append(food.get("name"))
-        updated_previous_food_ids = list(previous_food_ids.union(newly_suggested_food_ids))
-        updated_previous_food_names = list(previous_food_names.union(newly_suggested_food_names))
-        # DEBUG: Log các id và tên đã gợi ý
-        print("[DEBUG] previous_food_ids:", previous_food_ids)
-        print("[DEBUG] previous_food_names:", previous_food_names)
-        print("[DEBUG] newly_suggested_food_ids:", newly_suggested_food_ids)
-        print("[DEBUG] newly_suggested_food_names:", newly_suggested_food_names)
-        print("[DEBUG] updated_previous_food_ids:", updated_previous_food_ids)
-        print("[DEBUG] updated_previous_food_names:", updated_previous_food_names)
-        print("[DEBUG] ids các món trả về:", [food.get("id") or food.get("dish_id") for food in filtered_final_foods])
-        print("[DEBUG] names các món trả về:", [food.get("name") for food in filtered_final_foods])
-
-        # Lưu lại state mới vào Redis để đảm bảo loại trừ món đã gợi ý
-        if session_id:
-            try:
-                save_state_to_redis({**state, "previous_food_ids": updated_previous_food_ids, "previous_food_names": updated_previous_food_names}, session_id)
-            except Exception as e:
-                # Log lỗi ra console phía server, không trả về cho client
-                print(f"ERROR: [generate_final_result] Failed to save updated previous_food_ids to Redis: {e}")
+            exclusion.add(food.get("id"), food.get("name"))
+            exclusion.add(food.get("dish_id"))
+        # Lưu dạng danh sách (vị trí bit chỉ có nghĩa trong process)
+        updated_previous_food_ids = sorted(exclusion.ids(), key=str)
+        updated_previous_food_names = sorted(exclusion.names)
+        print(f"[DEBUG] Đã gợi ý {len(updated_previous_food_ids)} món trong session, lần này: {[food.get('name') for food in filtered_final_foods]}")
 
         return {
-            **state,
             "final_result": final_result,
             "previous_food_ids": updated_previous_food_ids,
             "previous_food_names": updated_previous_food_names,
@@ -658,7 +597,6 @@ def generate_final_result(state: WorkflowState) -> WorkflowState:
     except Exception as e:
         session_id = state.get("session_id")
         return {
-            **state,
             "error": f"Lỗi tạo kết quả: {str(e)}",
             "step": "result_generation_error"
         }
@@ -696,7 +634,7 @@ def should_continue(state: WorkflowState) -> str:
         return "query_neo4j"
         
     elif step == "awaiting_selections":
-        return "end_success"
+        return "await_selections"
     elif step == "selections_made":
         return "query_neo4j" # Đầu tiên truy vấn neo4j
     elif step == "neo4j_queried":
@@ -721,7 +659,6 @@ def end_with_error(state: WorkflowState) -> WorkflowState:
     """Kết thúc với lỗi"""
     session_id = state.get("session_id")
     return {
-        **state,
         "final_result": {
             "status": "error",
             "message": state.get("error", "Lỗi không xác định"),
@@ -753,7 +690,6 @@ def end_rejected(state: WorkflowState) -> WorkflowState:
     message = " | ".join(message_parts)
     
     return {
-        **state,
         "final_result": {
             "status": "rejected",
             "message": message,
@@ -773,23 +709,29 @@ def end_rejected(state: WorkflowState) -> WorkflowState:
 
 def end_success(state: WorkflowState) -> WorkflowState:
     """
-    Kết thúc thành công. Cập nhật lại state vào Redis để lưu lại các món đã gợi ý.
+    Kết thúc thành công (state, gồm các món đã gợi ý, đã được checkpointer lưu).
     Luôn trả về session_id trong final_result.
     """
     session_id = state.get("session_id")
-    if session_id:
-        try:
-            save_state_to_redis(state, session_id)
-        except Exception as e:
-            # Không nên raise lỗi ở đây để tránh làm hỏng kết quả trả về cho user
-            print(f"ERROR: [end_success] Failed to save state to Redis: {e}")
     # Đảm bảo final_result luôn có session_id
     final_result = state.get("final_result", {})
     if isinstance(final_result, dict):
-        final_result["session_id"] = session_id
-        return {**state, "final_result": final_result}
+        return {"final_result": {**final_result, "session_id": session_id}}
     else:
-        return {**state, "final_result": {"session_id": session_id}}
+        return {"final_result": {"session_id": session_id}}
+
+def await_selections(state: WorkflowState) -> WorkflowState:
+    """
+    Dừng workflow (interrupt) chờ người dùng chọn nguyên liệu và phương pháp nấu.
+    State được lưu ở checkpoint, /process-selections tiếp tục bằng Command(resume={...}).
+    Prompt lựa chọn đã trả về cho client qua final_result nên giá trị interrupt (lưu cùng checkpoint) chỉ gồm session_id.
+    """
+    selections = interrupt({"session_id": state.get("session_id")})
+    return {
+        "selected_ingredients": selections.get("ingredients", []),
+        "selected_cooking_methods": selections.get("cooking_methods", []),
+        "step": "selections_made"
+    }
 
 # Tạo LangGraph workflow
 def create_workflow() -> StateGraph:
@@ -797,22 +739,25 @@ def create_workflow() -> StateGraph:
     # Tạo graph
     workflow = StateGraph(WorkflowState)
     # Thêm nodes
-    workflow.add_node("check_session", check_session)
-    workflow.add_node("identify_user", identify_user)
-    workflow.add_node("classify_topic", classify_topic)
-    workflow.add_node("calculate_bmi", calculate_bmi)
-    workflow.add_node("generate_selection_prompts", generate_selection_prompts)
-    workflow.add_node("process_cooking_request", process_cooking_request) # Thêm node xử lý cooking request
-    workflow.add_node("query_neo4j", query_neo4j)
-    workflow.add_node("filter_by_ingredients", filter_by_ingredients)
-    workflow.add_node("filter_allergies", filter_allergies)
-    workflow.add_node("aggregate_foods", aggregate_foods)
-    workflow.add_node("rerank_foods", rerank_foods_wrapper)
-    workflow.add_node("generate_natural_response", generate_natural_response_wrapper)
-    workflow.add_node("generate_result", generate_final_result)
-    workflow.add_node("end_with_error", end_with_error)
-    workflow.add_node("end_rejected", end_rejected)
-    workflow.add_node("end_success", end_success)
+    # Node chờ LLM/MongoDB là async; node sync (Neo4j, tính toán) được LangGraph chạy ở thread pool khi ainvoke
+    # Mọi node được bọc bởi instrument_node (thời gian, lỗi, step kết quả -> /metrics)
+    workflow.add_node("check_session", instrument_node("check_session", check_session))
+    workflow.add_node("identify_user", instrument_node("identify_user", identify_user))
+    workflow.add_node("classify_topic", instrument_node("classify_topic", classify_topic))
+    workflow.add_node("calculate_bmi", instrument_node("calculate_bmi", calculate_bmi))
+    workflow.add_node("generate_selection_prompts", instrument_node("generate_selection_prompts", generate_selection_prompts))
+    workflow.add_node("await_selections", instrument_node("await_selections", await_selections))
+    workflow.add_node("process_cooking_request", instrument_node("process_cooking_request", process_cooking_request)) # Thêm node xử lý cooking request
+    workflow.add_node("query_neo4j", instrument_node("query_neo4j", query_neo4j))
+    workflow.add_node("filter_by_ingredients", instrument_node("filter_by_ingredients", filter_by_ingredients))
+    workflow.add_node("filter_allergies", instrument_node("filter_allergies", filter_allergies))
+    workflow.add_node("aggregate_foods", instrument_node("aggregate_foods", aggregate_foods))
+    workflow.add_node("rerank_foods", instrument_node("rerank_foods", rerank_foods_wrapper))
+    workflow.add_node("generate_natural_response", instrument_node("generate_natural_response", generate_natural_response_wrapper))
+    workflow.add_node("generate_result", instrument_node("generate_result", generate_final_result))
+    workflow.add_node("end_with_error", instrument_node("end_with_error", end_with_error))
+    workflow.add_node("end_rejected", instrument_node("end_rejected", end_rejected))
+    workflow.add_node("end_success", instrument_node("end_success", end_success))
     # Thêm router
     workflow.add_conditional_edges(
         "check_session",
@@ -855,10 +800,12 @@ def create_workflow() -> StateGraph:
         "generate_selection_prompts",
         should_continue,
         {
-            "end_success": "end_success",
+            "await_selections": "await_selections",
             "end_with_error": "end_with_error"
         }
     )
+    # Tiếp tục từ checkpoint: đi thẳng đến query_neo4j, không qua lại các node định tuyến
+    workflow.add_edge("await_selections", "query_neo4j")
 
     workflow.add_conditional_edges(
         "process_cooking_request", # Thêm điều kiện cho node xử lý cooking request
@@ -935,11 +882,48 @@ def create_workflow() -> StateGraph:
     workflow.add_edge("end_success", END)
     return workflow
 
-# Tạo workflow instance
-workflow_graph = create_workflow().compile()
-
-def run_langgraph_workflow_until_selection(user_id: str, question: str, weather: str, time_of_day: str, session_id: str = None, ignore_context_filter: bool = False) -> dict:
+# Các field được giữ lại từ checkpoint khi hỏi tiếp trong cùng session (không ghi đè bằng giá trị mặc định).
+# user_data và bmi_result không được lưu: đọc lại qua user_profile_cache để thay đổi hồ sơ có hiệu lực ngay
+_CARRIED_OVER_FIELDS = PERSISTED_FIELDS - {"session_id"}
+
+# Checkpoint chỉ được ghi khi workflow dừng (chờ lựa chọn) hoặc kết thúc, không ghi sau mỗi node
+_DURABILITY = "exit"
+
+_workflow_graph = None
+
+def get_workflow_graph():
+    """Graph đã compile với checkpointer hiện tại (compile lại nếu checkpointer đổi, ví dụ sau lifespan startup)"""
+    global _workflow_graph
+    checkpointer = get_checkpointer()
+    if _workflow_graph is None or _workflow_graph.checkpointer is not checkpointer:
+        _workflow_graph = create_workflow().compile(checkpointer=checkpointer)
+    return _workflow_graph
+
+def _thread_config(session_id: str) -> dict:
+    return {"configurable": {"thread_id": session_id}}
+
+async def _load_profile(user_id: str) -> Dict[str, Any]:
+    """user_data (qua user_profile_cache) và bmi_result mới nhất cho lượt tiếp theo của session"""
+    user_data = await async_mongo_service.get_user_health_data(user_id)
+    if not user_data:
+        return {}
+    profile = {"user_data": user_data}
+    bmi_result = calculate_bmi_from_user_data(user_data)
+    if "error" not in bmi_result:
+        profile["bmi_result"] = bmi_result
+    return profile
+
+async def _load_session_values(workflow_graph, session_id: str, user_id: str) -> Dict[str, Any]:
+    """State mới nhất của session, rỗng nếu không có hoặc session thuộc user khác"""
+    snapshot = await workflow_graph.aget_state(_thread_config(session_id))
+    values = snapshot.values if snapshot else {}
+    if values and values.get("user_id") not in (None, user_id):
+        return {}
+    return values or {}
+
+async def run_langgraph_workflow_until_selection(user_id: str, question: str, weather: str, time_of_day: str, session_id: str = None, ignore_context_filter: bool = False, response_mode: Optional[str] = None) -> dict:
     try:
+        workflow_graph = get_workflow_graph()
         # State mặc định cho một session hoàn toàn mới
         initial_state = {
             "user_id": user_id,
@@ -966,20 +950,24 @@ def run_langgraph_workflow_until_selection(user_id: str, question: str, weather:
             "cooking_request_warning": None,
             "context_analysis_shown": False,
             "ignore_context_filter": ignore_context_filter,
-            "natural_response": None
+            "natural_response": None,
+            "response_mode": response_mode
         }
 
-        if session_id:
-            try:
-                loaded_state = load_state_from_redis(session_id)
-                # Merge toàn bộ state cũ vào initial_state (ưu tiên giá trị đã lưu nếu trùng key)
-                merged_state = {**initial_state, **loaded_state}
-                initial_state = merged_state
-            except Exception as e:
-                # Lỗi không tìm thấy session là bình thường, không cần log ồn ào
-                pass
+        with user_profile_request_scope():
+            if session_id and await _load_session_values(workflow_graph, session_id, user_id):
+                # Hỏi tiếp trong session: giữ lại state đã lưu ở checkpoint (món đã gợi ý, lựa chọn),
+                # hồ sơ user (không lưu ở checkpoint) đọc lại từ user_profile_cache
+                initial_state = {
+                    key: value for key, value in initial_state.items()
+                    if key not in _CARRIED_OVER_FIELDS and key not in ("user_data", "bmi_result")
+                }
+                initial_state.update(await _load_profile(user_id))
+            else:
+                session_id = str(uuid.uuid4())
+                initial_state["session_id"] = session_id
 
-        result = workflow_graph.invoke(initial_state)
+            result = await workflow_graph.ainvoke(initial_state, _thread_config(session_id), durability=_DURABILITY)
         # Nếu workflow dừng lại để hỏi cả cảm xúc và phương pháp nấu
         if result.get("final_result", {}).get("status") == "analysis_complete":
             return result["final_result"]
@@ -992,20 +980,24 @@ def run_langgraph_workflow_until_selection(user_id: str, question: str, weather:
         print(f"Error in run_langgraph_workflow_until_selection: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Lỗi chạy workflow: {str(e)}")
 
-def continue_workflow_with_selections(session_id: str, ingredients: List[str], cooking_methods: List[str], user_id: str) -> dict:
-    """Tải state, cập nhật các lựa chọn, và tiếp tục workflow."""
+async def continue_workflow_with_selections(session_id: str, ingredients: List[str], cooking_methods: List[str], user_id: str, response_mode: Optional[str] = None) -> dict:
+    """Tiếp tục workflow từ checkpoint đang chờ lựa chọn (await_selections)."""
     try:
-        state = load_state_from_redis(session_id)
-        
-        state["selected_ingredients"] = ingredients
-        state["selected_cooking_methods"] = cooking_methods
-        state["user_id"] = user_id
-        state["step"] = "selections_made"
-        
-        state.pop("ingredient_prompt", None)
-        state.pop("cooking_method_prompt", None)
-
-        result = workflow_graph.invoke(state)
+        workflow_graph = get_workflow_graph()
+        config = _thread_config(session_id)
+        snapshot = await workflow_graph.aget_state(config)
+        if not snapshot or not snapshot.interrupts or snapshot.values.get("user_id") != user_id:
+            raise Exception("Session expired or not found")
+
+        with user_profile_request_scope():
+            result = await workflow_graph.ainvoke(
+                Command(
+                    resume={"ingredients": ingredients, "cooking_methods": cooking_methods},
+                    update={"response_mode": response_mode, **await _load_profile(user_id)}
+                ),
+                config,
+                durability=_DURABILITY
+            )
         
         return result.get("final_result", {
             "status": "error",
@@ -1013,4 +1005,3 @@ def continue_workflow_with_selections(session_id: str, ingredients: List[str], c
         })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi tiếp tục workflow: {str(e)}")
-
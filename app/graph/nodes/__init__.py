@@ -1,9 +1,9 @@
-from .classify_topic_node import check_mode
+from .classify_topic_node import check_mode, acheck_mode
 from .calculate_bmi_node import calculate_bmi_from_user_id
 from .query_neo4j_node import query_neo4j_for_foods
 from .aggregate_suitable_foods_node import aggregate_suitable_foods
-from .rerank_foods_node import rerank_foods
+from .rerank_foods_node import arerank_foods
 from .fallback_query_node import create_fallback_query
-from .filter_allergies_node import filter_foods_by_allergies
-from .generate_natural_response_node import generate_natural_response
+from .filter_allergies_node import filter_foods_by_allergies, afilter_foods_by_allergies
+from .generate_natural_response_node import agenerate_natural_response
 
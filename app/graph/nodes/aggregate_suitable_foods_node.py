@@ -1,5 +1,6 @@
 from app.services.graph_schema_service import GraphSchemaService
-from typing import Dict, Any, List, Set
+from typing import Dict, Any, List, Set, Union
+from app.utils.bitset import ExclusionSet
 
 def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -8,7 +9,11 @@ def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
     """
     try:
         neo4j_result = state.get("neo4j_result", {})
-        previous_food_ids = state.get("previous_food_ids", [])
+        # Các món đã gợi ý trong session, kiểm tra O(1) mỗi món
+        previous_food_ids = ExclusionSet.from_state(state)
+
+        def is_excluded(food: Dict[str, Any]) -> bool:
+            return previous_food_ids.contains_id(food.get('dish_id')) or previous_food_ids.contains_id(food.get('id'))
 
         if not neo4j_result or neo4j_result.get("status") == "error":
             return {"aggregated_result": {"status": "error", "message": neo4j_result.get("message", "Lỗi từ bước truy vấn Neo4j.")}}
@@ -17,7 +22,7 @@ def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
         if neo4j_result.get("status") == "popular_foods":
             popular_foods = neo4j_result.get("foods", {}).get("popular", {}).get("advanced", [])
             # Lọc lại một lần nữa để đảm bảo không có món cũ
-            filtered_popular = [food for food in popular_foods if food.get('dish_id') not in previous_food_ids]
+            filtered_popular = [food for food in popular_foods if not previous_food_ids.contains_id(food.get('dish_id'))]
             if not filtered_popular:
                 return {"aggregated_result": {
                     "status": "empty",
@@ -68,10 +73,7 @@ def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
             for key, value in foods_from_neo4j.items():
                 foods = value.get("advanced", [])
                 all_foods.extend(foods)
-            filtered_final_foods = [
-                food for food in all_foods
-                if food.get('dish_id') not in previous_food_ids and food.get('id') not in previous_food_ids
-            ]
+            filtered_final_foods = [food for food in all_foods if not is_excluded(food)]
             if not filtered_final_foods:
                 return {"aggregated_result": {
                     "status": "empty",
@@ -97,10 +99,7 @@ def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
             if selected_cooking_methods:
                 selected_methods_lower = [m.lower() for m in selected_cooking_methods]
                 all_foods = [food for food in all_foods if food.get('cook_method', '').lower() in selected_methods_lower and food.get('cook_method', '').lower() != 'không xác định']
-            filtered_final_foods = [
-                food for food in all_foods
-                if food.get('dish_id') not in previous_food_ids and food.get('id') not in previous_food_ids
-            ]
+            filtered_final_foods = [food for food in all_foods if not is_excluded(food)]
             if not filtered_final_foods:
                 return {"aggregated_result": {
                     "status": "empty",
@@ -195,7 +194,7 @@ def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
                         vegetarian_foods.append(food)
                 
                 # Lọc trừ previous_food_ids
-                filtered_vegetarian = [food for food in vegetarian_foods if food.get('dish_id') not in previous_food_ids]
+                filtered_vegetarian = [food for food in vegetarian_foods if not previous_food_ids.contains_id(food.get('dish_id'))]
                 
                 if filtered_vegetarian:
                     print(f"DEBUG: Found {len(filtered_vegetarian)} vegetarian foods by name filtering")
@@ -224,11 +223,12 @@ def aggregate_suitable_foods(state: Dict[str, Any]) -> Dict[str, Any]:
 def aggregate_foods_by_intersection(bmi_foods: List[Dict], cooking_foods: List[Dict], 
                                   disease_foods: List[Dict], bmi_category: str, 
                                   cooking_methods: List[str], diseases: List[str],
-                                  excluded_ids: List[str] = None) -> List[Dict]:
+                                  excluded_ids: Union[ExclusionSet, List[str]] = None) -> List[Dict]:
     """
     Tổng hợp món ăn bằng cách lấy giao (intersection) của các tiêu chí
     """
-    # Chuyển đổi thành sets để dễ xử lý intersection
+    # Tập dish_id của từng tiêu chí: danh sách đã được lọc context theo request ở query_neo4j
+    # nên dựng set trực tiếp (không dùng bitset tính sẵn theo tiêu chí)
     bmi_ids = {food.get("dish_id") for food in bmi_foods if food.get("dish_id")}
     cooking_ids = {food.get("dish_id") for food in cooking_foods if food.get("dish_id")}
     disease_ids = {food.get("dish_id") for food in disease_foods if food.get("dish_id")}
@@ -243,36 +243,7 @@ def aggregate_foods_by_intersection(bmi_foods: List[Dict], cooking_foods: List[D
     if diseases == []:  # Không có bệnh thực sự
         has_disease = False
     
-    # Lấy intersection dựa trên tiêu chí có sẵn
-    if has_bmi and has_cooking and has_disease:
-        # Có đủ 3 tiêu chí: lấy giao của cả 3
-        final_ids = bmi_ids & cooking_ids & disease_ids
-        
-    elif has_bmi and has_cooking:
-        # Có BMI và cách chế biến: lấy giao của 2
-        final_ids = bmi_ids & cooking_ids
-        
-    elif has_bmi and has_disease:
-        # Có BMI và bệnh: lấy giao của 2
-        final_ids = bmi_ids & disease_ids
-        
-    elif has_cooking and has_disease:
-        # Có cách chế biến và bệnh: lấy giao của 2
-        final_ids = cooking_ids & disease_ids
-        
-    elif has_bmi:
-        # Chỉ có BMI: lấy tất cả món ăn theo BMI
-        final_ids = bmi_ids
-        
-    elif has_cooking:
-        # Chỉ có cách chế biến: lấy tất cả món ăn theo cách chế biến
-        final_ids = cooking_ids
-        
-    elif has_disease:
-        # Chỉ có bệnh: lấy tất cả món ăn theo bệnh
-        final_ids = disease_ids
-        
-    else:
+    if not (has_bmi or has_cooking or has_disease):
         # Không có tiêu chí nào: trả về món ăn phổ biến
         try:
             popular_foods = GraphSchemaService.get_popular_foods(excluded_ids=excluded_ids)
@@ -280,18 +251,19 @@ def aggregate_foods_by_intersection(bmi_foods: List[Dict], cooking_foods: List[D
         except Exception as e:
             return []
     
-    # Tạo danh sách món ăn cuối cùng từ final_ids
-    all_foods = bmi_foods + cooking_foods + disease_foods
+    # Lấy giao của các tiêu chí có sẵn (1, 2 hoặc cả 3 tiêu chí)
+    final_ids = set.intersection(*[ids for available, ids in (
+        (has_bmi, bmi_ids), (has_cooking, cooking_ids), (has_disease, disease_ids)
+    ) if available])
+    exclusion = ExclusionSet.coerce(excluded_ids)
     
+    # Tạo danh sách món ăn cuối cùng, giữ món đầu tiên của mỗi dish_id
     final_foods = []
-    matched_count = 0
-    
-    for food in all_foods:
+    for food in bmi_foods + cooking_foods + disease_foods:
         food_id = food.get("dish_id")
-        if food_id in final_ids:
-            matched_count += 1
-            # Kiểm tra xem đã có trong final_foods chưa để tránh trùng lặp
-            if not any(f.get("dish_id") == food_id for f in final_foods):
-                final_foods.append(food)
+        if food_id in final_ids and not exclusion.contains_id(food_id):
+            final_foods.append(food)
+            # Bỏ khỏi final_ids để tránh trùng lặp
+            final_ids.discard(food_id)
     
-    return final_foods 
\ No newline at end of file
+    return final_foods
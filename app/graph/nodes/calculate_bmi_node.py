@@ -1,5 +1,9 @@
 from app.services.mongo_service import mongo_service
-from typing import Dict, Any, Optional
+from app.services.bmi_writer import bmi_writer
+from app.services.cache_service import stable_key
+from app.services.user_profile_cache import user_profile_cache
+from functools import lru_cache
+from typing import Dict, Any, Optional, Tuple
 
 def calculate_bmi_from_user_id(userId: str) -> Dict[str, Any]:
     """
@@ -8,6 +12,12 @@ def calculate_bmi_from_user_id(userId: str) -> Dict[str, Any]:
     # Lấy dữ liệu user từ MongoDB
     user_data: Optional[Dict[str, Any]] = mongo_service.get_user_health_data(userId)
     
+    return calculate_bmi_from_user_data(user_data)
+
+def calculate_bmi_from_user_data(user_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Tính BMI từ dữ liệu user đã có sẵn (không đọc lại MongoDB)
+    """
     if not user_data:
         return {"error": "Không tìm thấy thông tin user"}
     
@@ -17,20 +27,24 @@ def calculate_bmi_from_user_id(userId: str) -> Dict[str, Any]:
     
     return calculate_bmi(user_data)
 
-def calculate_bmi(user_data: Dict[str, Any]) -> Dict[str, Any]:
+def bmi_input_hash(user_data: Dict[str, Any]) -> str:
     """
-    Tính BMI cho người lớn và trẻ em (dưới 20 tuổi).
+    Hash các đầu vào quyết định kết quả BMI
     """
-    weight = user_data.get("weight")
-    height = user_data.get("height")
-    age = user_data.get("age")
-    gender = user_data.get("gender", "male").lower()
-    activity_level = user_data.get("activity_level", "sedentary")
+    return stable_key(
+        "bmi_v1",
+        user_data.get("weight"),
+        user_data.get("height"),
+        user_data.get("age"),
+        user_data.get("gender", "male").lower(),
+        user_data.get("activity_level", "sedentary"),
+    )
 
-    if not all([weight, height, age]):
-        return {"error": "Thiếu dữ liệu cần thiết để tính toán."}
-
-    # Tính BMI
+@lru_cache(maxsize=4096)
+def _compute_bmi(weight: float, height: float, age: int) -> Tuple[float, str]:
+    """
+    Tính BMI và phân loại (memo theo đầu vào)
+    """
     height_m = height / 100
     bmi = weight / (height_m ** 2)
 
@@ -55,8 +69,26 @@ def calculate_bmi(user_data: Dict[str, Any]) -> Dict[str, Any]:
         else:
             bmi_category = "Béo phì"
 
+    return round(bmi, 2), bmi_category
+
+def calculate_bmi(user_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Tính BMI cho người lớn và trẻ em (dưới 20 tuổi).
+    Chỉ ghi lại MongoDB khi đầu vào (cân nặng, chiều cao, tuổi, giới tính, mức vận động) thay đổi.
+    """
+    weight = user_data.get("weight")
+    height = user_data.get("height")
+    age = user_data.get("age")
+    gender = user_data.get("gender", "male").lower()
+    activity_level = user_data.get("activity_level", "sedentary")
+
+    if not all([weight, height, age]):
+        return {"error": "Thiếu dữ liệu cần thiết để tính toán."}
+
+    bmi, bmi_category = _compute_bmi(weight, height, age)
+
     result: Dict[str, Any] = {
-        "bmi": round(bmi, 2),
+        "bmi": bmi,
         "bmi_category": bmi_category,
         "user_info": {
             "name": user_data.get("name", "Unknown"),
@@ -69,11 +101,14 @@ def calculate_bmi(user_data: Dict[str, Any]) -> Dict[str, Any]:
         }
     }
     
-    # Lưu kết quả BMI vào MongoDB
+    # Lưu kết quả BMI vào MongoDB (write-behind) khi đầu vào thay đổi
     try:
         user_id = user_data.get("_id")
-        if user_id:
-            mongo_service.save_bmi_calculation(user_id, result)
+        input_hash = bmi_input_hash(user_data)
+        if user_id and user_data.get("bmi_input_hash") != input_hash:
+            bmi_writer.enqueue(user_id, result, input_hash)
+            # Cập nhật hash trong cache hồ sơ để các request sau không enqueue lại
+            user_profile_cache.patch(user_id, {"bmi_input_hash": input_hash})
     except Exception as e:
         print(f"Error saving BMI result to MongoDB: {e}")
     
@@ -1,12 +1,20 @@
-import os
-from openai import OpenAI
-from dotenv import load_dotenv
+import asyncio
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from app.services.cache_service import classification_cache, stable_key
+from app.services.llm.llm_service import LLMService, LLMUnavailable
+from app.utils import deadline
 
-def check_mode(user_question: str) -> str:
-    prompt = f"""Phân loại câu hỏi sau.
+# Phân loại mặc định khi không kịp gọi LLM (đi tiếp luồng tư vấn, không cache)
+DEFAULT_MODE = "tư vấn"
+
+CLASSIFY_SYSTEM_PROMPT = "Bạn là một trợ lý AI chuyên phân loại câu hỏi. Nhiệm vụ của bạn là trả lời 'tư vấn' cho các câu hỏi về thực phẩm/dinh dưỡng, 'cooking_request' cho yêu cầu cụ thể về cách chế biến, và 'không liên quan' cho các câu hỏi khác."
+
+def _classification_cache_key(user_question: str) -> str:
+    # Câu hỏi giống nhau (sau khi chuẩn hóa) cho cùng kết quả phân loại
+    return stable_key(" ".join(user_question.lower().split()))
+
+def _build_check_mode_prompt(user_question: str) -> str:
+    return f"""Phân loại câu hỏi sau.
 Nếu câu hỏi liên quan đến việc gợi ý món ăn, tư vấn dinh dưỡng, hoặc các chủ đề về sức khỏe, hãy trả lời là "tư vấn".
 Nếu câu hỏi yêu cầu cụ thể về cách chế biến (như chiên, nướng, luộc, hấp, xào, kho, nấu canh, salad, chay, mặn, ngọt, đắng, cay, smoothie, etc,...) hỏi về món khác ngoài các món trên hãy trả lời là "cooking_request".
 Nếu câu hỏi yêu cầu hỏi về món khác ( như món khác, món nào khác? tôi không thích món các món này, ect..) hãy trả lời là "cooking_request".
@@ -15,23 +23,67 @@ Chỉ trả lời duy nhất "tư vấn", "cooking_request" hoặc "không liên
 
 Câu hỏi: "{user_question}"
 """
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Bạn là một trợ lý AI chuyên phân loại câu hỏi. Nhiệm vụ của bạn là trả lời 'tư vấn' cho các câu hỏi về thực phẩm/dinh dưỡng, 'cooking_request' cho yêu cầu cụ thể về cách chế biến, và 'không liên quan' cho các câu hỏi khác."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.1,
-    )
 
-    answer = response.choices[0].message.content.strip().lower()
+def _parse_mode(answer: str) -> str:
+    answer = answer.strip().lower()
     # Đảm bảo kết quả trả về là một trong ba giá trị mong đợi
     if "cooking_request" in answer:
         return "cooking_request"
-    elif "tư vấn" in answer:
+    if "tư vấn" in answer:
         return "tư vấn"
     return "không liên quan"
 
+def check_mode(user_question: str) -> str:
+    cache_key = _classification_cache_key(user_question)
+    cached_mode = classification_cache.get(cache_key)
+    if cached_mode:
+        return cached_mode
+    if not deadline.has_budget():
+        deadline.degrade("classify_topic")
+        return DEFAULT_MODE
+    try:
+        answer = LLMService.chat(
+            _build_check_mode_prompt(user_question),
+            system_prompt=CLASSIFY_SYSTEM_PROMPT,
+            max_tokens=None,
+        )
+    except deadline.DeadlineExceeded:
+        deadline.degrade("classify_topic", "timeout")
+        return DEFAULT_MODE
+    except LLMUnavailable:
+        deadline.degrade("classify_topic", "llm_unavailable")
+        return DEFAULT_MODE
+    mode = _parse_mode(answer)
+    classification_cache.set(cache_key, mode)
+    return mode
+
+async def acheck_mode(user_question: str) -> str:
+    """Phiên bản async của check_mode (cache có thể gọi Redis nên chạy ở thread, không chặn event loop)"""
+    cache_key = _classification_cache_key(user_question)
+    cached_mode = await asyncio.to_thread(classification_cache.get, cache_key)
+    if cached_mode:
+        return cached_mode
+    if not deadline.has_budget():
+        deadline.degrade("classify_topic")
+        return DEFAULT_MODE
+    try:
+        # Phân loại nằm đầu mọi request: chậm thì gửi thêm request hedge
+        answer = await LLMService.achat(
+            _build_check_mode_prompt(user_question),
+            system_prompt=CLASSIFY_SYSTEM_PROMPT,
+            max_tokens=None,
+            hedge=True,
+        )
+    except deadline.DeadlineExceeded:
+        deadline.degrade("classify_topic", "timeout")
+        return DEFAULT_MODE
+    except LLMUnavailable:
+        deadline.degrade("classify_topic", "llm_unavailable")
+        return DEFAULT_MODE
+    mode = _parse_mode(answer)
+    await asyncio.to_thread(classification_cache.set, cache_key, mode)
+    return mode
+
 def extract_cooking_methods(user_question: str) -> list:
     """Trích xuất các phương pháp nấu từ câu hỏi của user. Nếu phát hiện các từ khóa như 'tất cả', 'món khác', 'bất kỳ', 'tùy' thì trả về ['ALL']."""
     all_keywords = ["tất cả", "tất cả các món", "món khác", "bất kỳ", "tùy"]
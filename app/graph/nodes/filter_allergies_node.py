@@ -1,7 +1,11 @@
 from app.services.graph_schema_service import GraphSchemaService
-from app.services.mongo_service import mongo_service
+from app.services.dish_store import dish_store, DishRecord
 from app.services.llm.llm_service import LLMService
-from typing import Dict, Any, List
+from app.services.cache_service import allergy_cache, stable_key
+from app.config import ALLERGY_LLM_CONCURRENCY
+from app.utils import deadline
+from typing import Dict, Any, List, Optional, Tuple
+import asyncio
 import json
 
 def check_dish_name_for_allergies(dish_name: str, user_allergies: List[str]) -> tuple[bool, List[str]]:
@@ -19,7 +23,7 @@ def check_dish_name_for_allergies(dish_name: str, user_allergies: List[str]) ->
     
     return len(allergic_keywords) > 0, allergic_keywords
 
-def debug_dish_info(food: Dict[str, Any], mongo_dish: Dict[str, Any] = None) -> None:
+def debug_dish_info(food: Dict[str, Any], mongo_dish: Optional[DishRecord] = None) -> None:
     """
     Debug thông tin món ăn để hiểu rõ vấn đề
     """
@@ -38,9 +42,69 @@ def debug_dish_info(food: Dict[str, Any], mongo_dish: Dict[str, Any] = None) ->
     else:
         print(f"[DEBUG] - No MongoDB dish found")
 
-def filter_foods_by_allergies(state: Dict[str, Any]) -> Dict[str, Any]:
+def _dish_ingredients(food: Dict[str, Any], mongo_dish: Optional[DishRecord]) -> List[str]:
+    # Ưu tiên ingredients từ MongoDB, không có thì dùng từ Neo4j
+    if mongo_dish and mongo_dish.ingredients:
+        return mongo_dish.ingredients
+    return food.get("ingredients", [])
+
+def _load_dish_records(foods: Dict[str, Any]) -> Dict[Any, DishRecord]:
+    # Lấy thông tin món ăn từ MongoDB một lần cho tất cả neo4j_id (projection gọn, có cache theo id)
+    all_neo4j_ids = [
+        food.get("neo4j_id")
+        for food_data in foods.values()
+        for food in food_data.get("advanced", [])
+        if food.get("neo4j_id")
+    ]
+    return dish_store.get_many(all_neo4j_ids, by="neo4j_id", use_case="allergy")
+
+def _pending_allergy_analyses(foods: Dict[str, Any], dish_records: Dict[Any, DishRecord], user_allergies: List[str]) -> List[Tuple[List[str], str]]:
+    """Các món cần LLM phân tích: (ingredients, dish_name), bỏ qua món bị loại theo tên hoặc không có ingredients"""
+    pending = []
+    for food_data in foods.values():
+        for food in food_data.get("advanced", []):
+            dish_name = food.get("name", "Unknown dish")
+            if check_dish_name_for_allergies(dish_name, user_allergies)[0]:
+                continue
+            neo4j_id = food.get("neo4j_id")
+            dish_ingredients = _dish_ingredients(food, dish_records.get(neo4j_id) if neo4j_id else None)
+            if dish_ingredients:
+                pending.append((dish_ingredients, dish_name))
+    return pending
+
+async def afilter_foods_by_allergies(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Phiên bản async của filter_foods_by_allergies: gọi LLM phân tích các món song song,
+    sau đó chạy bước lọc (đọc MongoDB qua dish_store) ở thread với kết quả đã có
+    """
+    user_allergies = state.get("user_data", {}).get("allergies", [])
+    foods = state.get("query_result", {}).get("foods", {})
+    analyses: Dict[str, Dict[str, Any]] = {}
+    if user_allergies and foods:
+        try:
+            dish_records = await asyncio.to_thread(_load_dish_records, foods)
+            pending = _pending_allergy_analyses(foods, dish_records, user_allergies)
+            if pending and not deadline.has_budget():
+                # Không kịp gọi LLM: từng món dùng fallback_ingredient_analysis
+                deadline.degrade("filter_allergies")
+            # Giới hạn số lời gọi LLM đồng thời của một request
+            semaphore = asyncio.Semaphore(ALLERGY_LLM_CONCURRENCY)
+
+            async def analyze(ingredients: List[str], dish_name: str) -> Dict[str, Any]:
+                async with semaphore:
+                    return await aanalyze_ingredients_with_llm(ingredients, user_allergies, dish_name)
+
+            results = await asyncio.gather(*(analyze(ingredients, dish_name) for ingredients, dish_name in pending))
+            for (ingredients, dish_name), analysis in zip(pending, results):
+                analyses[_allergy_cache_key(ingredients, user_allergies, dish_name)] = analysis
+        except Exception as e:
+            print(f"Error in afilter_foods_by_allergies: {e}")
+    return await asyncio.to_thread(filter_foods_by_allergies, state, analyses)
+
+def filter_foods_by_allergies(state: Dict[str, Any], analyses: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
     """
     Lọc món ăn theo dị ứng của người dùng sử dụng LLM
+    analyses: kết quả phân tích đã có sẵn theo _allergy_cache_key (bản async gọi LLM trước)
     """
     try:
         user_data = state.get("user_data", {})
@@ -62,6 +126,8 @@ def filter_foods_by_allergies(state: Dict[str, Any]) -> Dict[str, Any]:
         
         print(f"[DEBUG] Processing {len(foods)} food sources")
         
+        dish_records = _load_dish_records(foods)
+        
         for source_key, food_data in foods.items():
             advanced_foods = food_data.get("advanced", [])
             print(f"[DEBUG] Processing source {source_key} with {len(advanced_foods)} foods")
@@ -89,28 +155,14 @@ def filter_foods_by_allergies(state: Dict[str, Any]) -> Dict[str, Any]:
                 
                 # Lấy thông tin đầy đủ từ MongoDB nếu có neo4j_id
                 neo4j_id = food.get("neo4j_id")
-                mongo_dish = None
-                
-                if neo4j_id:
-                    # Tìm món ăn trong MongoDB theo neo4j_id
-                    mongo_dishes = mongo_service.get_all_dishes()
-                    for dish in mongo_dishes:
-                        if dish.get("neo4j_id") == neo4j_id:
-                            mongo_dish = dish
-                            break
+                mongo_dish = dish_records.get(neo4j_id) if neo4j_id else None
                 
                 # Debug thông tin món ăn
                 debug_dish_info(food, mongo_dish)
                 
                 # Sử dụng thông tin từ MongoDB nếu có, không thì dùng từ Neo4j
-                dish_ingredients = []
-                if mongo_dish and mongo_dish.get("ingredients"):
-                    dish_ingredients = mongo_dish.get("ingredients", [])
-                    print(f"[DEBUG] Found ingredients from MongoDB for {dish_name}: {dish_ingredients}")
-                else:
-                    # Fallback: lấy ingredients từ Neo4j nếu có
-                    dish_ingredients = food.get("ingredients", [])
-                    print(f"[DEBUG] Using ingredients from Neo4j for {dish_name}: {dish_ingredients}")
+                dish_ingredients = _dish_ingredients(food, mongo_dish)
+                print(f"[DEBUG] Ingredients for {dish_name}: {dish_ingredients}")
                 
                 # Nếu không có ingredients, sử dụng tên món ăn để kiểm tra dị ứng
                 if not dish_ingredients:
@@ -145,21 +197,25 @@ def filter_foods_by_allergies(state: Dict[str, Any]) -> Dict[str, Any]:
                         continue
                 
                 # Sử dụng LLM để phân tích nguyên liệu chính/phụ
-                analysis_result = analyze_ingredients_with_llm(
-                    dish_ingredients, 
-                    user_allergies,
-                    dish_name
-                )
+                analysis_key = _allergy_cache_key(dish_ingredients, user_allergies, dish_name)
+                if analyses and analysis_key in analyses:
+                    analysis_result = analyses[analysis_key]
+                else:
+                    analysis_result = analyze_ingredients_with_llm(
+                        dish_ingredients, 
+                        user_allergies,
+                        dish_name
+                    )
                 
                 # Thêm thông tin phân tích vào food
                 food["allergy_analysis"] = analysis_result
                 if mongo_dish:
                     # Merge thông tin từ MongoDB
                     food.update({
-                        "mongo_id": mongo_dish.get("_id"),
-                        "full_ingredients": mongo_dish.get("ingredients", []),
-                        "instructions": mongo_dish.get("instructions", []),
-                        "source": mongo_dish.get("source", "neo4j_migration")
+                        "mongo_id": mongo_dish.id,
+                        "full_ingredients": list(mongo_dish.ingredients or []),
+                        "instructions": list(mongo_dish.instructions or []),
+                        "source": mongo_dish.source or "neo4j_migration"
                     })
                 
                 # Chỉ thêm món ăn an toàn vào danh sách
@@ -216,13 +272,12 @@ def filter_foods_by_allergies(state: Dict[str, Any]) -> Dict[str, Any]:
             "error": f"Lỗi lọc dị ứng: {str(e)}"
         }
 
-def analyze_ingredients_with_llm(ingredients: List[str], user_allergies: List[str], dish_name: str) -> Dict[str, Any]:
-    """
-    Sử dụng LLM để phân tích nguyên liệu và kiểm tra dị ứng
-    """
-    try:
-        # Tạo prompt cho LLM
-        prompt = f"""
+def _allergy_cache_key(ingredients: List[str], user_allergies: List[str], dish_name: str) -> str:
+    # Kết quả phân tích chỉ phụ thuộc vào món, nguyên liệu và danh sách dị ứng
+    return stable_key(dish_name, sorted(ingredients), sorted(a.lower().strip() for a in user_allergies))
+
+def _build_allergy_prompt(ingredients: List[str], user_allergies: List[str], dish_name: str) -> str:
+    return f"""
         Phân tích món ăn "{dish_name}" với các nguyên liệu: {', '.join(ingredients)}
         
         Danh sách dị ứng của người dùng: {', '.join(user_allergies)}
@@ -254,25 +309,68 @@ def analyze_ingredients_with_llm(ingredients: List[str], user_allergies: List[st
         
         Trả về JSON hợp lệ.
         """
-        
+
+def _parse_allergy_response(llm_response: str, dish_name: str) -> Optional[Dict[str, Any]]:
+    """Parse JSON response, None nếu LLM trả về không đúng JSON"""
+    try:
+        analysis = json.loads(llm_response)
+        print(f"[DEBUG] LLM response for {dish_name}: {analysis}")
+        return analysis
+    except json.JSONDecodeError:
+        print(f"[DEBUG] LLM JSON parse error for {dish_name}, using fallback")
+        return None
+
+def analyze_ingredients_with_llm(ingredients: List[str], user_allergies: List[str], dish_name: str) -> Dict[str, Any]:
+    """
+    Sử dụng LLM để phân tích nguyên liệu và kiểm tra dị ứng
+    """
+    cache_key = _allergy_cache_key(ingredients, user_allergies, dish_name)
+    cached_analysis = allergy_cache.get(cache_key)
+    if cached_analysis:
+        return cached_analysis
+
+    # Không còn đủ thời gian trong deadline của request: phân tích cục bộ
+    if not deadline.has_budget():
+        return fallback_ingredient_analysis(ingredients, user_allergies, dish_name)
+
+    try:
         # Gọi LLM
-        llm_response = LLMService.get_completion(prompt)
-        
-        # Parse JSON response
-        try:
-            analysis = json.loads(llm_response)
-            print(f"[DEBUG] LLM response for {dish_name}: {analysis}")
-            return analysis
-        except json.JSONDecodeError:
-            print(f"[DEBUG] LLM JSON parse error for {dish_name}, using fallback")
+        llm_response = LLMService.get_completion(_build_allergy_prompt(ingredients, user_allergies, dish_name))
+        analysis = _parse_allergy_response(llm_response, dish_name)
+        if analysis is None:
             # Fallback: phân tích đơn giản không dùng LLM
             return fallback_ingredient_analysis(ingredients, user_allergies, dish_name)
-            
+        allergy_cache.set(cache_key, analysis)
+        return analysis
     except Exception as e:
         print(f"Error in analyze_ingredients_with_llm: {e}")
         # Fallback: phân tích đơn giản không dùng LLM
         return fallback_ingredient_analysis(ingredients, user_allergies, dish_name)
 
+async def aanalyze_ingredients_with_llm(ingredients: List[str], user_allergies: List[str], dish_name: str) -> Dict[str, Any]:
+    """
+    Phiên bản async của analyze_ingredients_with_llm (đọc/ghi cache ở thread, không chặn event loop)
+    """
+    cache_key = _allergy_cache_key(ingredients, user_allergies, dish_name)
+    cached_analysis = await asyncio.to_thread(allergy_cache.get, cache_key)
+    if cached_analysis:
+        return cached_analysis
+
+    # Không còn đủ thời gian trong deadline của request: phân tích cục bộ
+    if not deadline.has_budget():
+        return fallback_ingredient_analysis(ingredients, user_allergies, dish_name)
+
+    try:
+        llm_response = await LLMService.aget_completion(_build_allergy_prompt(ingredients, user_allergies, dish_name))
+        analysis = _parse_allergy_response(llm_response, dish_name)
+        if analysis is None:
+            return fallback_ingredient_analysis(ingredients, user_allergies, dish_name)
+        await asyncio.to_thread(allergy_cache.set, cache_key, analysis)
+        return analysis
+    except Exception as e:
+        print(f"Error in aanalyze_ingredients_with_llm: {e}")
+        return fallback_ingredient_analysis(ingredients, user_allergies, dish_name)
+
 def fallback_ingredient_analysis(ingredients: List[str], user_allergies: List[str], dish_name: str) -> Dict[str, Any]:
     """
     Phân tích đơn giản khi LLM không khả dụng
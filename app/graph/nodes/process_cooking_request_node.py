@@ -18,7 +18,6 @@ def process_cooking_request(state: Dict[str, Any]) -> Dict[str, Any]:
         # Nếu user muốn tất cả các món
         if requested_methods == ["ALL"]:
             return {
-                **state,
                 "selected_cooking_methods": None,  # None nghĩa là không lọc
                 "cooking_request_warning": None,
                 "step": "cooking_request_processed"
@@ -27,7 +26,6 @@ def process_cooking_request(state: Dict[str, Any]) -> Dict[str, Any]:
         if not requested_methods:
             # Nếu không nhận diện được cooking method, fallback sang trả về tất cả các món
             return {
-                **state,
                 "selected_cooking_methods": None,
                 "cooking_request_warning": None,
                 "step": "cooking_request_processed"
@@ -36,8 +34,9 @@ def process_cooking_request(state: Dict[str, Any]) -> Dict[str, Any]:
         # Kiểm tra tính phù hợp với bệnh
         medical_conditions = [c for c in user_data.get("medicalConditions", []) if c not in ["Không có", "Bình thường"]]
         allowed_methods = set()
+        diet_analysis = GraphSchemaService.get_diet_analysis_by_diseases(medical_conditions)
         for condition in medical_conditions:
-            allowed_methods.update(GraphSchemaService.get_cook_methods_by_disease(condition))
+            allowed_methods.update(diet_analysis.get(condition, {}).get("cook_methods", []))
         if not allowed_methods:
             allowed_methods = set(GraphSchemaService.get_all_cooking_methods())
 
@@ -54,7 +53,6 @@ def process_cooking_request(state: Dict[str, Any]) -> Dict[str, Any]:
         # Nếu không còn phương pháp nào phù hợp, có thể trả về lỗi hoặc yêu cầu chọn lại
         if not suitable_methods:
             return {
-                **state,
                 "selected_cooking_methods": [],
                 "cooking_request_warning": warning_message or "Không có phương pháp nấu nào phù hợp với tình trạng bệnh của bạn.",
                 "step": "cooking_request_processed"
@@ -62,7 +60,6 @@ def process_cooking_request(state: Dict[str, Any]) -> Dict[str, Any]:
 
         # Cập nhật state
         return {
-            **state,
             "selected_cooking_methods": suitable_methods,
             "cooking_request_warning": warning_message,
             "step": "cooking_request_processed"
@@ -70,7 +67,6 @@ def process_cooking_request(state: Dict[str, Any]) -> Dict[str, Any]:
         
     except Exception as e:
         return {
-            **state,
             "error": f"Lỗi xử lý yêu cầu cooking method: {str(e)}",
             "step": "cooking_request_error"
         } 
\ No newline at end of file
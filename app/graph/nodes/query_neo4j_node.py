@@ -1,4 +1,5 @@
 from app.services.graph_schema_service import GraphSchemaService
+from app.utils.bitset import ExclusionSet
 from typing import Dict, Any, List
 
 def query_neo4j_for_foods(state: Dict[str, Any]) -> Dict[str, Any]:
@@ -10,7 +11,8 @@ def query_neo4j_for_foods(state: Dict[str, Any]) -> Dict[str, Any]:
         selected_cooking_methods = state.get("selected_cooking_methods", [])
         bmi_result = state.get("bmi_result", {})
         medical_conditions = user_data.get("medicalConditions", [])
-        previous_food_ids = state.get("previous_food_ids", [])  # Lấy danh sách ID đã gợi ý
+        # Các món đã gợi ý, được loại trong process trên tập ứng viên đã cache (không truyền vào Cypher)
+        previous_food_ids = ExclusionSet.from_state(state)
         
         bmi_category = bmi_result.get("bmi_category", "") if bmi_result else ""
         real_conditions = []
@@ -1,124 +1,150 @@
-import os
-from dotenv import load_dotenv
-from openai import OpenAI
-from typing import Dict, Any, List
-from app.services.mongo_service import mongo_service
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-def rerank_foods(state: Dict[str, Any]) -> Dict[str, Any]:
+import asyncio
+import json
+import re
+from typing import Dict, Any, List, Optional
+from app.services.dish_store import dish_store
+from app.services.llm.llm_service import LLMService, LLMUnavailable
+from app.utils.bitset import ExclusionSet
+from app.utils import deadline
+from app.utils.prompt_templates import COMBINED_RESPONSE_FORMAT, format_food_lines, get_combined_rerank_prompt
+from app.config import RERANK_TOP_K
+from app.graph.nodes.generate_natural_response_node import resolve_response_mode
+
+RERANK_MODEL = "gpt-4o"
+# Số món trả về khi rerank cục bộ (không gọi LLM)
+LOCAL_RERANK_LIMIT = 10
+# Âm tiết phổ biến trong câu hỏi, không dùng để so khớp với tên món
+QUESTION_STOPWORDS = {
+    "tôi", "mình", "bạn", "nên", "ăn", "gì", "món", "cho", "muốn", "có", "không", "là", "và",
+    "với", "hôm", "nay", "của", "nào", "được", "hãy", "gợi", "ý", "một", "các", "những", "thì",
+}
+
+def pre_rank(foods: List[Dict], question: str = "", cooking_methods: Optional[List[str]] = None,
+             limit: Optional[int] = None) -> List[Dict]:
     """
-    Node rerank các món ăn sử dụng LLM theo thứ tự phù hợp nhất
+    Chấm điểm cục bộ (không gọi LLM) và giữ `limit` món tốt nhất (mặc định RERANK_TOP_K, 0 = tất cả):
+    +2 nếu cách chế biến nằm trong lựa chọn của người dùng, +1 cho mỗi âm tiết của câu hỏi
+    xuất hiện trong tên món / chế độ ăn. Cùng điểm thì giữ thứ tự gốc của aggregate.
     """
-    try:
-        user_data = state.get("user_data", {})
-        bmi_result = state.get("bmi_result", {})
-        selected_emotion = state.get("selected_emotion")
-        selected_cooking_methods = state.get("selected_cooking_methods", [])
-        aggregated_result = state.get("aggregated_result", {})
-        user_question = state.get("question", "")
-        
-        # Lấy danh sách món ăn đã được tổng hợp
-        if not aggregated_result or aggregated_result.get("status") != "success":
-            return {"rerank_result": {"status": "error", "message": "Không có dữ liệu món ăn để rerank"}}
-        
-        aggregated_foods = aggregated_result.get("aggregated_foods", [])
-        if not aggregated_foods:
-            return {"rerank_result": {"status": "error", "message": "Danh sách món ăn trống"}}
-        
-        print(f"DEBUG: Reranking {len(aggregated_foods)} foods")
-        
-        # Lấy thông tin người dùng
-        user_name = user_data.get("name", "Unknown")
-        user_age = user_data.get("age", "N/A")
-        bmi_category = bmi_result.get("bmi_category", "") if bmi_result else ""
-        medical_conditions = user_data.get("medicalConditions", [])
-        user_allergies = user_data.get("allergies", [])
-        
-        # Lọc bệnh thực sự
-        real_conditions = []
-        if medical_conditions:
-            for condition in medical_conditions:
-                condition_lower = condition.lower().strip()
-                if condition_lower not in ["không có", "không bệnh", "không có bệnh", "bình thường", "khỏe mạnh"]:
-                    real_conditions.append(condition)
-        
-        # Lọc món ăn theo dị ứng (nếu có)
-        if user_allergies:
-            # Lấy thông tin chi tiết món ăn từ MongoDB
-            dish_ids = [food.get("dish_id") for food in aggregated_foods if food.get("dish_id")]
-            dishes_from_mongo = mongo_service.get_dishes_by_ids(dish_ids)
-            
-            # Tạo mapping từ dish_id đến dish data
-            dish_mapping = {dish["_id"]: dish for dish in dishes_from_mongo}
-            
-            # Lọc món ăn theo dị ứng
-            filtered_foods = []
-            for food in aggregated_foods:
-                dish_id = food.get("dish_id")
-                if dish_id and dish_id in dish_mapping:
-                    dish_data = dish_mapping[dish_id]
-                    dish_ingredients = dish_data.get("ingredients", [])
-                    
-                    # Kiểm tra xem món ăn có chứa nguyên liệu dị ứng không
-                    has_allergic_ingredient = False
-                    for allergy in user_allergies:
-                        if allergy.lower() in [ing.lower() for ing in dish_ingredients]:
-                            has_allergic_ingredient = True
-                            break
-                    
-                    # Chỉ thêm món ăn không chứa nguyên liệu dị ứng
-                    if not has_allergic_ingredient:
-                        filtered_foods.append(food)
-                else:
-                    # Nếu không tìm thấy trong MongoDB, giữ lại món ăn (để an toàn)
-                    filtered_foods.append(food)
-            
-            aggregated_foods = filtered_foods
-            print(f"DEBUG: Filtered {len(filtered_foods)} foods after allergy check (removed {len([food.get('dish_id') for food in aggregated_foods if food.get('dish_id')]) - len(filtered_foods)} dishes with allergic ingredients)")
+    limit = RERANK_TOP_K if limit is None else limit
+    preferred_methods = {method.lower() for method in cooking_methods or []}
+    question_words = set(re.findall(r"\w+", question.lower())) - QUESTION_STOPWORDS
+
+    def score(food: Dict) -> int:
+        points = 2 if (food.get("cook_method") or "").lower() in preferred_methods else 0
+        if question_words:
+            food_words = set(re.findall(r"\w+", f"{food.get('dish_name', '')} {food.get('diet_name', '')}".lower()))
+            points += len(question_words & food_words)
+        return points
+
+    ranked = sorted(foods, key=score, reverse=True) if preferred_methods or question_words else list(foods)
+    return ranked[:limit] if limit else ranked
+
+def _prepare_rerank(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Lọc dị ứng và dựng prompt rerank (phần không gọi LLM, có đọc MongoDB).
+    Trả về {"rerank_result": ...} nếu không cần gọi LLM, ngược lại trả về context cho _finish_rerank
+    """
+    user_data = state.get("user_data", {})
+    bmi_result = state.get("bmi_result", {})
+    selected_emotion = state.get("selected_emotion")
+    selected_cooking_methods = state.get("selected_cooking_methods", [])
+    aggregated_result = state.get("aggregated_result", {})
+    user_question = state.get("question", "")
+    
+    # Lấy danh sách món ăn đã được tổng hợp
+    if not aggregated_result or aggregated_result.get("status") != "success":
+        return {"rerank_result": {"status": "error", "message": "Không có dữ liệu món ăn để rerank"}}
+    
+    aggregated_foods = aggregated_result.get("aggregated_foods", [])
+    if not aggregated_foods:
+        return {"rerank_result": {"status": "error", "message": "Danh sách món ăn trống"}}
+    
+    print(f"DEBUG: Reranking {len(aggregated_foods)} foods")
+    
+    # Lấy thông tin người dùng
+    user_name = user_data.get("name", "Unknown")
+    user_age = user_data.get("age", "N/A")
+    bmi_category = bmi_result.get("bmi_category", "") if bmi_result else ""
+    medical_conditions = user_data.get("medicalConditions", [])
+    user_allergies = user_data.get("allergies", [])
+    
+    # Lọc bệnh thực sự
+    real_conditions = []
+    if medical_conditions:
+        for condition in medical_conditions:
+            condition_lower = condition.lower().strip()
+            if condition_lower not in ["không có", "không bệnh", "không có bệnh", "bình thường", "khỏe mạnh"]:
+                real_conditions.append(condition)
+    
+    # Lọc món ăn theo dị ứng (nếu có)
+    if user_allergies:
+        # Lấy thông tin chi tiết món ăn từ MongoDB
+        dish_ids = [food.get("dish_id") for food in aggregated_foods if food.get("dish_id")]
+        # Tạo mapping từ dish_id đến DishRecord (chỉ lấy các trường cần dùng, có cache theo id)
+        dish_mapping = dish_store.get_many(dish_ids, by="_id", use_case="rerank")
         
-        # Chuẩn bị dữ liệu cho LLM
-        foods_data = []
+        # Lọc món ăn theo dị ứng
+        filtered_foods = []
         for food in aggregated_foods:
-            food_info = {
-                "id": food.get("dish_id", ""),
-                "name": food.get("dish_name", "Unknown"),
-                "cook_method": food.get("cook_method", ""),
-                "diet": food.get("diet_name", "")
-            }
-            foods_data.append(food_info)
-        
-        # Tạo danh sách món ăn cho prompt
-        foods_list = ""
-        for i, food in enumerate(foods_data, 1):
-            foods_list += f"{i}. {food['name']}\n"
-            if food.get('cook_method'):
-                foods_list += f"   - Cách chế biến: {food['cook_method']}\n"
-            if food.get('diet'):
-                foods_list += f"   - Chế độ ăn: {food['diet']}\n"
-            foods_list += "\n"
-        
-        # Tạo thông tin bệnh
-        conditions_text = "không có bệnh đặc biệt"
-        if real_conditions:
-            conditions_text = ", ".join(real_conditions)
-        
-        # Tạo thông tin dị ứng
-        allergies_text = "không có dị ứng"
-        if user_allergies:
-            allergies_text = ", ".join(user_allergies)
-        
-        # Tạo thông tin cách chế biến
-        cooking_text = "không yêu cầu cụ thể"
-        if selected_cooking_methods:
-            cooking_text = ", ".join(selected_cooking_methods)
+            dish_id = food.get("dish_id")
+            if dish_id and dish_id in dish_mapping:
+                dish_data = dish_mapping[dish_id]
+                dish_ingredients = dish_data.ingredients or []
+                
+                # Kiểm tra xem món ăn có chứa nguyên liệu dị ứng không
+                has_allergic_ingredient = False
+                for allergy in user_allergies:
+                    if allergy.lower() in [ing.lower() for ing in dish_ingredients]:
+                        has_allergic_ingredient = True
+                        break
+                
+                # Chỉ thêm món ăn không chứa nguyên liệu dị ứng
+                if not has_allergic_ingredient:
+                    filtered_foods.append(food)
+            else:
+                # Nếu không tìm thấy trong MongoDB, giữ lại món ăn (để an toàn)
+                filtered_foods.append(food)
         
-        # Tạo prompt mới, rõ ràng và ổn định hơn
-        previous_food_ids = state.get("previous_food_ids", [])
-        previous_foods_text = ""
-        if previous_food_ids:
-            previous_foods_text = f"\n\n**Lưu ý QUAN TRỌNG:**\n- KHÔNG ĐƯỢC chọn lại bất kỳ món ăn nào có id trong danh sách sau (đây là các món đã được gợi ý trước đó): {previous_food_ids}\n"
+        aggregated_foods = filtered_foods
+        print(f"DEBUG: Filtered {len(filtered_foods)} foods after allergy check (removed {len([food.get('dish_id') for food in aggregated_foods if food.get('dish_id')]) - len(filtered_foods)} dishes with allergic ingredients)")
+    
+    # Bỏ món đã gợi ý, chấm điểm cục bộ và chỉ giữ top-K món cho prompt (catalog có thể rất lớn)
+    exclusion = ExclusionSet.from_state(state)
+    total_count = len(aggregated_foods)
+    aggregated_foods = pre_rank(exclusion.filter(aggregated_foods), user_question, selected_cooking_methods)
+
+    # Chuẩn bị dữ liệu cho LLM
+    foods_data = []
+    for food in aggregated_foods:
+        food_info = {
+            "id": food.get("dish_id", ""),
+            "name": food.get("dish_name", "Unknown"),
+            "cook_method": food.get("cook_method", ""),
+            "diet": food.get("diet_name", "")
+        }
+        foods_data.append(food_info)
+
+    # Danh sách món dạng một dòng mỗi món (id | tên | cách chế biến | chế độ ăn)
+    foods_list = format_food_lines(foods_data)
 
-        prompt = f"""Bạn là một chuyên gia dinh dưỡng và ẩm thực hàng đầu. Nhiệm vụ của bạn là giúp người dùng chọn món ăn phù hợp nhất từ một danh sách cho trước.
+    # Tạo thông tin bệnh
+    conditions_text = "không có bệnh đặc biệt"
+    if real_conditions:
+        conditions_text = ", ".join(real_conditions)
+    
+    # Tạo thông tin dị ứng
+    allergies_text = "không có dị ứng"
+    if user_allergies:
+        allergies_text = ", ".join(user_allergies)
+    
+    # Tạo thông tin cách chế biến
+    cooking_text = "không yêu cầu cụ thể"
+    if selected_cooking_methods:
+        cooking_text = ", ".join(selected_cooking_methods)
+    
+    # Tạo prompt mới, rõ ràng và ổn định hơn
+    prompt = f"""Bạn là một chuyên gia dinh dưỡng và ẩm thực hàng đầu. Nhiệm vụ của bạn là giúp người dùng chọn món ăn phù hợp nhất từ một danh sách cho trước.
 
 **Thông tin người dùng:**
 - Tên: {user_name}
@@ -129,10 +155,9 @@ def rerank_foods(state: Dict[str, Any]) -> Dict[str, Any]:
 - Cảm xúc hiện tại: {selected_emotion}
 - Cách chế biến ưa thích: {cooking_text}
 
-**Danh sách món ăn cần xử lý:**
+**Danh sách món ăn cần xử lý (id | tên | cách chế biến | chế độ ăn):**
 {foods_list}
-{previous_foods_text}
-**Lưu ý QUAN TRỌNG:**- KHÔNG ĐƯỢC chọn lại bất kỳ món ăn nào có id trong danh sách sau (đây là các món đã được gợi ý trước đó): {previous_food_ids}
+
 **YÊU CẦU:**
 
 **Bước 1: Xác định quy tắc lọc món ăn từ câu hỏi của người dùng.**
@@ -155,7 +180,6 @@ def rerank_foods(state: Dict[str, Any]) -> Dict[str, Any]:
   3.  **Sở thích:** Phù hợp với cách chế biến ({cooking_text}).
   4.  Mức độ phổ biến và cân bằng dinh dưỡng.
 - **Loại bỏ** những món không thực sự phù hợp với các tiêu chí trên.
-- **TUYỆT ĐỐI KHÔNG ĐƯỢC chọn lại bất kỳ món ăn nào có id nằm trong danh sách đã cung cấp ở trên. TRỪ khi câu hỏi yêu cầu chọn lại món đã gợi ý trước đó.
 -**Nếu có món ăn phù hợp**: Trả về **CHỈ danh sách TÊN các món ăn** đã được lọc và sắp xếp.
 - **Nếu User CHỈ ĐỊNH YÊU CẦU MỘT MÓN CỤ THỂ**: Trả về CHỈ MỘT MÓN ĂN.
 - **Nếu KHÔNG có món ăn phù hợp do dị ứng**: Trả về lời giải thích rõ ràng về lý do không thể gợi ý món ăn, bao gồm:
@@ -169,116 +193,192 @@ def rerank_foods(state: Dict[str, Any]) -> Dict[str, Any]:
 - Nếu User CHỈ ĐỊNH YÊU CẦU MỘT MÓN CỤ THỂ hoặc GẦN GIỐNG MỘT MÓN CỤ THỂ đó. BẠN PHẢI TRẢ VỀ CHỈ MỘT MÓN ĂN.
 - Mỗi món ăn trên một dòng. Không thêm số thứ tự, giải thích hay bất kỳ thông tin nào khác.
 """
-        
-        print(f"DEBUG: Sending rerank request to LLM for {len(foods_data)} foods")
-        print(f"DEBUG: User question: {user_question}")
-        print(f"DEBUG: Prompt length: {len(prompt)} characters")
-        
-        # Gọi LLM để rerank
+    
+    print(f"DEBUG: Sending rerank request to LLM for {len(foods_data)}/{total_count} foods (top-K={RERANK_TOP_K or 'all'})")
+    print(f"DEBUG: User question: {user_question}")
+
+    # Chế độ combined: một lần gọi LLM trả về cả thứ tự món và câu trả lời tự nhiên
+    combined = resolve_response_mode(state) == "combined"
+    if combined:
+        prompt = get_combined_rerank_prompt({
+            "user_name": user_name,
+            "user_question": user_question,
+            "bmi_category": bmi_category,
+            "conditions_text": conditions_text,
+            "allergies_text": allergies_text,
+            "cooking_text": cooking_text,
+            "foods": foods_data,
+            "weather": state.get("weather", ""),
+            "time_of_day": state.get("time_of_day", ""),
+        })
+
+    print(f"DEBUG: Prompt length: {len(prompt)} characters")
+
+    return {
+        "prompt": prompt,
+        "combined": combined,
+        "aggregated_foods": aggregated_foods,
+        "rerank_criteria": {
+            "bmi_category": bmi_category,
+            "medical_conditions": real_conditions,
+            "emotion": selected_emotion,
+            "cooking_methods": selected_cooking_methods
+        }
+    }
+
+def _finish_rerank(llm_response: str, context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parse câu trả lời của LLM thành rerank_result
+    """
+    # Parse kết quả từ LLM
+    # Danh sách ứng viên đã bỏ món gợi ý trước đó nên kết quả parse không cần lọc lại
+    filtered_ranked_foods = parse_llm_rerank_response(llm_response, context["aggregated_foods"])
+
+    print(f"DEBUG: After parsing, ranked_foods count: {len(filtered_ranked_foods)}")
+    if filtered_ranked_foods:
+        print(f"DEBUG: First few ranked foods: {[f.get('dish_name', 'Unknown') for f in filtered_ranked_foods[:3]]}")
+        print(f"DEBUG: Successfully reranked {len(filtered_ranked_foods)} foods")
+        return {
+            "status": "success",
+            "message": f"Đã rerank và lọc {len(filtered_ranked_foods)} món ăn phù hợp",
+            "ranked_foods": filtered_ranked_foods,
+            "total_count": len(filtered_ranked_foods),
+            "rerank_criteria": context["rerank_criteria"]
+        }
+
+    print("DEBUG: LLM did not select any foods, checking if it provided explanation")
+
+    # Kiểm tra xem LLM có trả về lời giải thích về dị ứng hoặc lý do không
+    explanation_keywords = [
+        "xin lỗi", "không thể", "không phù hợp", "dị ứng", "gây dị ứng",
+        "không an toàn", "không có món", "không tìm thấy"
+    ]
+
+    has_explanation = any(keyword in llm_response.lower() for keyword in explanation_keywords)
+
+    if has_explanation and len(llm_response.strip()) > 30:
+        # LLM đã trả về lời giải thích, sử dụng nó
+        print(f"DEBUG: LLM provided explanation: {llm_response[:100]}...")
+        return {
+            "status": "llm_explanation_provided",
+            "message": "LLM đã cung cấp lời giải thích",
+            "ranked_foods": [],
+            "total_count": 0,
+            "llm_explanation": llm_response.strip(),
+            "rerank_criteria": context["rerank_criteria"]
+        }
+
+    # LLM không chọn món nào và không có lời giải thích rõ ràng
+    return {
+        "status": "success",
+        "message": f"Không tìm thấy món ăn phù hợp với yêu cầu của bạn",
+        "ranked_foods": [],
+        "total_count": 0,
+        "rerank_criteria": context["rerank_criteria"]
+    }
+
+def _finish_combined(llm_response: str, context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parse kết quả structured output {ranked_ids, answer} của chế độ combined.
+    answer được generate_natural_response dùng luôn, không gọi LLM lần hai
+    """
+    try:
+        data = json.loads(llm_response)
+        ranked_ids = [str(dish_id) for dish_id in data["ranked_ids"]]
+        answer = data["answer"].strip()
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        # Không parse được: rerank cục bộ, câu trả lời để node generate_natural_response tạo như thường
+        print(f"DEBUG: Invalid combined rerank response: {e}")
+        return local_rerank(context)
+
+    foods_by_id = {str(food.get("dish_id")): food for food in context["aggregated_foods"] if food.get("dish_id")}
+    ranked_foods = []
+    for dish_id in dict.fromkeys(ranked_ids):
+        if dish_id in foods_by_id:
+            ranked_foods.append(foods_by_id[dish_id])
+    print(f"DEBUG: Combined rerank selected {len(ranked_foods)} foods")
+    return {
+        "status": "success",
+        "message": f"Đã rerank và lọc {len(ranked_foods)} món ăn phù hợp" if ranked_foods else "Không tìm thấy món ăn phù hợp với yêu cầu của bạn",
+        "ranked_foods": ranked_foods,
+        "total_count": len(ranked_foods),
+        "rerank_criteria": context["rerank_criteria"],
+        "answer": answer
+    }
+
+def local_rerank(context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Rerank không dùng LLM (khi không kịp deadline): dùng luôn thứ tự chấm điểm cục bộ của pre_rank
+    (đã bỏ món đã gợi ý), lấy LOCAL_RERANK_LIMIT món đầu
+    """
+    ranked_foods = context["aggregated_foods"][:LOCAL_RERANK_LIMIT]
+    return {
+        "status": "success",
+        "message": f"Đã sắp xếp {len(ranked_foods)} món ăn phù hợp",
+        "ranked_foods": ranked_foods,
+        "total_count": len(ranked_foods),
+        "rerank_criteria": context["rerank_criteria"],
+        "degraded": True
+    }
+
+def _rerank_error(e: Exception, context: Dict[str, Any]) -> Dict[str, Any]:
+    print(f"DEBUG: LLM error: {e}")
+    # Nếu LLM lỗi, trả về thông báo lỗi thay vì sử dụng thứ tự gốc
+    return {
+        "status": "error",
+        "message": f"Lỗi khi rerank món ăn: {str(e)}",
+        "ranked_foods": [],
+        "total_count": 0,
+        "rerank_criteria": context["rerank_criteria"]
+    }
+
+def _llm_options(context: Dict[str, Any]) -> Dict[str, Any]:
+    if context["combined"]:
+        return {"model": RERANK_MODEL, "response_format": COMBINED_RESPONSE_FORMAT}
+    return {"model": RERANK_MODEL}
+
+def _finish_llm_response(llm_response: str, context: Dict[str, Any]) -> Dict[str, Any]:
+    if context["combined"] and llm_response:
+        return _finish_combined(llm_response, context)
+    return _finish_rerank(llm_response, context)
+
+def _log_llm_response(llm_response: str):
+    print(f"DEBUG: LLM response received: {len(llm_response)} characters")
+    print(f"DEBUG: LLM response content: {llm_response}")
+
+async def arerank_foods(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Node rerank các món ăn sử dụng LLM theo thứ tự phù hợp nhất.
+    Phần đọc MongoDB chạy ở thread, chờ LLM không chiếm thread
+    """
+    try:
+        context = await asyncio.to_thread(_prepare_rerank, state)
+        if "rerank_result" in context:
+            return context
+
+        if not deadline.has_budget():
+            deadline.degrade("rerank_foods")
+            return {"rerank_result": local_rerank(context)}
+
         try:
-            # Sử dụng OpenAI client trực tiếp
-            if not client:
+            if not LLMService.is_available():
                 print("WARNING: No OpenAI client available, using original order")
                 llm_response = ""
             else:
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "Bạn là một chuyên gia dinh dưỡng và ẩm thực."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=2000,
-                    temperature=0.1
-                )
-                
-                llm_response = response.choices[0].message.content
-                print(f"DEBUG: LLM response received: {len(llm_response)} characters")
-                print(f"DEBUG: LLM response content: {llm_response}")
-            
-            # Parse kết quả từ LLM
-            ranked_foods = parse_llm_rerank_response(llm_response, aggregated_foods)
-            # Lọc lại các món đã gợi ý trước đó
-            filtered_ranked_foods = [food for food in ranked_foods if food.get("dish_id") not in previous_food_ids]
-            
-            print(f"DEBUG: After parsing, ranked_foods count: {len(filtered_ranked_foods)}")
-            if filtered_ranked_foods:
-                print(f"DEBUG: First few ranked foods: {[f.get('dish_name', 'Unknown') for f in filtered_ranked_foods[:3]]}")
-            
-            if filtered_ranked_foods:
-                print(f"DEBUG: Successfully reranked {len(filtered_ranked_foods)} foods")
-                
-                result = {
-                    "status": "success",
-                    "message": f"Đã rerank và lọc {len(filtered_ranked_foods)} món ăn phù hợp",
-                    "ranked_foods": filtered_ranked_foods,
-                    "total_count": len(filtered_ranked_foods),
-                    "rerank_criteria": {
-                        "bmi_category": bmi_category,
-                        "medical_conditions": real_conditions,
-                        "emotion": selected_emotion,
-                        "cooking_methods": selected_cooking_methods
-                    }
-                }
-            else:
-                print("DEBUG: LLM did not select any foods, checking if it provided explanation")
-                
-                # Kiểm tra xem LLM có trả về lời giải thích về dị ứng hoặc lý do không
-                explanation_keywords = [
-                    "xin lỗi", "không thể", "không phù hợp", "dị ứng", "gây dị ứng",
-                    "không an toàn", "không có món", "không tìm thấy"
-                ]
-                
-                has_explanation = any(keyword in llm_response.lower() for keyword in explanation_keywords)
-                
-                if has_explanation and len(llm_response.strip()) > 30:
-                    # LLM đã trả về lời giải thích, sử dụng nó
-                    print(f"DEBUG: LLM provided explanation: {llm_response[:100]}...")
-                    result = {
-                        "status": "llm_explanation_provided",
-                        "message": "LLM đã cung cấp lời giải thích",
-                        "ranked_foods": [],
-                        "total_count": 0,
-                        "llm_explanation": llm_response.strip(),
-                        "rerank_criteria": {
-                            "bmi_category": bmi_category,
-                            "medical_conditions": real_conditions,
-                            "emotion": selected_emotion,
-                            "cooking_methods": selected_cooking_methods
-                        }
-                    }
-                else:
-                    # LLM không chọn món nào và không có lời giải thích rõ ràng
-                    result = {
-                        "status": "success",
-                        "message": f"Không tìm thấy món ăn phù hợp với yêu cầu của bạn",
-                        "ranked_foods": [],
-                        "total_count": 0,
-                        "rerank_criteria": {
-                            "bmi_category": bmi_category,
-                            "medical_conditions": real_conditions,
-                            "emotion": selected_emotion,
-                            "cooking_methods": selected_cooking_methods
-                        }
-                    }
-                
+                llm_response = await LLMService.achat(context["prompt"], **_llm_options(context))
+                _log_llm_response(llm_response)
+            result = _finish_llm_response(llm_response, context)
+        except deadline.DeadlineExceeded:
+            deadline.degrade("rerank_foods", "timeout")
+            result = local_rerank(context)
+        except LLMUnavailable:
+            deadline.degrade("rerank_foods", "llm_unavailable")
+            result = local_rerank(context)
         except Exception as e:
-            print(f"DEBUG: LLM error: {e}")
-            # Nếu LLM lỗi, trả về thông báo lỗi thay vì sử dụng thứ tự gốc
-            result = {
-                "status": "error",
-                "message": f"Lỗi khi rerank món ăn: {str(e)}",
-                "ranked_foods": [],
-                "total_count": 0,
-                "rerank_criteria": {
-                    "bmi_category": bmi_category,
-                    "medical_conditions": real_conditions,
-                    "emotion": selected_emotion,
-                    "cooking_methods": selected_cooking_methods
-                }
-            }
-        
+            result = _rerank_error(e, context)
+
         return {"rerank_result": result}
-        
+
     except Exception as e:
         return {"rerank_result": {"status": "error", "message": f"Lỗi rerank: {str(e)}"}}
 
@@ -1,9 +1,38 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes import classify_topic, langgraph_workflow
+from app.services.bmi_writer import bmi_writer
+from app.services.connection_manager import connection_manager
+from app.services.async_mongo_service import async_mongo_service
+from app.services.cache_watcher import cache_watcher
+from app.utils.checkpointer import open_checkpointer, close_checkpointer, get_checkpoint_stats
+from app.services.metrics import registry as metrics_registry, setup_tracing, shutdown_tracing
+from app.services.cache_service import graph_cache, allergy_cache, classification_cache
+from app.config import CACHE_WATCH_ENABLED
 # from app.routes.langgraph_workflow import get_user_id_from_token
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Khởi tạo pool Neo4j/MongoDB khi worker khởi động (không chặn lúc import)
+    setup_tracing()
+    await run_in_threadpool(connection_manager.startup)
+    # Checkpointer của workflow (sqlite/redis mở kết nối trong event loop)
+    await open_checkpointer()
+    if CACHE_WATCH_ENABLED:
+        cache_watcher.start()
+    yield
+    await run_in_threadpool(cache_watcher.stop)
+    # Ghi nốt các kết quả BMI còn trong hàng đợi rồi đóng kết nối
+    await run_in_threadpool(bmi_writer.stop)
+    await async_mongo_service.close()
+    await close_checkpointer()
+    await run_in_threadpool(connection_manager.shutdown)
+    shutdown_tracing()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration - Updated for deployment
 app.add_middleware(
@@ -16,3 +45,30 @@ app.add_middleware(
 )
 app.include_router(classify_topic.router, prefix="/api/classify", tags=["Classification"])
 app.include_router(langgraph_workflow.router, prefix="/api/langgraph", tags=["LangGraph Workflow"])
+
+
+@app.get("/ready", tags=["Health"])
+def ready():
+    """Readiness probe: 200 khi Neo4j và MongoDB đều phản hồi, ngược lại 503"""
+    status = connection_manager.readiness()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+def _cache_stats(field: str):
+    return {(cache.namespace,): cache.stats()[field] for cache in (graph_cache, allergy_cache, classification_cache)}
+
+# Gauge session/cache, tính lúc Prometheus scrape
+metrics_registry.gauge_callback("checkpoint_threads", "Số session (thread checkpoint) đang giữ trong process", lambda: get_checkpoint_stats().get("threads"))
+metrics_registry.gauge_callback("checkpoint_evicted", "Số session bị loại (LRU) từ khi khởi động", lambda: get_checkpoint_stats().get("evicted"))
+metrics_registry.gauge_callback("checkpoint_expired", "Số session hết hạn bị xóa từ khi khởi động", lambda: get_checkpoint_stats().get("expired"))
+metrics_registry.gauge_callback("checkpoint_bytes", "Tổng số byte session đang giữ trong process", lambda: get_checkpoint_stats().get("bytes"))
+metrics_registry.gauge_callback("cache_l1_entries", "Số entry cache L1 trong process", lambda: _cache_stats("l1_entries"), ("namespace",))
+metrics_registry.gauge_callback("cache_hits_l1", "Số lần trúng cache L1", lambda: _cache_stats("hits_l1"), ("namespace",))
+metrics_registry.gauge_callback("cache_hits_l2", "Số lần trúng cache Redis", lambda: _cache_stats("hits_l2"), ("namespace",))
+metrics_registry.gauge_callback("cache_misses", "Số lần trượt cache", lambda: _cache_stats("misses"), ("namespace",))
+
+
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+def metrics():
+    """Metrics định dạng Prometheus: thời gian/lỗi/step theo node, lời gọi ngoài, token LLM, session, cache"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
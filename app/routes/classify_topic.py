@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from app.graph.nodes.classify_topic_node import check_mode
+from app.graph.nodes.classify_topic_node import acheck_mode
 
 router = APIRouter()
 
@@ -8,12 +8,12 @@ class QuestionInput(BaseModel):
     question: str
 
 @router.post("/check-mode")
-def classify_question(data: QuestionInput):
+async def classify_question(data: QuestionInput):
     """
     Phân loại chủ đề câu hỏi
     """
     try:
-        result = check_mode(data.question)
+        result = await acheck_mode(data.question)
         return {
             "status": "success" if result == "yes" else "rejected",
             "message": "Câu hỏi thuộc chủ đề dinh dưỡng" if result == "yes" else "Câu hỏi không thuộc chủ đề dinh dưỡng",
@@ -1,12 +1,14 @@
 from fastapi import APIRouter, HTTPException, Depends, Header
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Literal
 import jwt
 from app.graph.engine import (
     run_langgraph_workflow_until_selection, 
     continue_workflow_with_selections
 )
-from app.config import JWT_SECRET_KEY
+from app.config import JWT_SECRET_KEY, PROCESS_DEADLINE_SECONDS, PROCESS_SELECTIONS_DEADLINE_SECONDS
+from app.utils.deadline import request_deadline
+from app.utils.checkpointer import get_checkpoint_stats
 
 router = APIRouter()
 
@@ -16,11 +18,15 @@ class WorkflowInput(BaseModel):
     time_of_day: Optional[str] = None
     session_id: Optional[str] = None
     ignore_context_filter: bool = False
+    # "template": câu trả lời dựng sẵn không gọi LLM, "combined": rerank + câu trả lời trong một lần gọi LLM
+    # None = theo NATURAL_RESPONSE_MODE
+    response_mode: Optional[Literal["llm", "template", "combined"]] = None
 
 class SelectionsInput(BaseModel):
     session_id: str
     ingredients: List[str]
     cooking_methods: List[str]
+    response_mode: Optional[Literal["llm", "template", "combined"]] = None
 
 def get_user_id_from_token(authorization: Optional[str] = Header(None)) -> str:
     """
@@ -71,7 +77,7 @@ def get_user_id_from_token(authorization: Optional[str] = Header(None)) -> str:
         )
 
 @router.post("/process")
-def process_with_langgraph(
+async def process_with_langgraph(
     data: WorkflowInput,
     user_id: str = Depends(get_user_id_from_token),
 ):
@@ -83,10 +89,12 @@ def process_with_langgraph(
                 detail="weather và time_of_day là bắt buộc khi ignore_context_filter=False"
             )
     try:
-        # Chạy workflow từ đầu để lấy phân tích và prompts
-        result = run_langgraph_workflow_until_selection(
-            user_id, data.question, data.weather, data.time_of_day, data.session_id, data.ignore_context_filter
-        )
+        # Chạy workflow từ đầu để lấy phân tích và prompts (các node chia nhau deadline của request)
+        with request_deadline(PROCESS_DEADLINE_SECONDS):
+            result = await run_langgraph_workflow_until_selection(
+                user_id, data.question, data.weather, data.time_of_day, data.session_id, data.ignore_context_filter,
+                response_mode=data.response_mode
+            )
         return result
     except Exception as e:
         raise HTTPException(
@@ -95,7 +103,7 @@ def process_with_langgraph(
         )
 
 @router.post("/process-selections")
-def process_selections(
+async def process_selections(
     data: SelectionsInput,
     user_id: str = Depends(get_user_id_from_token)
 ):
@@ -103,12 +111,14 @@ def process_selections(
     Nhận các lựa chọn (nguyên liệu và phương pháp chế biến) và trả về kết quả cuối cùng.
     """
     try:
-        result = continue_workflow_with_selections(
-            session_id=data.session_id,
-            ingredients=data.ingredients,
-            cooking_methods=data.cooking_methods,
-            user_id=user_id
-        )
+        with request_deadline(PROCESS_SELECTIONS_DEADLINE_SECONDS):
+            result = await continue_workflow_with_selections(
+                session_id=data.session_id,
+                ingredients=data.ingredients,
+                cooking_methods=data.cooking_methods,
+                user_id=user_id,
+                response_mode=data.response_mode
+            )
         return result
     except HTTPException as he:
         raise he
@@ -120,6 +130,13 @@ def process_selections(
             detail=f"Lỗi xử lý workflow: {str(e)}"
         )
 
+@router.get("/session-stats")
+def session_stats():
+    """
+    Gauge session (thread checkpoint) đang lưu: backend, số thread, số thread bị loại (LRU / hết hạn)
+    """
+    return get_checkpoint_stats()
+
 @router.get("/workflow-info")
 def get_workflow_info():
     """
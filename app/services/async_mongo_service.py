@@ -0,0 +1,137 @@
+from typing import Optional, Dict, Any, List
+
+from pymongo import AsyncMongoClient
+
+from app.config import MONGODB_URI, MONGODB_DB, MONGO_CLIENT_OPTIONS
+from app.services.mongo_service import (
+    MongoService,
+    USER_HEALTH_PROJECTION,
+    DISH_ID_PROJECTION,
+    INGREDIENT_NAME_PROJECTION,
+    ALL_INGREDIENTS_KEY,
+    ingredient_cache,
+    cook_methods_cache,
+    cook_methods_key,
+    build_cook_methods_pipeline,
+    build_dishes_by_ingredients_query,
+    prepare_user_health_data,
+)
+from app.services.user_profile_cache import user_profile_cache
+from app.services.metrics import traced
+from app.services.metrics import traced
+
+
+class AsyncMongoService:
+    """
+    Phiên bản async của MongoService (pymongo AsyncMongoClient) cho các luồng async,
+    cùng bề mặt phương thức, cùng projection, cùng cấu hình pool và cache hồ sơ user.
+    Client được tạo lười ở lần dùng đầu tiên (bên trong event loop).
+    """
+
+    def __init__(self):
+        self._client: Optional[AsyncMongoClient] = None
+
+    @property
+    def db(self):
+        if self._client is None:
+            self._client = AsyncMongoClient(MONGODB_URI, **MONGO_CLIENT_OPTIONS)
+        return self._client[MONGODB_DB]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    @traced("mongo")
+    async def get_user_health_data(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy dữ liệu sức khỏe của user (dùng chung cache hồ sơ với bản sync)
+        """
+        cached_user = user_profile_cache.get(user_id)
+        if cached_user:
+            return cached_user
+        try:
+            object_id = MongoService._convert_to_object_id(user_id)
+            user = await self.db.users.find_one({"_id": object_id}, USER_HEALTH_PROJECTION)
+
+            if not user:
+                print(f"User not found with ID: {user_id}")
+                return None
+
+            user = prepare_user_health_data(user, user_id)
+            user_profile_cache.set(user_id, user)
+            return user
+        except Exception as e:
+            print(f"Error getting user health data: {e}")
+            return None
+
+    @traced("mongo")
+    async def get_dishes_by_ids(self, dish_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Lấy danh sách món ăn theo danh sách ID
+        """
+        try:
+            dishes = await self.db.dishes.find({"_id": {"$in": dish_ids}}).to_list(None)
+            for dish in dishes:
+                dish["_id"] = str(dish["_id"])
+            return dishes
+        except Exception as e:
+            print(f"Error getting dishes by IDs: {e}")
+            return []
+
+    @traced("mongo")
+    async def get_cook_methods_by_ingredients(self, ingredients: List[str]) -> List[str]:
+        """
+        Lấy danh sách các phương pháp chế biến duy nhất từ các món ăn chứa nguyên liệu
+        """
+        if not ingredients:
+            return []
+        cache_key = cook_methods_key(ingredients)
+        cached = cook_methods_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+        try:
+            cursor = await self.db.dishes.aggregate(build_cook_methods_pipeline(ingredients))
+            results = await cursor.to_list(None)
+            cook_methods = [result["cook_method"] for result in results if result.get("cook_method")]
+            cook_methods_cache.set(cache_key, cook_methods)
+            return cook_methods
+        except Exception as e:
+            print(f"Error getting cook methods by ingredients: {e}")
+            return []
+
+    @traced("mongo")
+    async def filter_dishes_by_ingredients(self, dish_ids: List[str], ingredients: List[str]) -> List[str]:
+        """
+        Lọc dish_ids, chỉ giữ lại món chứa ít nhất một nguyên liệu (theo ingredient_keys)
+        """
+        if not ingredients:
+            return dish_ids
+        try:
+            query = build_dishes_by_ingredients_query(dish_ids, ingredients)
+            results = await self.db.dishes.find(query, DISH_ID_PROJECTION).to_list(None)
+            return [result["neo4j_id"] for result in results]
+        except Exception as e:
+            print(f"Error filtering dishes by ingredients: {e}")
+            return []
+
+    @traced("mongo")
+    async def get_all_ingredients(self) -> List[str]:
+        """
+        Lấy tất cả các nguyên liệu từ collection 'ingredients'
+        """
+        cached = ingredient_cache.get(ALL_INGREDIENTS_KEY)
+        if cached is not None:
+            return list(cached)
+        try:
+            ingredients = await self.db.ingredients.find({}, INGREDIENT_NAME_PROJECTION).to_list(None)
+            names = [ingredient["name"] for ingredient in ingredients]
+            ingredient_cache.set(ALL_INGREDIENTS_KEY, names)
+            return list(names)
+        except Exception as e:
+            print(f"Error getting all ingredients: {e}")
+            return []
+
+
+# Tạo instance global
+async_mongo_service = AsyncMongoService()
@@ -0,0 +1,76 @@
+import atexit
+import threading
+from typing import Any, Dict, Tuple
+
+from pymongo import UpdateOne
+
+from app.config import BMI_WRITE_FLUSH_INTERVAL
+from app.services.mongo_service import mongo_service
+
+
+class BmiWriteBehind:
+    """
+    Hàng đợi ghi kết quả BMI xuống MongoDB theo lô (write-behind).
+    - Gộp theo user_id: chỉ giữ kết quả mới nhất của mỗi user
+    - Flush bằng bulk_write theo chu kỳ và khi tắt ứng dụng
+    """
+
+    def __init__(self, flush_interval: float = BMI_WRITE_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, Tuple[Dict[str, Any], str]] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def enqueue(self, user_id: str, bmi_data: Dict[str, Any], input_hash: str):
+        with self._lock:
+            self._pending[user_id] = (bmi_data, input_hash)
+            if self._thread is None or not self._thread.is_alive():
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name="bmi-write-behind", daemon=True)
+                self._thread.start()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Ghi toàn bộ hàng đợi bằng một lần bulk_write, trả về số bản ghi đã gửi"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+
+        try:
+            operations = [
+                UpdateOne(
+                    {"_id": mongo_service._convert_to_object_id(user_id)},
+                    {"$set": mongo_service.build_bmi_update(bmi_data, input_hash)}
+                )
+                for user_id, (bmi_data, input_hash) in batch.items()
+            ]
+            mongo_service.users_collection.bulk_write(operations, ordered=False)
+            print(f"[DEBUG] BMI write-behind: đã ghi {len(operations)} bản ghi")
+            return len(operations)
+        except Exception as e:
+            print(f"Error flushing BMI write-behind queue: {e}")
+            # Đưa lại vào hàng đợi, không ghi đè kết quả mới hơn đã được enqueue trong lúc flush
+            with self._lock:
+                for user_id, item in batch.items():
+                    self._pending.setdefault(user_id, item)
+            return 0
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        """Dừng thread nền và flush phần còn lại (gọi khi shutdown)"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+bmi_writer = BmiWriteBehind()
+atexit.register(bmi_writer.stop)
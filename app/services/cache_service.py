@@ -0,0 +1,458 @@
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+import hashlib
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import msgpack
+import redis
+from bson import ObjectId
+
+from app.config import REDIS_URL, CACHE_L1_MAX_ENTRIES, CACHE_KEY_PREFIX
+
+# Header 1 byte đầu payload cho biết payload có được nén hay không
+# (0x00/0x01 là định dạng pickle cũ, không còn được đọc)
+_RAW = b"\x02"
+_ZLIB = b"\x03"
+# Chỉ nén khi payload đủ lớn, payload nhỏ nén không có lợi
+_COMPRESS_MIN_BYTES = 512
+
+INVALIDATION_CHANNEL = f"{CACHE_KEY_PREFIX}:invalidate"
+
+# ID của process hiện tại, dùng để bỏ qua message invalidation do chính mình gửi
+_PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def stable_key(*parts: Any) -> str:
+    """
+    Tạo hash ổn định giữa các process cho cache key.
+    (hash() của Python bị random theo từng process nên không dùng được cho Redis)
+    """
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+
+
+# Kiểu ngoài JSON được phép lưu trong cache: mã ext msgpack -> (class, to_data, from_data).
+# Không dùng pickle: payload đọc lại từ Redis dùng chung, pickle cho phép chạy code tùy ý khi giải mã.
+_EXT_TYPES: Dict[int, Tuple[type, Callable[[Any], Any], Callable[[Any], Any]]] = {}
+_EXT_CODES: Dict[type, int] = {}
+
+
+def register_type(code: int, cls: type, to_data: Callable[[Any], Any], from_data: Callable[[Any], Any]):
+    """
+    Cho phép lưu object của cls trong cache (vd: DishRecord).
+    to_data trả về dữ liệu msgpack được (dict, list, str...), from_data dựng lại object từ dữ liệu đó.
+    """
+    _EXT_TYPES[code] = (cls, to_data, from_data)
+    _EXT_CODES[cls] = code
+
+
+register_type(1, datetime, datetime.isoformat, datetime.fromisoformat)
+register_type(2, date, date.isoformat, date.fromisoformat)
+register_type(3, ObjectId, str, ObjectId)
+
+
+def _pack_default(value: Any) -> Any:
+    if isinstance(value, (tuple, set, frozenset)):
+        return list(value)
+    code = _EXT_CODES.get(type(value))
+    if code is None:
+        raise TypeError(f"Kiểu {type(value).__name__} không được phép lưu trong cache")
+    return msgpack.ExtType(code, _pack(_EXT_TYPES[code][1](value)))
+
+
+def _unpack_ext(code: int, data: bytes) -> Any:
+    if code not in _EXT_TYPES:
+        raise ValueError(f"Mã ext {code} không được đăng ký")
+    return _EXT_TYPES[code][2](_unpack(data))
+
+
+def _pack(value: Any) -> bytes:
+    return msgpack.packb(value, default=_pack_default, use_bin_type=True)
+
+
+def _unpack(payload: bytes) -> Any:
+    return msgpack.unpackb(payload, ext_hook=_unpack_ext, raw=False, strict_map_key=False)
+
+
+def serialize(value: Any) -> bytes:
+    """Serialize giá trị bằng msgpack (kèm các kiểu đã register_type), nén zlib nếu payload lớn"""
+    payload = _pack(value)
+    if len(payload) >= _COMPRESS_MIN_BYTES:
+        return _ZLIB + zlib.compress(payload, 6)
+    return _RAW + payload
+
+
+def deserialize(data: bytes) -> Any:
+    """Giải mã payload tạo bởi serialize(), raise ValueError nếu payload không đúng định dạng"""
+    header, payload = data[:1], data[1:]
+    if header == _ZLIB:
+        payload = zlib.decompress(payload)
+    elif header != _RAW:
+        raise ValueError("Payload cache không đúng định dạng")
+    return _unpack(payload)
+
+
+class _RedisConnection:
+    """
+    Quản lý kết nối Redis dùng chung cho tất cả các cache.
+    Khi Redis lỗi, tạm ngắt L2 trong một khoảng thời gian rồi thử lại.
+    """
+
+    RETRY_AFTER_SECONDS = 30
+
+    def __init__(self, url: Optional[str]):
+        self.url = url
+        self._client = None
+        self._disabled_until = 0.0
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if not self.url or time.time() < self._disabled_until:
+            return None
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = redis.Redis.from_url(
+                        self.url, socket_timeout=0.5, socket_connect_timeout=0.5
+                    )
+        return self._client
+
+    def mark_failed(self, error: Exception):
+        print(f"WARNING: Redis cache không khả dụng, tạm dùng cache L1: {error}")
+        self._disabled_until = time.time() + self.RETRY_AFTER_SECONDS
+
+
+_redis_connection = _RedisConnection(REDIS_URL)
+
+
+class TieredCache:
+    """
+    Cache 2 tầng:
+    - L1: LRU trong process (nhỏ, nhanh)
+    - L2: Redis dùng chung giữa các uvicorn worker
+
+    Key trên Redis có version theo namespace, clear() chỉ cần tăng version
+    để vô hiệu hóa toàn bộ key cũ. Các thay đổi được publish qua pub/sub
+    để các worker khác xóa L1 tương ứng.
+    """
+
+    def __init__(self, namespace: str, default_ttl: int = 3600, max_entries: int = None):
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries or CACHE_L1_MAX_ENTRIES
+        self._l1: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._version: Optional[int] = None
+        self.hits_l1 = 0
+        self.hits_l2 = 0
+        self.misses = 0
+        _invalidation_bus.register(self)
+
+    # ===== L1 =====
+
+    def _l1_get(self, key: str):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.time() >= expires_at:
+                del self._l1[key]
+                return None
+            self._l1.move_to_end(key)
+            return entry
+
+    def _l1_set(self, key: str, value: Any, ttl: float):
+        with self._lock:
+            self._l1[key] = (time.time() + ttl, value)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.max_entries:
+                self._l1.popitem(last=False)
+
+    def _l1_delete(self, key: Optional[str] = None):
+        with self._lock:
+            if key is None:
+                self._l1.clear()
+            else:
+                self._l1.pop(key, None)
+
+    # ===== L2 =====
+
+    def _version_key(self) -> str:
+        return f"{CACHE_KEY_PREFIX}:{self.namespace}:version"
+
+    def _get_version(self, client) -> int:
+        if self._version is None:
+            raw = client.get(self._version_key())
+            self._version = int(raw) if raw else 0
+        return self._version
+
+    def _l2_key(self, client, key: str) -> str:
+        return f"{CACHE_KEY_PREFIX}:{self.namespace}:v{self._get_version(client)}:{key}"
+
+    # ===== API =====
+
+    @staticmethod
+    def _decode(key: str, data: Optional[bytes]) -> Any:
+        """Giải mã payload L2, payload hỏng hoặc định dạng cũ coi như miss"""
+        if data is None:
+            return None
+        try:
+            return deserialize(data)
+        except Exception as e:
+            print(f"WARNING: Bỏ qua payload cache không hợp lệ '{key}': {e}")
+            return None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Lấy giá trị theo thứ tự L1 -> L2"""
+        entry = self._l1_get(key)
+        if entry is not None:
+            self.hits_l1 += 1
+            return entry[1]
+
+        client = _redis_connection.get_client()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                l2_key = self._l2_key(client, key)
+                pipe.get(l2_key)
+                pipe.pttl(l2_key)
+                data, pttl = pipe.execute()
+                value = self._decode(key, data)
+                if value is not None:
+                    ttl = pttl / 1000 if pttl and pttl > 0 else self.default_ttl
+                    self._l1_set(key, value, ttl)
+                    self.hits_l2 += 1
+                    return value
+            except Exception as e:
+                _redis_connection.mark_failed(e)
+
+        self.misses += 1
+        return default
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Lấy nhiều key: L1 trước, các key còn thiếu đọc L2 trong một round trip (pipeline GET + PTTL).
+        Trả về dict key -> value, key không có trong cache thì không có trong kết quả
+        """
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        for key in dict.fromkeys(keys):
+            entry = self._l1_get(key)
+            if entry is not None:
+                self.hits_l1 += 1
+                found[key] = entry[1]
+            else:
+                missing.append(key)
+
+        client = _redis_connection.get_client() if missing else None
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for key in missing:
+                    l2_key = self._l2_key(client, key)
+                    pipe.get(l2_key)
+                    pipe.pttl(l2_key)
+                replies = pipe.execute()
+                for key, data, pttl in zip(missing, replies[::2], replies[1::2]):
+                    value = self._decode(key, data)
+                    if value is not None:
+                        ttl = pttl / 1000 if pttl and pttl > 0 else self.default_ttl
+                        self._l1_set(key, value, ttl)
+                        self.hits_l2 += 1
+                        found[key] = value
+            except Exception as e:
+                _redis_connection.mark_failed(e)
+
+        self.misses += sum(1 for key in missing if key not in found)
+        return found
+
+    def set(self, key: str, value: Any, ttl: int = None):
+        """Ghi vào cả L1 và L2"""
+        ttl = ttl or self.default_ttl
+        self._l1_set(key, value, ttl)
+        client = _redis_connection.get_client()
+        if client is None:
+            return
+        try:
+            payload = serialize(value)
+        except Exception as e:
+            # Giá trị không serialize được (vd: object driver) thì chỉ giữ ở L1
+            print(f"WARNING: Không thể serialize cache key '{key}', chỉ lưu L1: {e}")
+            return
+        try:
+            client.setex(self._l2_key(client, key), int(ttl), payload)
+        except Exception as e:
+            _redis_connection.mark_failed(e)
+
+    def set_many(self, items: Dict[str, Any], ttl: int = None):
+        """Ghi nhiều key vào L1 và L2, các SETEX gửi trong một round trip (pipeline)"""
+        if not items:
+            return
+        ttl = ttl or self.default_ttl
+        for key, value in items.items():
+            self._l1_set(key, value, ttl)
+        client = _redis_connection.get_client()
+        if client is None:
+            return
+        # Nhiều key có thể trỏ cùng một object (vd: DishRecord theo _id và neo4j_id): serialize một lần
+        payloads: Dict[int, Optional[bytes]] = {}
+        try:
+            pipe = client.pipeline(transaction=False)
+            for key, value in items.items():
+                if id(value) not in payloads:
+                    try:
+                        payloads[id(value)] = serialize(value)
+                    except Exception as e:
+                        print(f"WARNING: Không thể serialize cache key '{key}', chỉ lưu L1: {e}")
+                        payloads[id(value)] = None
+                payload = payloads[id(value)]
+                if payload is not None:
+                    pipe.setex(self._l2_key(client, key), int(ttl), payload)
+            pipe.execute()
+        except Exception as e:
+            _redis_connection.mark_failed(e)
+
+    def delete(self, key: str):
+        """Xóa một key ở cả 2 tầng và báo cho các worker khác"""
+        self._l1_delete(key)
+        client = _redis_connection.get_client()
+        if client is not None:
+            try:
+                client.delete(self._l2_key(client, key))
+            except Exception as e:
+                _redis_connection.mark_failed(e)
+        _invalidation_bus.publish(self.namespace, key)
+
+    def clear(self):
+        """Vô hiệu hóa toàn bộ namespace bằng cách tăng version"""
+        self._l1_delete()
+        client = _redis_connection.get_client()
+        if client is not None:
+            try:
+                self._version = int(client.incr(self._version_key()))
+            except Exception as e:
+                _redis_connection.mark_failed(e)
+        _invalidation_bus.publish(self.namespace, None)
+
+    def purge_expired(self):
+        """Xóa các entry L1 đã hết hạn"""
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (expires_at, _) in self._l1.items() if expires_at <= now]
+            for k in expired:
+                del self._l1[k]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "namespace": self.namespace,
+                "l1_entries": len(self._l1),
+                "l1_max_entries": self.max_entries,
+                "hits_l1": self.hits_l1,
+                "hits_l2": self.hits_l2,
+                "misses": self.misses,
+                "l2_enabled": _redis_connection.get_client() is not None,
+            }
+
+    def _on_remote_invalidation(self, key: Optional[str]):
+        """Được gọi khi worker khác xóa key hoặc clear namespace"""
+        self._l1_delete(key)
+        if key is None:
+            # Version trên Redis đã thay đổi, đọc lại ở lần truy cập tới
+            self._version = None
+
+
+class _InvalidationBus:
+    """
+    Lắng nghe kênh pub/sub trên Redis để xóa L1 khi worker khác thay đổi dữ liệu.
+    Thread lắng nghe chỉ được khởi tạo khi có cache đầu tiên đăng ký và có Redis.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, TieredCache] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def register(self, cache: TieredCache):
+        self._caches[cache.namespace] = cache
+        self._ensure_listener()
+
+    def publish(self, namespace: str, key: Optional[str]):
+        client = _redis_connection.get_client()
+        if client is None:
+            return
+        message = json.dumps({"origin": _PROCESS_ID, "ns": namespace, "key": key})
+        try:
+            client.publish(INVALIDATION_CHANNEL, message)
+        except Exception as e:
+            _redis_connection.mark_failed(e)
+
+    def _ensure_listener(self):
+        if self._thread is not None or not REDIS_URL:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._listen, name="cache-invalidation", daemon=True
+                )
+                self._thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                client = redis.Redis.from_url(REDIS_URL)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    self._handle(message.get("data"))
+            except Exception as e:
+                print(f"WARNING: Mất kết nối kênh invalidation cache: {e}")
+                time.sleep(_RedisConnection.RETRY_AFTER_SECONDS)
+
+    def _handle(self, data):
+        try:
+            payload = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        if payload.get("origin") == _PROCESS_ID:
+            return
+        cache = self._caches.get(payload.get("ns"))
+        if cache is not None:
+            cache._on_remote_invalidation(payload.get("key"))
+
+
+_invalidation_bus = _InvalidationBus()
+
+
+def try_acquire_lease(name: str, ttl: int) -> bool:
+    """
+    Giành (hoặc gia hạn) quyền chạy một tác vụ nền duy nhất giữa các worker qua Redis.
+    Không có Redis thì mỗi process tự chạy (trả về True).
+    """
+    client = _redis_connection.get_client()
+    if client is None:
+        return True
+    lease_key = f"{CACHE_KEY_PREFIX}:lease:{name}"
+    try:
+        if client.set(lease_key, _PROCESS_ID, nx=True, ex=ttl):
+            return True
+        owner = client.get(lease_key)
+        if owner is not None and owner.decode() == _PROCESS_ID:
+            client.expire(lease_key, ttl)
+            return True
+        return False
+    except Exception as e:
+        _redis_connection.mark_failed(e)
+        return True
+
+# Các cache dùng chung trong ứng dụng
+graph_cache = TieredCache("graph_schema", default_ttl=3600)
+allergy_cache = TieredCache("allergy_analysis", default_ttl=24 * 3600)
+classification_cache = TieredCache("topic_classification", default_ttl=24 * 3600)
@@ -0,0 +1,171 @@
+"""
+Theo dõi thay đổi trên MongoDB (dishes, ingredients, users) để xóa đúng các key cache bị ảnh hưởng.
+
+- Ưu tiên change stream (cần replica set / Atlas)
+- mongod standalone: fallback polling theo lastUpdateDate (không thấy được thao tác xóa,
+  nhưng delete_dish đã tự xóa cache và publish sang worker khác)
+- Khi có Redis, chỉ một worker giữ lease để chạy watcher; việc xóa key đi qua
+  TieredCache.delete nên được publish sang các worker còn lại
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.config import CACHE_WATCH_POLL_INTERVAL
+from app.services.cache_service import try_acquire_lease
+from app.services.dish_store import dish_store
+from app.services.mongo_service import (
+    mongo_service, ingredient_cache, cook_methods_cache, ALL_INGREDIENTS_KEY, BMI_RESULT_FIELDS
+)
+from app.services.user_profile_cache import user_profile_cache
+
+WATCHED_COLLECTIONS = ("dishes", "ingredients", "users")
+# Mã lỗi khi change stream không được hỗ trợ (standalone mongod)
+_CHANGE_STREAM_UNSUPPORTED = {40573, 40324}
+_LEASE_NAME = "mongo_cache_watcher"
+# Lùi mốc polling một chút để không bỏ sót bản ghi ghi cùng lúc với lần poll trước
+_POLL_OVERLAP = timedelta(seconds=2)
+
+
+class MongoCacheWatcher:
+    def __init__(self, poll_interval: float = CACHE_WATCH_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._resume_token = None
+        self._poll_since: Dict[str, datetime] = {}
+        self._poll_seen: Dict[str, Dict[Any, Any]] = {}
+        self.mode = "stopped"
+        self.evictions = 0
+
+    # ----- xử lý thay đổi -----
+
+    def invalidate(self, collection: str, doc_id: Any, neo4j_id: Optional[str] = None, updated_fields=None):
+        """Xóa key cache tương ứng với một document đã thay đổi"""
+        if collection == "dishes":
+            dish_store.invalidate(str(doc_id), neo4j_id)
+            cook_methods_cache.clear()
+        elif collection == "ingredients":
+            ingredient_cache.delete(ALL_INGREDIENTS_KEY)
+        elif collection == "users":
+            # Chỉ ghi kết quả BMI (write-behind) thì hồ sơ đã cache vẫn đúng
+            if updated_fields is not None and set(updated_fields) <= BMI_RESULT_FIELDS:
+                return
+            user_profile_cache.invalidate(str(doc_id))
+        else:
+            return
+        self.evictions += 1
+
+    def handle_change(self, change: Dict[str, Any]):
+        collection = change.get("ns", {}).get("coll")
+        doc_id = change.get("documentKey", {}).get("_id")
+        if collection not in WATCHED_COLLECTIONS or doc_id is None:
+            return
+        updated_fields = None
+        neo4j_id = None
+        if change.get("operationType") == "update":
+            updated = change.get("updateDescription", {})
+            updated_fields = list(updated.get("updatedFields", {})) + list(updated.get("removedFields", []))
+            neo4j_id = updated.get("updatedFields", {}).get("neo4j_id")
+        elif change.get("fullDocument"):
+            neo4j_id = change["fullDocument"].get("neo4j_id")
+        self.invalidate(collection, doc_id, neo4j_id, updated_fields)
+
+    # ----- change stream -----
+
+    def _watch_change_stream(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        with mongo_service.db.watch(pipeline, resume_after=self._resume_token, max_await_time_ms=1000) as stream:
+            self.mode = "change_stream"
+            print("[DEBUG] Cache watcher: đang theo dõi change stream")
+            while not self._stop_event.is_set() and try_acquire_lease(_LEASE_NAME, int(self.poll_interval * 3) + 5):
+                change = stream.try_next()
+                if change is not None:
+                    self.handle_change(change)
+                self._resume_token = stream.resume_token
+
+    # ----- polling fallback -----
+
+    def poll_once(self):
+        """Một vòng polling theo lastUpdateDate cho tất cả collection được theo dõi"""
+        now = datetime.now()
+        for collection in WATCHED_COLLECTIONS:
+            since = self._poll_since.get(collection, now)
+            seen = self._poll_seen.setdefault(collection, {})
+            cursor = mongo_service.db[collection].find(
+                {"lastUpdateDate": {"$gt": since - _POLL_OVERLAP}},
+                {"_id": 1, "neo4j_id": 1, "lastUpdateDate": 1}
+            )
+            latest = since
+            current: Dict[Any, Any] = {}
+            for doc in cursor:
+                last_update = doc.get("lastUpdateDate")
+                current[doc["_id"]] = last_update
+                if isinstance(last_update, datetime) and last_update > latest:
+                    latest = last_update
+                # Bỏ qua bản ghi đã xử lý ở vòng trước (do khoảng overlap)
+                if seen.get(doc["_id"]) == last_update:
+                    continue
+                if collection == "users" and user_profile_cache.get_last_update_date(str(doc["_id"])) == last_update:
+                    continue
+                self.invalidate(collection, doc["_id"], doc.get("neo4j_id"))
+            self._poll_since[collection] = latest
+            self._poll_seen[collection] = current
+
+    def _poll(self):
+        self.mode = "polling"
+        print("[DEBUG] Cache watcher: change stream không khả dụng, chuyển sang polling lastUpdateDate")
+        while not self._stop_event.is_set() and try_acquire_lease(_LEASE_NAME, int(self.poll_interval * 3) + 5):
+            try:
+                self.poll_once()
+            except PyMongoError as e:
+                print(f"Error polling MongoDB for cache invalidation: {e}")
+            self._stop_event.wait(self.poll_interval)
+
+    # ----- vòng đời -----
+
+    def _run(self):
+        use_change_stream = True
+        while not self._stop_event.is_set():
+            if not try_acquire_lease(_LEASE_NAME, int(self.poll_interval * 3) + 5):
+                # Worker khác đang chạy watcher, chờ đến lượt
+                self.mode = "standby"
+                self._stop_event.wait(self.poll_interval)
+                continue
+            try:
+                if use_change_stream:
+                    self._watch_change_stream()
+                else:
+                    self._poll()
+            except OperationFailure as e:
+                if e.code in _CHANGE_STREAM_UNSUPPORTED:
+                    use_change_stream = False
+                    continue
+                print(f"Error in cache watcher: {e}")
+                self._resume_token = None
+                self._stop_event.wait(self.poll_interval)
+            except Exception as e:
+                print(f"Error in cache watcher: {e}")
+                self._stop_event.wait(self.poll_interval)
+        self.mode = "stopped"
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="mongo-cache-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "evictions": self.evictions}
+
+
+cache_watcher = MongoCacheWatcher()
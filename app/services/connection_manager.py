@@ -0,0 +1,102 @@
+import threading
+from typing import Any, Dict
+
+from neo4j import GraphDatabase
+from pymongo import MongoClient
+
+from app.config import (
+    NEO4J_URI,
+    NEO4J_USER,
+    NEO4J_PASSWORD,
+    NEO4J_MAX_POOL_SIZE,
+    NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+    NEO4J_CONNECTION_TIMEOUT,
+    NEO4J_MAX_CONNECTION_LIFETIME,
+    MONGODB_URI,
+    MONGODB_DB,
+    MONGO_CLIENT_OPTIONS,
+)
+
+
+class ConnectionManager:
+    """
+    Quản lý kết nối Neo4j và MongoDB:
+    - Tạo lười ở lần dùng đầu tiên (import không mở kết nối)
+    - Pool cấu hình qua biến môi trường (xem app.config)
+    - startup()/shutdown() gắn vào lifespan của FastAPI, readiness() cho /ready
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._neo4j_driver = None
+        self._mongo_client = None
+
+    def get_neo4j_driver(self):
+        if self._neo4j_driver is None:
+            with self._lock:
+                if self._neo4j_driver is None:
+                    self._neo4j_driver = GraphDatabase.driver(
+                        NEO4J_URI,
+                        auth=(NEO4J_USER, NEO4J_PASSWORD),
+                        max_connection_pool_size=NEO4J_MAX_POOL_SIZE,
+                        connection_acquisition_timeout=NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+                        connection_timeout=NEO4J_CONNECTION_TIMEOUT,
+                        max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+                    )
+        return self._neo4j_driver
+
+    def get_mongo_client(self) -> MongoClient:
+        if self._mongo_client is None:
+            with self._lock:
+                if self._mongo_client is None:
+                    # MongoClient không chặn khi khởi tạo, kết nối được mở ở truy vấn đầu tiên
+                    self._mongo_client = MongoClient(MONGODB_URI, **MONGO_CLIENT_OPTIONS)
+        return self._mongo_client
+
+    def get_mongo_db(self):
+        return self.get_mongo_client()[MONGODB_DB]
+
+    def readiness(self) -> Dict[str, Any]:
+        """Kiểm tra kết nối tới Neo4j và MongoDB, trả về trạng thái từng backend"""
+        checks: Dict[str, Any] = {}
+        try:
+            self.get_neo4j_driver().verify_connectivity()
+            checks["neo4j"] = "ok"
+        except Exception as e:
+            checks["neo4j"] = f"error: {e}"
+        try:
+            self.get_mongo_client().admin.command("ping")
+            checks["mongodb"] = "ok"
+        except Exception as e:
+            checks["mongodb"] = f"error: {e}"
+        return {"ready": all(value == "ok" for value in checks.values()), "checks": checks}
+
+    def startup(self):
+        """Khởi tạo pool khi app khởi động, lỗi kết nối chỉ được log (xem /ready)"""
+        status = self.readiness()
+        for name, result in status["checks"].items():
+            if result == "ok":
+                print(f"✅ {name} kết nối thành công!")
+            else:
+                print(f"❌ {name} chưa sẵn sàng: {result}")
+        return status
+
+    def shutdown(self):
+        with self._lock:
+            if self._neo4j_driver is not None:
+                self._neo4j_driver.close()
+                self._neo4j_driver = None
+            if self._mongo_client is not None:
+                self._mongo_client.close()
+                self._mongo_client = None
+
+
+connection_manager = ConnectionManager()
+
+
+def get_neo4j_driver():
+    return connection_manager.get_neo4j_driver()
+
+
+def get_mongo_db():
+    return connection_manager.get_mongo_db()
@@ -0,0 +1,153 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import ObjectId
+
+from app.config import DISH_CACHE_TTL
+from app.services.cache_service import TieredCache, register_type
+from app.services.connection_manager import get_mongo_db
+
+# Trường nhẹ luôn được đọc, trường nặng (instructions) chỉ đọc khi use case cần hoặc khi truy cập lười
+LIGHT_FIELDS = ("neo4j_id", "name", "ingredients", "cook_method", "source")
+HEAVY_FIELDS = ("instructions",)
+
+# Projection theo từng use case
+DISH_PROJECTIONS: Dict[str, Dict[str, int]] = {
+    # rerank_foods chỉ cần ingredients để lọc dị ứng
+    "rerank": {field: 1 for field in LIGHT_FIELDS},
+    # filter_allergies cần thêm instructions để trả về cho client
+    "allergy": {field: 1 for field in LIGHT_FIELDS + HEAVY_FIELDS},
+}
+
+
+class DishRecord:
+    """
+    Bản ghi món ăn gọn (__slots__) thay cho document đầy đủ.
+    instructions được tải lười ở lần truy cập đầu nếu projection ban đầu không lấy.
+    Bản ghi được cache dùng chung giữa các request, không sửa các list bên trong.
+    """
+
+    __slots__ = ("id", "neo4j_id", "name", "ingredients", "cook_method", "source", "_instructions", "_heavy_loaded")
+
+    def __init__(self, doc: Dict[str, Any], heavy_loaded: bool = False):
+        self.id = str(doc["_id"])
+        self.neo4j_id = doc.get("neo4j_id")
+        self.name = doc.get("name")
+        self.ingredients = doc.get("ingredients", [])
+        self.cook_method = doc.get("cook_method")
+        self.source = doc.get("source")
+        # heavy_loaded: projection lúc đọc đã gồm trường nặng (kể cả khi document không có trường đó)
+        self._heavy_loaded = heavy_loaded
+        self._instructions = doc.get("instructions", []) if heavy_loaded else None
+
+    @property
+    def heavy_loaded(self) -> bool:
+        return self._heavy_loaded
+
+    @property
+    def instructions(self) -> List[Any]:
+        if not self._heavy_loaded:
+            doc = get_mongo_db().dishes.find_one({"_id": self._mongo_id()}, {field: 1 for field in HEAVY_FIELDS}) or {}
+            self._set_heavy(doc)
+        return self._instructions
+
+    def _set_heavy(self, doc: Dict[str, Any]):
+        self._instructions = doc.get("instructions", [])
+        self._heavy_loaded = True
+
+    def _mongo_id(self):
+        # _id trong collection dishes có thể là ObjectId hoặc string
+        return ObjectId(self.id) if ObjectId.is_valid(self.id) else self.id
+
+    def get(self, field: str, default: Any = None) -> Any:
+        """Truy cập kiểu dict để tương thích với code cũ"""
+        if field == "_id":
+            return self.id
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "DishRecord":
+        record = cls.__new__(cls)
+        record.__setstate__(state)
+        return record
+
+    def __repr__(self) -> str:
+        return f"DishRecord(id={self.id!r}, name={self.name!r})"
+
+
+# DishRecord được lưu trong cache L2 (Redis) dưới dạng dict các slot
+register_type(10, DishRecord, DishRecord.__getstate__, DishRecord.from_state)
+
+
+class DishStore:
+    """Đọc món ăn theo lô với projection tối thiểu, cache DishRecord theo id (_id và neo4j_id)"""
+
+    def __init__(self, ttl: int = DISH_CACHE_TTL):
+        self._cache = TieredCache("dish_record", default_ttl=ttl, max_entries=8192)
+
+    @staticmethod
+    def _key(by: str, value: Any) -> str:
+        return f"{by}:{value}"
+
+    def _remember(self, records: Iterable[DishRecord]):
+        """Ghi cache cả lô theo _id và neo4j_id (L2 trong một round trip)"""
+        entries: Dict[str, DishRecord] = {}
+        for record in records:
+            entries[self._key("_id", record.id)] = record
+            if record.neo4j_id:
+                entries[self._key("neo4j_id", record.neo4j_id)] = record
+        self._cache.set_many(entries)
+
+    def get_many(self, ids: Iterable[Any], by: str = "_id", use_case: str = "rerank") -> Dict[Any, DishRecord]:
+        """
+        Lấy DishRecord cho danh sách id (by = "_id" hoặc "neo4j_id").
+        Trả về dict id -> DishRecord, id không có trong MongoDB thì không có trong kết quả.
+        """
+        projection = DISH_PROJECTIONS[use_case]
+        needs_heavy = any(field in projection for field in HEAVY_FIELDS)
+
+        records: Dict[Any, DishRecord] = {}
+        missing: List[Any] = []
+        values = list(dict.fromkeys(v for v in ids if v))
+        # Một lần đọc cache cho cả lô (L2 trong một round trip)
+        cached = self._cache.get_many(self._key(by, value) for value in values)
+        for value in values:
+            record = cached.get(self._key(by, value))
+            if record is None or (needs_heavy and not record.heavy_loaded):
+                missing.append(value)
+            else:
+                records[value] = record
+
+        if missing:
+            try:
+                cursor = get_mongo_db().dishes.find({by: {"$in": missing}}, projection)
+                loaded = []
+                for doc in cursor:
+                    record = DishRecord(doc, heavy_loaded=needs_heavy)
+                    loaded.append(record)
+                    records[record.id if by == "_id" else doc.get(by)] = record
+                self._remember(loaded)
+            except Exception as e:
+                print(f"Error loading dish records: {e}")
+        return records
+
+    def get(self, value: Any, by: str = "_id", use_case: str = "rerank") -> Optional[DishRecord]:
+        return self.get_many([value], by=by, use_case=use_case).get(value)
+
+    def invalidate(self, dish_id: str, neo4j_id: Optional[str] = None):
+        """Xóa cache của một món (gọi khi món được cập nhật/xóa)"""
+        record = self._cache.get(self._key("_id", dish_id))
+        self._cache.delete(self._key("_id", dish_id))
+        neo4j_ids = {neo4j_id, record.neo4j_id if record is not None else None} - {None, ""}
+        for value in neo4j_ids:
+            self._cache.delete(self._key("neo4j_id", value))
+
+
+dish_store = DishStore()
@@ -1,39 +1,42 @@
-from app.config import driver
+from app.services.connection_manager import get_neo4j_driver
 from typing import List, Dict, Any
 from app.services.mongo_service import mongo_service
+from app.services.cache_service import graph_cache, stable_key
+from app.services.metrics import span
+from app.utils.bitset import ExclusionSet
 from neo4j.graph import Node
-import time
+
+
+def _run(session, name: str, query: str, **params) -> List[Any]:
+    """
+    Chạy Cypher trong span neo4j tên `name` (cache hit không tạo span).
+    Record được đọc hết trong span để tính cả thời gian nhận kết quả; lỗi làm span bị đánh dấu lỗi
+    rồi mới ném tiếp cho except của hàm gọi.
+    """
+    with span("neo4j", name, **{"db.statement": " ".join(query.split())}):
+        return list(session.run(query, **params))
+
 
 class GraphSchemaService:
     """Service để khám phá và làm việc với schema graph hiện tại"""
     
-    # Simple in-memory cache
-    _cache = {}
+    # Cache 2 tầng (L1 trong process + Redis) dùng chung giữa các worker
+    _cache = graph_cache
     
     @classmethod
     def _get_cache(cls, key: str):
         """Get value from cache if not expired"""
-        if key in cls._cache:
-            value, timestamp = cls._cache[key]
-            if time.time() - timestamp < 3600:  # 1 hour timeout
-                return value
-            else:
-                del cls._cache[key]
-        return None
+        return cls._cache.get(key)
     
     @classmethod
     def _set_cache(cls, key: str, value: Any, timeout: int = 3600):
         """Set value in cache with timeout"""
-        cls._cache[key] = (value, time.time())
+        cls._cache.set(key, value, ttl=timeout)
     
     @classmethod
     def _clear_cache(cls):
         """Clear expired cache entries"""
-        current_time = time.time()
-        expired_keys = [key for key, (_, timestamp) in cls._cache.items() 
-                       if current_time - timestamp > 3600]
-        for key in expired_keys:
-            del cls._cache[key]
+        cls._cache.purge_expired()
     
     @classmethod
     def clear_cache(cls):
@@ -44,9 +47,10 @@ class GraphSchemaService:
     def get_cache_stats(cls):
         """Get cache statistics"""
         cls._clear_cache()  # Clear expired entries first
+        stats = cls._cache.stats()
         return {
-            "total_entries": len(cls._cache),
-            "cache_size": sum(len(str(v)) for v in cls._cache.values())
+            "total_entries": stats["l1_entries"],
+            **stats
         }
     
     @staticmethod
@@ -64,8 +68,8 @@ class GraphSchemaService:
         ORDER BY label
         """
         try:
-            with driver.session() as session:
-                result = session.run(query)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "db.labels", query)
                 labels = [record["label"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, labels, timeout=3600)
@@ -89,8 +93,8 @@ class GraphSchemaService:
         ORDER BY relationshipType
         """
         try:
-            with driver.session() as session:
-                result = session.run(query)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "db.relationshipTypes", query)
                 rel_types = [record["relationshipType"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, rel_types, timeout=3600)
@@ -115,8 +119,8 @@ class GraphSchemaService:
             LIMIT 1
             """
             try:
-                with driver.session() as session:
-                    result = session.run(query)
+                with get_neo4j_driver().session() as session:
+                    result = _run(session, "node_properties", query)
                     properties = [record["properties"] for record in result]
                     # Cache kết quả trong 1 giờ
                     GraphSchemaService._set_cache(cache_key, properties, timeout=3600)
@@ -130,8 +134,8 @@ class GraphSchemaService:
             RETURN DISTINCT labels(n) as labels, keys(n) as properties
             """
             try:
-                with driver.session() as session:
-                    result = session.run(query)
+                with get_neo4j_driver().session() as session:
+                    result = _run(session, "all_node_properties", query)
                     properties = [{"labels": record["labels"], "properties": record["properties"]} for record in result]
                     # Cache kết quả trong 1 giờ
                     GraphSchemaService._set_cache(cache_key, properties, timeout=3600)
@@ -192,9 +196,8 @@ class GraphSchemaService:
         RETURN count(n) as count
         """
         try:
-            with driver.session() as session:
-                result = session.run(query)
-                count = result.single()["count"]
+            with get_neo4j_driver().session() as session:
+                count = _run(session, "node_count", query)[0]["count"]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, count, timeout=3600)
                 return count
@@ -216,9 +219,8 @@ class GraphSchemaService:
         RETURN count(r) as count
         """
         try:
-            with driver.session() as session:
-                result = session.run(query)
-                count = result.single()["count"]
+            with get_neo4j_driver().session() as session:
+                count = _run(session, "relationship_count", query)[0]["count"]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, count, timeout=3600)
                 return count
@@ -241,8 +243,8 @@ class GraphSchemaService:
         ORDER BY count DESC
         """
         try:
-            with driver.session() as session:
-                result = session.run(query)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "relationship_connections", query)
                 connections = [record.data() for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, connections, timeout=3600)
@@ -271,8 +273,8 @@ class GraphSchemaService:
             LIMIT 5
             """
             try:
-                with driver.session() as session:
-                    result = session.run(query)
+                with get_neo4j_driver().session() as session:
+                    result = _run(session, "sample_nodes", query)
                     sample_data[label] = [record["n"] for record in result]
             except Exception as e:
                 print(f"Error querying sample data for {label}: {e}")
@@ -323,20 +325,17 @@ class GraphSchemaService:
     def get_foods_by_disease_advanced(disease_name: str, excluded_ids: List[str] = None):
         """Truy vấn nâng cao để tìm thực phẩm theo bệnh"""
         # Sử dụng cache để tối ưu hiệu suất
-        cache_key = f"foods_for_{disease_name}_{hash(str(excluded_ids)) if excluded_ids else 'none'}"
+        # Cache theo tiêu chí, món đã gợi ý được loại trong process (key không phụ thuộc session)
+        cache_key = f"foods_for_{disease_name}"
         cached_data = GraphSchemaService._get_cache(cache_key)
         if cached_data:
-            return cached_data
+            return ExclusionSet.coerce(excluded_ids).filter(cached_data)
         
         params = {"disease": disease_name}
         query = """
         MATCH (d:Disease {name: $disease})-[:YÊU_CẦU_CHẾ_ĐỘ]->(diet:Diet)
         -[:KHUYẾN_NGHỊ]->(cm:CookMethod)-[:ĐƯỢC_DÙNG_TRONG]->(dish:Dish)
         """
-        if excluded_ids:
-            query += " WHERE NOT dish.id IN $excluded_ids "
-            params["excluded_ids"] = excluded_ids
-            
         query += """
         RETURN DISTINCT 
             dish.name AS dish_name, 
@@ -346,12 +345,12 @@ class GraphSchemaService:
         ORDER BY dish.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, **params)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "foods_by_disease", query, **params)
                 foods = [record.data() for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, foods, timeout=3600)
-                return foods
+                return ExclusionSet.coerce(excluded_ids).filter(foods)
         except Exception as e:
             print(f"Error querying foods for {disease_name}: {e}")
             return []
@@ -372,8 +371,8 @@ class GraphSchemaService:
         ORDER BY d.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, food_name=food_name)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "diseases_by_food", query, food_name=food_name)
                 diseases = [record["disease_name"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, diseases, timeout=3600)
@@ -398,8 +397,8 @@ class GraphSchemaService:
         ORDER BY cm.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, disease=disease_name)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "cook_methods_by_disease", query, disease=disease_name)
                 cook_methods = [record["cook_method"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, cook_methods, timeout=3600)
@@ -419,8 +418,8 @@ class GraphSchemaService:
         
         query = "MATCH (cm:CookMethod) RETURN DISTINCT cm.name AS cook_method ORDER BY cook_method"
         try:
-            with driver.session() as session:
-                result = session.run(query)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "all_cook_methods", query)
                 cook_methods = [record["cook_method"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, cook_methods, timeout=3600)
@@ -445,8 +444,8 @@ class GraphSchemaService:
         RETURN DISTINCT cm.name AS cook_method
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, bmi_category=bmi_category)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "cook_methods_by_bmi", query, bmi_category=bmi_category)
                 cook_methods = [record["cook_method"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, cook_methods, timeout=3600)
@@ -470,8 +469,8 @@ class GraphSchemaService:
         ORDER BY diet.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, disease_name=disease_name)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "diets_by_disease", query, disease_name=disease_name)
                 diet_names = [record["diet_name"] for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, diet_names, timeout=3600)
@@ -495,8 +494,9 @@ class GraphSchemaService:
         LIMIT 1
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, diet_name=diet_name).single()
+            with get_neo4j_driver().session() as session:
+                records = _run(session, "diet_by_name", query, diet_name=diet_name)
+                result = records[0] if records else None
                 if result and isinstance(result["name"], Node):
                     diet_details = result["name"]._properties
                 else:
@@ -509,6 +509,53 @@ class GraphSchemaService:
             print(f"Error querying diet details for {diet_name}: {e}")
             return None
     
+    @staticmethod
+    def get_diet_analysis_by_diseases(disease_names: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Lấy chế độ ăn (kèm mô tả) và các phương pháp nấu được khuyến nghị
+        cho nhiều bệnh cùng lúc trong một truy vấn UNWIND.
+        Trả về {disease: {"diets": [{"name", "description"}], "cook_methods": [...]}}
+        """
+        if not disease_names:
+            return {}
+        # Sử dụng cache để tối ưu hiệu suất
+        cache_key = f"diet_analysis_{stable_key(sorted(disease_names))}"
+        cached_data = GraphSchemaService._get_cache(cache_key)
+        if cached_data:
+            return cached_data
+
+        query = """
+        UNWIND $disease_names AS disease_name
+        MATCH (d:Disease {name: disease_name})
+        OPTIONAL MATCH (d)-[:YÊU_CẦU_CHẾ_ĐỘ]->(diet:Diet)
+        OPTIONAL MATCH (diet)-[:KHUYẾN_NGHỊ]->(cm:CookMethod)
+        WITH d, diet, collect(DISTINCT cm.name) AS diet_methods
+        ORDER BY diet.name
+        WITH d,
+             collect(CASE WHEN diet IS NULL THEN NULL
+                     ELSE {name: diet.name, description: diet.description} END) AS diets,
+             collect(diet_methods) AS method_lists
+        RETURN d.name AS disease,
+               diets,
+               reduce(acc = [], methods IN method_lists |
+                      acc + [m IN methods WHERE NOT m IN acc]) AS cook_methods
+        """
+        try:
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "diet_analysis_by_diseases", query, disease_names=list(disease_names))
+                analysis = {name: {"diets": [], "cook_methods": []} for name in disease_names}
+                for record in result:
+                    analysis[record["disease"]] = {
+                        "diets": record["diets"],
+                        "cook_methods": sorted(record["cook_methods"])
+                    }
+                # Cache kết quả trong 1 giờ
+                GraphSchemaService._set_cache(cache_key, analysis, timeout=3600)
+                return analysis
+        except Exception as e:
+            print(f"Error querying diet analysis for {disease_names}: {e}")
+            return {}
+
     @staticmethod
     def get_food_network_analysis():
         """Phân tích mạng lưới thực phẩm"""
@@ -529,8 +576,8 @@ class GraphSchemaService:
         ORDER BY d.name, dish.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "food_network", query)
                 analysis = [record.data() for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, analysis, timeout=3600)
@@ -542,20 +589,16 @@ class GraphSchemaService:
     def get_foods_by_cooking_method(cooking_method: str, excluded_ids: List[str] = None):
         """Truy vấn thực phẩm theo phương pháp nấu (không phân biệt hoa thường)"""
         # Sử dụng cache để tối ưu hiệu suất
-        cache_key = f"foods_for_cooking_{cooking_method}_{hash(str(excluded_ids)) if excluded_ids else 'none'}"
+        cache_key = f"foods_for_cooking_{cooking_method}"
         cached_data = GraphSchemaService._get_cache(cache_key)
         if cached_data:
-            return cached_data
+            return ExclusionSet.coerce(excluded_ids).filter(cached_data)
         
         params = {"cooking_method": cooking_method}
         query = """
         MATCH (cm:CookMethod)-[:ĐƯỢC_DÙNG_TRONG]->(dish:Dish)
         WHERE toLower(cm.name) = toLower($cooking_method)
         """
-        if excluded_ids:
-            query += " AND NOT dish.id IN $excluded_ids "
-            params["excluded_ids"] = excluded_ids
-
         query += """
         RETURN DISTINCT 
             dish.name AS dish_name,
@@ -565,12 +608,12 @@ class GraphSchemaService:
         ORDER BY dish.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, **params)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "foods_by_cook_method", query, **params)
                 foods = [record.data() for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, foods, timeout=3600)
-                return foods
+                return ExclusionSet.coerce(excluded_ids).filter(foods)
         except Exception as e:
             print(f"Error querying foods for cooking method {cooking_method}: {e}")
             return []
@@ -600,8 +643,8 @@ class GraphSchemaService:
             LIMIT $limit
             """
             try:
-                with driver.session() as session:
-                    result = session.run(query, limit=limit)
+                with get_neo4j_driver().session() as session:
+                    result = _run(session, "healthy_foods", query, limit=limit)
                     foods = [record.data() for record in result]
                     # Cache kết quả trong 1 giờ
                     GraphSchemaService._set_cache(cache_key, foods, timeout=3600)
@@ -623,8 +666,8 @@ class GraphSchemaService:
             ORDER BY dish.name
             """
             try:
-                with driver.session() as session:
-                    result = session.run(query)
+                with get_neo4j_driver().session() as session:
+                    result = _run(session, "healthy_foods", query)
                     foods = [record.data() for record in result]
                     # Cache kết quả trong 1 giờ
                     GraphSchemaService._set_cache(cache_key, foods, timeout=3600)
@@ -642,7 +685,7 @@ class GraphSchemaService:
         
         if is_read_query:
             # Tạo cache key từ query và params
-            cache_key = f"custom_query_{hash(query + str(sorted(params.items()) if params else []))}"
+            cache_key = f"custom_query_{stable_key(query, sorted(params.items()) if params else [])}"
             cached_data = GraphSchemaService._get_cache(cache_key)
             if cached_data:
                 return cached_data
@@ -651,8 +694,8 @@ class GraphSchemaService:
             params = {}
         
         try:
-            with driver.session() as session:
-                result = session.run(query, **params)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "custom_query", query, **params)
                 data = [record.data() for record in result]
                 
                 # Chỉ cache cho read queries
@@ -668,18 +711,13 @@ class GraphSchemaService:
     def get_foods_by_bmi(bmi_category: str, excluded_ids: List[str] = None):
         """Truy vấn thực phẩm phù hợp với BMI category"""
         # Sử dụng cache để tối ưu hiệu suất
-        cache_key = f"foods_for_bmi_{bmi_category}_{hash(str(excluded_ids)) if excluded_ids else 'none'}"
+        cache_key = f"foods_for_bmi_{bmi_category}"
         cached_data = GraphSchemaService._get_cache(cache_key)
         if cached_data:
-            return cached_data
+            return ExclusionSet.coerce(excluded_ids).filter(cached_data)
         
         params = {"bmi_category": bmi_category}
         query = "MATCH (dish:Dish)-[:PHÙ_HỢP_VỚI_BMI]->(bmi:BMI {name: $bmi_category}) "
-        
-        if excluded_ids:
-            query += "WHERE NOT dish.id IN $excluded_ids "
-            params["excluded_ids"] = excluded_ids
-            
         query += """
         RETURN DISTINCT 
             dish.name AS dish_name,
@@ -689,12 +727,12 @@ class GraphSchemaService:
         ORDER BY dish.name
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, **params)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "foods_by_bmi", query, **params)
                 foods = [record.data() for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, foods, timeout=3600)
-                return foods
+                return ExclusionSet.coerce(excluded_ids).filter(foods)
         except Exception as e:
             print(f"Error querying foods for BMI {bmi_category}: {e}")
             return []
@@ -747,68 +785,41 @@ class GraphSchemaService:
     def get_popular_foods(excluded_ids: List[str] = None):
         """Truy vấn các món ăn phổ biến"""
         # Sử dụng cache để tối ưu hiệu suất
-        cache_key = f"popular_foods_{hash(str(excluded_ids)) if excluded_ids else 'none'}"
+        cache_key = "popular_foods"
         cached_data = GraphSchemaService._get_cache(cache_key)
         if cached_data:
-            return cached_data
+            return ExclusionSet.coerce(excluded_ids).filter(cached_data)
         
         params = {}
-        query = "MATCH (dish:Dish) "
-        if excluded_ids:
-            query += "WHERE NOT dish.id IN $excluded_ids "
-            params["excluded_ids"] = excluded_ids
-        
-        query += """
+        query = """
           MATCH (dish:Dish)
           RETURN dish.name as dish_name, dish.id as dish_id, dish.description as description
           ORDER BY dish.name
           
         """
         try:
-            with driver.session() as session:
-                result = session.run(query, **params)
+            with get_neo4j_driver().session() as session:
+                result = _run(session, "popular_foods", query, **params)
                 foods = [record.data() for record in result]
                 # Cache kết quả trong 1 giờ
                 GraphSchemaService._set_cache(cache_key, foods, timeout=3600)
-                return foods
+                return ExclusionSet.coerce(excluded_ids).filter(foods)
         except Exception as e:
             print(f"Error querying popular foods: {e}")
             return []
 
     @staticmethod
     def get_all_ingredients():
-        """Lấy tất cả các thành phần (Ingredient) từ MongoDB."""
-        # Sử dụng cache để tối ưu hiệu suất
-        cache_key = "all_ingredients"
-        cached_data = GraphSchemaService._get_cache(cache_key)
-        if cached_data:
-            return cached_data
-        
-        try:
-            ingredients = mongo_service.get_all_ingredients()
-            # Cache kết quả trong 1 giờ
-            GraphSchemaService._set_cache(cache_key, ingredients, timeout=3600)
-            return ingredients
-        except Exception as e:
-            print(f"Error getting all ingredients: {e}")
-            return []
+        """
+        Lấy tất cả các thành phần (Ingredient) từ MongoDB.
+        Cache nằm ở ingredient_cache của mongo_service (được cache_watcher xóa khi ingredients đổi)
+        """
+        return mongo_service.get_all_ingredients()
 
     @classmethod
     def get_cook_methods_by_ingredients(cls, ingredients: list) -> list:
         """
         Lấy các phương pháp chế biến phù hợp với danh sách nguyên liệu.
+        Cache nằm ở cook_methods_cache của mongo_service (bị xóa khi món ăn thay đổi)
         """
-        # Sử dụng cache để tối ưu hiệu suất
-        cache_key = f"cook_methods_for_ingredients_{hash(str(sorted(ingredients)))}"
-        cached_data = cls._get_cache(cache_key)
-        if cached_data:
-            return cached_data
-        
-        try:
-            cook_methods = mongo_service.get_cook_methods_by_ingredients(ingredients)
-            # Cache kết quả trong 1 giờ
-            cls._set_cache(cache_key, cook_methods, timeout=3600)
-            return cook_methods
-        except Exception as e:
-            print(f"Error getting cook methods by ingredients: {e}")
-            return []
\ No newline at end of file
+        return mongo_service.get_cook_methods_by_ingredients(ingredients)
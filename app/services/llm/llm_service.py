@@ -1,58 +1,143 @@
-import os
-import requests
-from typing import Optional
+from typing import Any, Dict, Optional
+
+from openai import OpenAI, AsyncOpenAI
+
+from app.config import OPENAI_API_KEY, OPENAI_BASE_URL, LLM_TIMEOUT
+from app.services.metrics import span, record_llm_usage
+from app.services.llm.resilience import LLMUnavailable, resilience
+from app.services.llm.single_flight import single_flight
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+DEFAULT_SYSTEM_PROMPT = "Bạn là một chuyên gia dinh dưỡng và ẩm thực."
+
 
 class LLMService:
     """
-    Service để gọi LLM API
+    Service để gọi LLM API (gateway dùng chung cho mọi node).
+    - chat / achat: gọi chat completion, lỗi thì raise để node tự xử lý
+    - get_completion / aget_completion: như chat nhưng không có API key thì trả về prompt gốc
+    LLM không trả lời được (lỗi sau retry, circuit đang mở) thì raise LLMUnavailable, node dùng đường xử lý cục bộ.
+    Các lời gọi giống hệt nhau đến cùng lúc được gộp thành một request (single_flight),
+    retry / circuit breaker / hedging nằm trong resilience.
+    Client sync và async được tạo lười, dùng chung pool kết nối HTTP trong process.
     """
-    
+
+    api_key: Optional[str] = OPENAI_API_KEY
+    base_url: Optional[str] = OPENAI_BASE_URL
+    _client: Optional[OpenAI] = None
+    _async_client: Optional[AsyncOpenAI] = None
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return bool(cls.api_key)
+
+    @classmethod
+    def configure(cls, base_url: Optional[str] = None, api_key: Optional[str] = None):
+        """Đổi endpoint / API key (ví dụ server giả lập khi test), client được tạo lại ở lần gọi sau"""
+        cls.base_url = base_url
+        if api_key is not None:
+            cls.api_key = api_key
+        cls._client = None
+        cls._async_client = None
+
+    @classmethod
+    def _get_client(cls) -> OpenAI:
+        if cls._client is None:
+            # Retry do resilience đảm nhận (có circuit breaker, theo deadline), tắt retry của SDK
+            cls._client = OpenAI(api_key=cls.api_key, base_url=cls.base_url, timeout=LLM_TIMEOUT, max_retries=0)
+        return cls._client
+
+    @classmethod
+    def _get_async_client(cls) -> AsyncOpenAI:
+        if cls._async_client is None:
+            cls._async_client = AsyncOpenAI(api_key=cls.api_key, base_url=cls.base_url, timeout=LLM_TIMEOUT, max_retries=0)
+        return cls._async_client
+
     @staticmethod
-    def get_completion(prompt: str, model: str = "gpt-3.5-turbo") -> str:
-        """
-        Gọi LLM API để lấy completion
-        """
-        try:
-            # Sử dụng OpenAI API hoặc API tương tự
-            api_key = os.getenv("OPENAI_API_KEY")
-            if not api_key:
-                # Fallback: trả về prompt gốc nếu không có API key
-                print("WARNING: No OpenAI API key found, returning original prompt")
-                return prompt
-            
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": "Bạn là một chuyên gia dinh dưỡng và ẩm thực."},
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": 2000,
-                "temperature": 0.1
-            }
-            
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
-            else:
-                print(f"LLM API error: {response.status_code} - {response.text}")
-                return prompt
-                
-        except Exception as e:
-            print(f"LLM service error: {e}")
+    def build_request(
+        prompt: str,
+        model: str = DEFAULT_MODEL,
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+        max_tokens: Optional[int] = 2000,
+        temperature: float = 0.1,
+        response_format: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        request: Dict[str, Any] = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": temperature,
+        }
+        if max_tokens:
+            request["max_tokens"] = max_tokens
+        if response_format:
+            # Structured output (json_schema) cho các node cần kết quả có cấu trúc
+            request["response_format"] = response_format
+        return request
+
+    @staticmethod
+    def _log_usage(model: str, usage: Any):
+        """Log số token mỗi lần gọi để theo dõi chi phí (tổng theo model có ở /metrics: llm_tokens_total)"""
+        if usage is not None:
+            print(f"DEBUG: LLM usage [{model}]: prompt_tokens={getattr(usage, 'prompt_tokens', None)}, completion_tokens={getattr(usage, 'completion_tokens', None)}")
+
+    @classmethod
+    def _create(cls, request: Dict[str, Any]) -> str:
+        with span("llm", request["model"]) as current:
+            response = cls._get_client().chat.completions.create(**request)
+            record_llm_usage(current, request["model"], response.usage)
+        cls._log_usage(request["model"], response.usage)
+        return response.choices[0].message.content or ""
+
+    @classmethod
+    async def _acreate(cls, request: Dict[str, Any]) -> str:
+        with span("llm", request["model"]) as current:
+            response = await cls._get_async_client().chat.completions.create(**request)
+            record_llm_usage(current, request["model"], response.usage)
+        cls._log_usage(request["model"], response.usage)
+        return response.choices[0].message.content or ""
+
+    @classmethod
+    def chat(cls, prompt: str, **options) -> str:
+        """
+        Gọi chat completion (blocking). options: model, system_prompt, max_tokens, temperature, response_format
+        Timeout mỗi lần gọi lấy theo deadline còn lại của request (raise DeadlineExceeded nếu đã hết)
+        """
+        request = cls.build_request(prompt, **options)
+        return single_flight.do(request, lambda: resilience.call(request, cls._create))
+
+    @classmethod
+    async def achat(cls, prompt: str, hedge: bool = False, **options) -> str:
+        """
+        Phiên bản async của chat, không chiếm thread trong lúc chờ LLM.
+        hedge=True cho lời gọi cần độ trễ thấp: chậm quá LLM_HEDGE_DELAY_SECONDS thì gửi thêm một request
+        """
+        request = cls.build_request(prompt, **options)
+        return await single_flight.ado(request, lambda: resilience.acall(request, cls._acreate, hedge=hedge))
+
+    @classmethod
+    def get_completion(cls, prompt: str, model: str = DEFAULT_MODEL) -> str:
+        """
+        Gọi LLM API để lấy completion (LLM lỗi thì raise LLMUnavailable, hết deadline thì DeadlineExceeded)
+        """
+        if not cls.is_available():
+            # Fallback: trả về prompt gốc nếu không có API key
+            print("WARNING: No OpenAI API key found, returning original prompt")
             return prompt
-    
+        return cls.chat(prompt, model=model)
+
+    @classmethod
+    async def aget_completion(cls, prompt: str, model: str = DEFAULT_MODEL) -> str:
+        """
+        Phiên bản async của get_completion
+        """
+        if not cls.is_available():
+            print("WARNING: No OpenAI API key found, returning original prompt")
+            return prompt
+        return await cls.achat(prompt, model=model)
+
     @staticmethod
     def get_completion_simple(prompt: str) -> str:
         """
@@ -60,4 +145,4 @@ class LLMService:
         """
         # Fallback: trả về prompt gốc
         print("INFO: Using simple LLM fallback")
-        return prompt 
\ No newline at end of file
+        return prompt
@@ -0,0 +1,269 @@
+"""
+Lớp chịu lỗi cho lời gọi LLM (dùng trong LLMService):
+
+- Retry lỗi tạm thời (429, 408, 409, 5xx, timeout, mất kết nối) với exponential backoff có jitter,
+  ưu tiên thời gian chờ server gửi trong header Retry-After / retry-after-ms
+- Circuit breaker theo model: lỗi tạm thời liên tiếp đủ ngưỡng thì mở mạch, các lời gọi sau raise
+  CircuitOpenError ngay (node chuyển sang đường xử lý cục bộ) cho đến khi một lời gọi thử thành công
+- Hedging (chỉ nhánh async): lời gọi cần độ trễ thấp chưa có kết quả sau LLM_HEDGE_DELAY_SECONDS
+  thì gửi thêm một request giống hệt, lấy kết quả về trước và hủy request còn lại
+
+Mọi thời gian chờ đều nằm trong deadline của request (app.utils.deadline).
+"""
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from openai import APIConnectionError, APIError, APIStatusError, APITimeoutError
+
+from app.config import (
+    LLM_CIRCUIT_FAILURE_THRESHOLD,
+    LLM_CIRCUIT_RESET_SECONDS,
+    LLM_HEDGE_DELAY_SECONDS,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+    LLM_TIMEOUT,
+)
+from app.services.metrics import registry
+from app.utils import deadline
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+RETRIES = registry.counter(
+    "llm_retries_total", "Số lần gọi lại LLM sau lỗi tạm thời", ("model", "reason")
+)
+CIRCUIT_REJECTED = registry.counter(
+    "llm_circuit_rejected_total", "Số lời gọi LLM bị từ chối ngay vì circuit đang mở", ("model",)
+)
+HEDGED = registry.counter(
+    "llm_hedged_requests_total", "Số request hedge đã gửi, theo request trả về trước", ("model", "winner")
+)
+
+
+class LLMUnavailable(Exception):
+    """LLM không trả lời được (lỗi upstream sau khi đã retry, hoặc circuit đang mở)"""
+
+
+class CircuitOpenError(LLMUnavailable):
+    """Circuit breaker của model đang mở, không gửi request"""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, APIConnectionError):  # gồm cả APITimeoutError
+        return True
+    return isinstance(error, APIStatusError) and (
+        error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    )
+
+
+def _failure_reason(error: Exception) -> str:
+    if isinstance(error, APITimeoutError):
+        return "timeout"
+    if isinstance(error, APIStatusError):
+        return str(error.status_code)
+    return "connection"
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Số giây server yêu cầu chờ (retry-after-ms, Retry-After dạng giây hoặc HTTP date), None nếu không có"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Circuit breaker của một model: closed -> open (đủ lỗi liên tiếp) -> half_open (sau reset_seconds, thử một lời gọi)"""
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, model: str, failure_threshold: int, reset_seconds: float):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Gọi trước mỗi request: raise CircuitOpenError nếu mạch mở hoặc đang có lời gọi thử"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        CIRCUIT_REJECTED.inc(model=self.model)
+        raise CircuitOpenError(f"Circuit breaker của {self.model} đang mở")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print(f"INFO: Circuit breaker {self.model} đóng lại")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"WARNING: Circuit breaker {self.model} mở sau {self._failures} lỗi liên tiếp")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """Lời gọi kết thúc mà không cho biết upstream còn lỗi hay không (lỗi 4xx, deadline...)"""
+        with self._lock:
+            self._probing = False
+
+
+class ResilientCaller:
+    """Retry + circuit breaker + hedging quanh hàm gửi request (LLMService._create / _acreate)"""
+
+    STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+    def __init__(self):
+        self.max_retries = LLM_MAX_RETRIES
+        self.base_delay = LLM_RETRY_BASE_DELAY
+        self.max_delay = LLM_RETRY_MAX_DELAY
+        self.hedge_delay = LLM_HEDGE_DELAY_SECONDS
+        self.failure_threshold = LLM_CIRCUIT_FAILURE_THRESHOLD
+        self.reset_seconds = LLM_CIRCUIT_RESET_SECONDS
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(model, self.failure_threshold, self.reset_seconds)
+            return self._breakers[model]
+
+    def circuit_states(self) -> Dict[tuple, int]:
+        with self._lock:
+            return {(model,): self.STATE_VALUES[breaker.state] for model, breaker in self._breakers.items()}
+
+    def reset(self):
+        with self._lock:
+            self._breakers.clear()
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        """Retry-After nếu server có gửi, ngược lại full jitter: random(0, base * 2^attempt), tối đa max_delay"""
+        hinted = retry_after(error)
+        if hinted is not None:
+            return min(hinted, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _attempt(self, request: Dict[str, Any], breaker: CircuitBreaker) -> Dict[str, Any]:
+        # Timeout tính trước khi chiếm lượt thử của half_open (timeout_for có thể raise DeadlineExceeded)
+        attempt_request = {**request, "timeout": deadline.timeout_for(LLM_TIMEOUT)}
+        breaker.check()
+        return attempt_request
+
+    def _on_failure(self, breaker: CircuitBreaker, request: Dict[str, Any], error: Exception, attempt: int) -> float:
+        """Xử lý lỗi của một lần gọi: raise nếu không gọi lại, ngược lại trả về số giây cần chờ"""
+        if isinstance(error, APITimeoutError) and request["timeout"] < LLM_TIMEOUT:
+            # Timeout do deadline của request (không phải LLM_TIMEOUT): node degrade, không tính là lỗi upstream
+            breaker.release()
+            raise deadline.DeadlineExceeded("Hết thời gian của request khi chờ LLM") from error
+        if not is_retryable(error):
+            breaker.release()
+            if isinstance(error, APIError):
+                raise LLMUnavailable(f"LLM lỗi: {error}") from error
+            raise error
+
+        breaker.record_failure()
+        if attempt >= self.max_retries:
+            raise LLMUnavailable(f"LLM lỗi sau {attempt + 1} lần gọi: {error}") from error
+        delay = self.backoff_delay(attempt, error)
+        if not deadline.has_budget(delay):
+            raise LLMUnavailable(f"Không đủ thời gian để gọi lại LLM: {error}") from error
+        reason = _failure_reason(error)
+        RETRIES.inc(model=breaker.model, reason=reason)
+        print(f"WARNING: LLM {breaker.model} lỗi ({reason}), gọi lại sau {delay:.2f}s (lần {attempt + 1}/{self.max_retries})")
+        return delay
+
+    def call(self, request: Dict[str, Any], send: Callable[[Dict[str, Any]], str]) -> str:
+        breaker = self.breaker(request["model"])
+        attempt = 0
+        while True:
+            attempt_request = self._attempt(request, breaker)
+            try:
+                result = send(attempt_request)
+            except Exception as e:
+                time.sleep(self._on_failure(breaker, attempt_request, e, attempt))
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+    async def acall(self, request: Dict[str, Any], send: Callable[[Dict[str, Any]], Awaitable[str]], hedge: bool = False) -> str:
+        breaker = self.breaker(request["model"])
+        attempt = 0
+        while True:
+            attempt_request = self._attempt(request, breaker)
+            try:
+                if hedge and self.hedge_delay > 0:
+                    result = await self._hedged(attempt_request, send)
+                else:
+                    result = await send(attempt_request)
+            except Exception as e:
+                await asyncio.sleep(self._on_failure(breaker, attempt_request, e, attempt))
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+    async def _hedged(self, request: Dict[str, Any], send: Callable[[Dict[str, Any]], Awaitable[str]]) -> str:
+        """Gửi request, quá hedge_delay chưa xong thì gửi thêm một bản; lấy kết quả thành công về trước"""
+        primary = asyncio.ensure_future(send(request))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if done or not deadline.has_budget():
+                return await primary
+            hedge = asyncio.ensure_future(send({**request, "timeout": deadline.timeout_for(LLM_TIMEOUT)}))
+            tasks.add(hedge)
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        HEDGED.inc(model=request["model"], winner="primary" if task is primary else "hedge")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+resilience = ResilientCaller()
+registry.gauge_callback(
+    "llm_circuit_state", "Trạng thái circuit breaker theo model (0 đóng, 1 nửa mở, 2 mở)",
+    resilience.circuit_states, ("model",)
+)
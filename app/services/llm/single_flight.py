@@ -0,0 +1,147 @@
+"""
+Single-flight cho lời gọi LLM: các lời gọi giống hệt nhau (model, messages, tham số) đến cùng lúc
+chỉ gửi một request lên OpenAI và dùng chung kết quả.
+
+- Lời gọi đầu tiên (leader) gửi request, các lời gọi sau (follower) chờ kết quả đó
+- Kết quả thành công được giữ thêm LLM_SINGLE_FLIGHT_WINDOW_SECONDS giây cho các lời gọi đến ngay sau
+- Lỗi được trả cho mọi lời gọi đang chờ nhưng không được giữ lại
+- Mỗi lời gọi chờ theo deadline của request đó, không theo deadline của leader
+Số lời gọi được gộp đếm ở llm_coalesced_total.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.config import LLM_SINGLE_FLIGHT_WINDOW_SECONDS
+from app.services.metrics import registry
+from app.utils import deadline
+
+COALESCED = registry.counter(
+    "llm_coalesced_total", "Số lời gọi LLM dùng chung kết quả thay vì gửi request mới", ("model", "source")
+)
+
+# Số kết quả vừa xong được giữ tối đa trong cửa sổ dùng lại
+MAX_RECENT_RESULTS = 256
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Hash của request (model, messages, tham số; bỏ timeout vì mỗi lời gọi có deadline riêng)"""
+    payload = {name: value for name, value in request.items() if name != "timeout"}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class _Call:
+    """Một request đang chạy ở nhánh sync, các thread follower chờ trên event"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self, window: float = LLM_SINGLE_FLIGHT_WINDOW_SECONDS):
+        self.window = window
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # key -> (thời điểm hết hạn theo time.monotonic(), kết quả)
+        self._recent: Dict[str, Tuple[float, str]] = {}
+
+    def _get_recent(self, key: str) -> Optional[str]:
+        entry = self._recent.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._recent.pop(key, None)
+            return None
+        return entry[1]
+
+    def _remember(self, key: str, result: str):
+        if self.window <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if len(self._recent) >= MAX_RECENT_RESULTS:
+                self._recent = {k: v for k, v in self._recent.items() if v[0] >= now}
+                if len(self._recent) >= MAX_RECENT_RESULTS:
+                    self._recent.pop(next(iter(self._recent)))
+            self._recent[key] = (now + self.window, result)
+
+    def do(self, request: Dict[str, Any], fn: Callable[[], str]) -> str:
+        """Nhánh sync: leader gọi fn ngay trên thread hiện tại, follower chờ trong deadline của mình"""
+        key = request_key(request)
+        with self._lock:
+            recent = self._get_recent(key)
+            call = self._calls.get(key) if recent is None else None
+            leader = recent is None and call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if recent is not None:
+            COALESCED.inc(model=request["model"], source="recent")
+            return recent
+
+        if not leader:
+            COALESCED.inc(model=request["model"], source="inflight")
+            if not call.done.wait(deadline.remaining()):
+                raise deadline.DeadlineExceeded("Hết thời gian của request khi chờ lời gọi LLM đang chạy")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        self._remember(key, call.result)
+        return call.result
+
+    async def ado(self, request: Dict[str, Any], fn: Callable[[], Awaitable[str]]) -> str:
+        """
+        Nhánh async: request chạy trong một task riêng nên leader bị hủy (client ngắt kết nối)
+        thì các follower vẫn nhận được kết quả
+        """
+        key = request_key(request)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            recent = self._get_recent(key)
+            task = self._tasks.get(key) if recent is None else None
+            if task is not None and task.get_loop() is not loop:
+                task = None
+            leader = recent is None and task is None
+            if leader:
+                task = self._tasks[key] = loop.create_task(fn())
+                task.add_done_callback(lambda done: self._finish_task(key, done))
+        if recent is not None:
+            COALESCED.inc(model=request["model"], source="recent")
+            return recent
+        if not leader:
+            COALESCED.inc(model=request["model"], source="inflight")
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+        except asyncio.TimeoutError as e:
+            if task.done():
+                raise
+            raise deadline.DeadlineExceeded("Hết thời gian của request khi chờ lời gọi LLM đang chạy") from e
+
+    def _finish_task(self, key: str, task: asyncio.Task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        if not task.cancelled() and task.exception() is None:
+            self._remember(key, task.result())
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+
+
+single_flight = SingleFlight()
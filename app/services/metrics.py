@@ -0,0 +1,351 @@
+"""
+Đo thời gian / lỗi theo node và theo lời gọi ngoài (Neo4j, MongoDB, LLM).
+
+- Registry tối giản xuất định dạng text của Prometheus (GET /metrics), không cần prometheus_client
+- instrument_node: bọc node LangGraph, ghi histogram thời gian, số lỗi và step kết quả
+- span / traced: span cho lời gọi ngoài, lồng trong span của node đang chạy (contextvars)
+- OpenTelemetry tùy chọn: có OTEL_EXPORTER_OTLP_ENDPOINT và cài opentelemetry-sdk +
+  opentelemetry-exporter-otlp-proto-http thì span được gửi về collector (setup_tracing ở lifespan)
+"""
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from langgraph.errors import GraphBubbleUp
+
+from app.config import OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(labelnames: Iterable[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # label -> [số đếm theo bucket..., tổng, số lần]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[-1] if state else 0
+
+    def render(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = self.header()
+        for key, state in items:
+            for bound, bucket_count in zip(self.buckets, state):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {bucket_count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Gauge lấy giá trị lúc xuất /metrics (số session, số entry cache...)"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback: Callable[[], Any], labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"WARNING: metric {self.name} lỗi: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values.items() if value is not None
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable[[], Any], labelnames: Tuple[str, ...] = ()):
+        """Đăng ký (hoặc thay) gauge tính theo callback"""
+        with self._lock:
+            self._metrics[name] = CallbackGauge(name, documentation, callback, labelnames)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+NODE_DURATION = registry.histogram(
+    "workflow_node_duration_seconds", "Thời gian chạy mỗi node LangGraph", ("node",)
+)
+NODE_ERRORS = registry.counter(
+    "workflow_node_errors_total", "Số lần node raise hoặc trả về error", ("node",)
+)
+NODE_STEPS = registry.counter(
+    "workflow_node_steps_total", "Step kết quả của mỗi node", ("node", "step")
+)
+EXTERNAL_CALL_DURATION = registry.histogram(
+    "external_call_duration_seconds", "Thời gian lời gọi ngoài (neo4j, mongo, llm) theo node đang chạy", ("kind", "name", "node")
+)
+EXTERNAL_CALL_ERRORS = registry.counter(
+    "external_call_errors_total", "Số lời gọi ngoài bị lỗi", ("kind", "name")
+)
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Số token LLM theo model", ("model", "type")
+)
+
+# Node LangGraph đang chạy (để gắn lời gọi ngoài vào node), giữ qua asyncio.to_thread / executor
+_current_node: ContextVar[str] = ContextVar("workflow_node", default="")
+
+_tracer = trace.get_tracer("nutrition-assistant") if trace is not None else None
+
+
+def setup_tracing() -> bool:
+    """Gửi span về collector OTLP (HTTP) nếu có cấu hình, trả về True khi đã bật"""
+    global _tracer
+    if not OTEL_EXPORTER_OTLP_ENDPOINT:
+        return False
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        print("WARNING: OTEL_EXPORTER_OTLP_ENDPOINT cần cài opentelemetry-sdk và opentelemetry-exporter-otlp-proto-http, bỏ qua tracing")
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=f"{OTEL_EXPORTER_OTLP_ENDPOINT.rstrip('/')}/v1/traces")))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("nutrition-assistant")
+    print(f"[DEBUG] OpenTelemetry tracing -> {OTEL_EXPORTER_OTLP_ENDPOINT}")
+    return True
+
+
+def shutdown_tracing():
+    if trace is None:
+        return
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, "shutdown"):
+        provider.shutdown()
+
+
+class Span:
+    """Span đang mở: set() ghi thuộc tính (token, số bản ghi...) lên span OpenTelemetry nếu có"""
+
+    def __init__(self, otel_span=None):
+        self._otel_span = otel_span
+        self.attributes: Dict[str, Any] = {}
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+        if self._otel_span is not None and value is not None:
+            self._otel_span.set_attribute(key, value)
+
+
+@contextmanager
+def _otel_span(name: str, attributes: Dict[str, Any]):
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes) as otel_span:
+        yield otel_span
+
+
+@contextmanager
+def span(kind: str, name: str, **attributes):
+    """Span cho một lời gọi ngoài, ví dụ span("neo4j", "get_foods_by_bmi")"""
+    node = _current_node.get()
+    start = time.perf_counter()
+    with _otel_span(f"{kind} {name}", {"call.kind": kind, "call.name": name, **attributes}) as otel_span:
+        current = Span(otel_span)
+        try:
+            yield current
+        except Exception:
+            EXTERNAL_CALL_ERRORS.inc(kind=kind, name=name)
+            raise
+        finally:
+            EXTERNAL_CALL_DURATION.observe(time.perf_counter() - start, kind=kind, name=name, node=node)
+
+
+def traced(kind: str, name: Optional[str] = None):
+    """Decorator tạo span cho hàm (sync hoặc async), mặc định tên span = tên hàm"""
+
+    def decorator(func):
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(kind, span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def record_llm_usage(current: Span, model: str, usage: Any):
+    """Ghi số token (response.usage của OpenAI) vào span và counter"""
+    if usage is None:
+        return
+    for token_type in ("prompt_tokens", "completion_tokens"):
+        count = getattr(usage, token_type, None)
+        if count:
+            current.set(f"llm.{token_type}", count)
+            LLM_TOKENS.inc(count, model=model, type=token_type.replace("_tokens", ""))
+
+
+@contextmanager
+def _node_scope(node_name: str):
+    """Đo một lần chạy node; kết quả (step, error) được ghi qua hàm record trả về"""
+    token = _current_node.set(node_name)
+    start = time.perf_counter()
+
+    def record(result: Any):
+        if isinstance(result, dict):
+            if result.get("error"):
+                NODE_ERRORS.inc(node=node_name)
+            if result.get("step"):
+                NODE_STEPS.inc(node=node_name, step=result["step"])
+
+    try:
+        with _otel_span(f"node {node_name}", {"workflow.node": node_name}):
+            yield record
+    except GraphBubbleUp:
+        # interrupt() dừng workflow chờ người dùng, không phải lỗi
+        NODE_STEPS.inc(node=node_name, step="interrupted")
+        raise
+    except Exception:
+        NODE_ERRORS.inc(node=node_name)
+        raise
+    finally:
+        _current_node.reset(token)
+        NODE_DURATION.observe(time.perf_counter() - start, node=node_name)
+
+
+def instrument_node(node_name: str, func: Callable) -> Callable:
+    """Bọc node LangGraph: đo thời gian, đếm lỗi, ghi step kết quả và mở span cho node"""
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_node(state):
+            with _node_scope(node_name) as record:
+                result = await func(state)
+                record(result)
+            return result
+        return async_node
+
+    @functools.wraps(func)
+    def node(state):
+        with _node_scope(node_name) as record:
+            result = func(state)
+            record(result)
+        return result
+    return node
@@ -0,0 +1,159 @@
+"""
+Tạo index MongoDB cần thiết cho các truy vấn nóng và kiểm tra query plan.
+
+Cách dùng:
+    python -m app.services.mongo_indexes            # tạo index + kiểm tra plan
+    python -m app.services.mongo_indexes --check    # chỉ kiểm tra plan
+    python -m app.services.mongo_indexes --backfill # backfill ingredient_keys trước khi tạo index
+
+Thoát với mã 1 nếu có truy vấn nóng nào rơi vào COLLSCAN (dùng được trong CI với mongod local).
+"""
+import argparse
+import sys
+from typing import Any, Dict, List
+
+from pymongo import ASCENDING
+
+from app.services.mongo_service import mongo_service
+
+# Index bắt buộc: (collection, keys, options)
+REQUIRED_INDEXES: List[Dict[str, Any]] = [
+    # get_dishes_by_ids theo neo4j_id, filter_dishes_by_ingredients
+    {"collection": "dishes", "keys": [("neo4j_id", ASCENDING)], "name": "neo4j_id_1"},
+    # filter_dishes_by_ingredients (multikey)
+    {"collection": "dishes", "keys": [("ingredient_keys", ASCENDING)], "name": "ingredient_keys_1"},
+    # get_cook_methods_by_ingredients: $match trên ingredients, cook_method để index che phủ $group
+    {"collection": "dishes", "keys": [("ingredients", ASCENDING), ("cook_method", ASCENDING)], "name": "ingredients_1_cook_method_1"},
+    # get_user_by_email
+    {"collection": "users", "keys": [("email", ASCENDING)], "name": "email_1"},
+    # cache_watcher ở chế độ polling (mongod standalone)
+    {"collection": "users", "keys": [("lastUpdateDate", ASCENDING)], "name": "lastUpdateDate_1"},
+    {"collection": "dishes", "keys": [("lastUpdateDate", ASCENDING)], "name": "lastUpdateDate_1"},
+    {"collection": "ingredients", "keys": [("lastUpdateDate", ASCENDING)], "name": "lastUpdateDate_1"},
+]
+
+# Các dạng truy vấn nóng cần được phục vụ bằng index
+HOT_QUERIES: List[Dict[str, Any]] = [
+    {
+        "name": "dishes.find(neo4j_id $in)",
+        "collection": "dishes",
+        "filter": {"neo4j_id": {"$in": ["__explain__"]}},
+    },
+    {
+        "name": "dishes.find(_id $in)",
+        "collection": "dishes",
+        "filter": {"_id": {"$in": ["__explain__"]}},
+    },
+    {
+        "name": "dishes.find(neo4j_id $in, ingredient_keys $in)",
+        "collection": "dishes",
+        "filter": {"neo4j_id": {"$in": ["__explain__"]}, "ingredient_keys": {"$in": ["__explain__"]}},
+    },
+    {
+        "name": "dishes.aggregate(ingredients $match + $group cook_method)",
+        "collection": "dishes",
+        "pipeline": [
+            {"$match": {"ingredients": {"$in": ["__explain__"]}}},
+            {"$group": {"_id": "$cook_method"}},
+        ],
+    },
+    {
+        "name": "users.find_one(email)",
+        "collection": "users",
+        "filter": {"email": "__explain__@example.com"},
+    },
+]
+
+
+def ensure_indexes(db) -> List[str]:
+    """Tạo các index bắt buộc (idempotent). Trả về danh sách tên index."""
+    created = []
+    for spec in REQUIRED_INDEXES:
+        name = db[spec["collection"]].create_index(spec["keys"], name=spec["name"])
+        print(f"✅ Index {spec['collection']}.{name}")
+        created.append(name)
+    return created
+
+
+def _collect_stages(plan: Any, stages: List[str]):
+    """Duyệt đệ quy output của explain() để lấy tên tất cả các stage"""
+    if isinstance(plan, dict):
+        stage = plan.get("stage")
+        if isinstance(stage, str):
+            stages.append(stage)
+        for value in plan.values():
+            _collect_stages(value, stages)
+    elif isinstance(plan, list):
+        for item in plan:
+            _collect_stages(item, stages)
+
+
+def _find_key(doc: Any, key: str, found: List[Any]):
+    if isinstance(doc, dict):
+        for k, value in doc.items():
+            if k == key:
+                found.append(value)
+            else:
+                _find_key(value, key, found)
+    elif isinstance(doc, list):
+        for item in doc:
+            _find_key(item, key, found)
+
+
+def explain_query(db, query: Dict[str, Any]) -> Dict[str, Any]:
+    """Chạy explain cho một truy vấn nóng, trả về các stage của winning plan"""
+    collection = db[query["collection"]]
+    if "pipeline" in query:
+        explain = db.command("aggregate", query["collection"], pipeline=query["pipeline"], explain=True)
+    else:
+        explain = collection.find(query["filter"]).explain()
+
+    stages: List[str] = []
+    # Chỉ xét winning plan, bỏ qua rejectedPlans
+    planners = []
+    _find_key(explain, "queryPlanner", planners)
+    for planner in planners:
+        _collect_stages(planner.get("winningPlan", {}), stages)
+    return {"name": query["name"], "stages": stages, "collscan": "COLLSCAN" in stages}
+
+
+def verify_query_plans(db) -> bool:
+    """Kiểm tra tất cả truy vấn nóng, trả về False nếu có COLLSCAN"""
+    ok = True
+    for query in HOT_QUERIES:
+        result = explain_query(db, query)
+        if result["collscan"] or not result["stages"]:
+            ok = False
+            print(f"❌ {result['name']}: {' -> '.join(result['stages']) or 'không đọc được plan'}")
+        else:
+            print(f"✅ {result['name']}: {' -> '.join(result['stages'])}")
+    return ok
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Tạo index MongoDB và kiểm tra query plan")
+    parser.add_argument("--check", action="store_true", help="Chỉ kiểm tra plan, không tạo index")
+    parser.add_argument("--backfill", action="store_true", help="Backfill ingredient_keys trước khi tạo index")
+    args = parser.parse_args(argv)
+
+    db = mongo_service.db
+    try:
+        db.client.admin.command("ping")
+    except Exception as e:
+        print(f"❌ Không có kết nối MongoDB: {e}")
+        return 1
+
+    if args.backfill:
+        mongo_service.backfill_ingredient_keys()
+    if not args.check:
+        ensure_indexes(db)
+
+    if not verify_query_plans(db):
+        print("❌ Có truy vấn nóng không dùng index (COLLSCAN)")
+        return 1
+    print("✅ Tất cả truy vấn nóng đều dùng index")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,144 @@
-from app.config import mongo_db
+from app.services.connection_manager import get_mongo_db
+from app.services.user_profile_cache import user_profile_cache
+from app.services.dish_store import dish_store
+from app.services.cache_service import TieredCache, stable_key
+from app.config import INGREDIENT_CACHE_TTL
+from app.services.metrics import traced
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne
+import unicodedata
+
+
+def normalize_ingredient_key(name: str) -> str:
+    """
+    Chuẩn hóa tên nguyên liệu thành key để so khớp chính xác:
+    chữ thường, bỏ dấu tiếng Việt, gộp khoảng trắng.
+    Ví dụ: "  Thịt  Heo " -> "thit heo", "Đậu phụ" -> "dau phu"
+    """
+    text = unicodedata.normalize("NFD", str(name).strip().lower())
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = text.replace("đ", "d")
+    return " ".join(text.split())
+
+
+def build_ingredient_keys(ingredients: List[str]) -> List[str]:
+    """Tạo danh sách ingredient_keys (multikey) từ danh sách nguyên liệu"""
+    return sorted({normalize_ingredient_key(i) for i in ingredients or [] if i and str(i).strip()})
+
+
+# Projection dùng chung cho service sync và async
+USER_HEALTH_PROJECTION = {
+    "name": 1,
+    "email": 1,
+    "dateOfBirth": 1,
+    "gender": 1,
+    "weight": 1,
+    "height": 1,
+    "activityLevel": 1,
+    "medicalConditions": 1,
+    "allergies": 1,
+    "lastUpdateDate": 1,
+    "bmi_input_hash": 1
+}
+# Các trường chỉ do save_bmi_calculation ghi, không làm thay đổi hồ sơ đã cache
+BMI_RESULT_FIELDS = frozenset({"bmi", "bmi_category", "bmr", "calorie_need_per_day", "last_bmi_calculation", "bmi_input_hash", "lastUpdateDate"})
+DISH_ID_PROJECTION = {"neo4j_id": 1, "_id": 0}
+INGREDIENT_NAME_PROJECTION = {"name": 1, "_id": 0}
+
+def build_cook_methods_pipeline(ingredients: List[str]) -> List[Dict[str, Any]]:
+    """Pipeline lấy các phương pháp chế biến duy nhất từ món ăn chứa nguyên liệu"""
+    return [
+        {
+            "$match": {
+                "ingredients": {"$in": ingredients}
+            }
+        },
+        {
+            "$group": {
+                "_id": "$cook_method"
+            }
+        },
+        {
+            "$project": {
+                "cook_method": "$_id",
+                "_id": 0
+            }
+        }
+    ]
+
+def build_dishes_by_ingredients_query(dish_ids: List[str], ingredients: List[str]) -> Dict[str, Any]:
+    """Ví dụ: ingredients = ["Thịt heo", "Cà tím"] -> ingredient_keys $in ["thit heo", "ca tim"]"""
+    return {
+        "neo4j_id": {"$in": dish_ids},
+        "ingredient_keys": {"$in": build_ingredient_keys(ingredients)}
+    }
+
+def prepare_user_health_data(user: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    """
+    Chuẩn hóa document user: _id dạng string, tính tuổi từ dateOfBirth, activity_level
+    """
+    # Convert ObjectId to string
+    user["_id"] = str(user["_id"])
+    
+    # Tính tuổi từ dateOfBirth
+    if user.get("dateOfBirth"):
+        birth_date = user["dateOfBirth"]
+        if isinstance(birth_date, str):
+            birth_date = datetime.fromisoformat(birth_date.replace('Z', '+00:00'))
+        elif isinstance(birth_date, datetime):
+            pass
+        else:
+            birth_date = datetime.fromisoformat(str(birth_date))
+        
+        today = datetime.now()
+        age = today.year - birth_date.year
+        if today.month < birth_date.month or (today.month == birth_date.month and today.day < birth_date.day):
+            age -= 1
+        user["age"] = age
+    else:
+        user["age"] = None
+        print(f"Warning: No dateOfBirth for user {user_id}")
+    
+    # Sử dụng trực tiếp activityLevel string
+    user["activity_level"] = user.get("activityLevel", "sedentary")
+    
+    # Kiểm tra dữ liệu cần thiết
+    missing_fields = []
+    if not user.get("weight"):
+        missing_fields.append("weight")
+    if not user.get("height"):
+        missing_fields.append("height")
+    if not user.get("age"):
+        missing_fields.append("age (from dateOfBirth)")
+    
+    if missing_fields:
+        print(f"Missing required fields for user {user_id}: {missing_fields}")
+    return user
+
+# Danh sách nguyên liệu ít thay đổi, được xóa bởi cache_watcher khi collection ingredients đổi
+ingredient_cache = TieredCache("ingredients", default_ttl=INGREDIENT_CACHE_TTL)
+ALL_INGREDIENTS_KEY = "all"
+# Phương pháp chế biến theo tập nguyên liệu: phụ thuộc vào mọi món ăn nên bị xóa cả namespace khi một món thay đổi
+cook_methods_cache = TieredCache("cook_methods", default_ttl=INGREDIENT_CACHE_TTL)
+
+
+def cook_methods_key(ingredients: List[str]) -> str:
+    return stable_key(sorted(ingredients))
 
 class MongoService:
-    def __init__(self):
-        self.db = mongo_db
-        self.users_collection = self.db.users
+    @property
+    def db(self):
+        # Kết nối được tạo lười qua connection_manager
+        return get_mongo_db()
+
+    @property
+    def users_collection(self):
+        return self.db.users
 
-    def _convert_to_object_id(self, user_id: str) -> ObjectId:
+    @staticmethod
+    def _convert_to_object_id(user_id: str) -> ObjectId:
         """
         Chuyển đổi string ID thành ObjectId
         """
@@ -18,6 +148,7 @@ class MongoService:
             print(f"Error converting to ObjectId: {e}")
             raise ValueError(f"Invalid ObjectId format: {user_id}")
 
+    @traced("mongo")
     def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """
         Lấy thông tin user theo ID
@@ -33,6 +164,7 @@ class MongoService:
             print(f"Error getting user: {e}")
             return None
 
+    @traced("mongo")
     def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """
         Lấy thông tin user theo email
@@ -46,6 +178,7 @@ class MongoService:
             print(f"Error getting user by email: {e}")
             return None
 
+    @traced("mongo")
     def create_user(self, user_data: Dict[str, Any]) -> Optional[str]:
         """
         Tạo user mới
@@ -57,6 +190,7 @@ class MongoService:
             print(f"Error creating user: {e}")
             return None
 
+    @traced("mongo")
     def update_user(self, user_id: str, update_data: Dict[str, Any]) -> bool:
         """
         Cập nhật thông tin user
@@ -67,79 +201,37 @@ class MongoService:
                 {"_id": object_id},
                 {"$set": update_data}
             )
+            user_profile_cache.invalidate(user_id)
             return result.modified_count > 0
         except Exception as e:
             print(f"Error updating user: {e}")
             return False
 
+    @traced("mongo")
     def get_user_health_data(self, user_id: str) -> Optional[Dict[str, Any]]:
         """
         Lấy dữ liệu sức khỏe của user theo schema Next.js
+        (có cache theo request và cache TTL ngắn theo user_id)
         """
+        cached_user = user_profile_cache.get(user_id)
+        if cached_user:
+            return cached_user
         try:
             object_id = self._convert_to_object_id(user_id)
-            user = self.users_collection.find_one(
-                {"_id": object_id},
-                {
-                    "name": 1,
-                    "email": 1,
-                    "dateOfBirth": 1,
-                    "gender": 1,
-                    "weight": 1,
-                    "height": 1,
-                    "activityLevel": 1,
-                    "medicalConditions": 1,
-                    "allergies": 1,
-                    "lastUpdateDate": 1
-                }
-            )
+            user = self.users_collection.find_one({"_id": object_id}, USER_HEALTH_PROJECTION)
             
             if not user:
                 print(f"User not found with ID: {user_id}")
                 return None
-                
-            # Convert ObjectId to string
-            user["_id"] = str(user["_id"])
-            
-            # Tính tuổi từ dateOfBirth
-            if user.get("dateOfBirth"):
-                birth_date = user["dateOfBirth"]
-                if isinstance(birth_date, str):
-                    birth_date = datetime.fromisoformat(birth_date.replace('Z', '+00:00'))
-                elif isinstance(birth_date, datetime):
-                    pass
-                else:
-                    birth_date = datetime.fromisoformat(str(birth_date))
-                
-                today = datetime.now()
-                age = today.year - birth_date.year
-                if today.month < birth_date.month or (today.month == birth_date.month and today.day < birth_date.day):
-                    age -= 1
-                user["age"] = age
-            else:
-                user["age"] = None
-                print(f"Warning: No dateOfBirth for user {user_id}")
-            
-            # Sử dụng trực tiếp activityLevel string
-            user["activity_level"] = user.get("activityLevel", "sedentary")
-            
-            # Kiểm tra dữ liệu cần thiết
-            missing_fields = []
-            if not user.get("weight"):
-                missing_fields.append("weight")
-            if not user.get("height"):
-                missing_fields.append("height")
-            if not user.get("age"):
-                missing_fields.append("age (from dateOfBirth)")
-            
-            if missing_fields:
-                print(f"Missing required fields for user {user_id}: {missing_fields}")
             
+            user = prepare_user_health_data(user, user_id)
+            user_profile_cache.set(user_id, user)
             return user
         except Exception as e:
             print(f"Error getting user health data: {e}")
             return None
 
+    @traced("mongo")
     def update_user_health_data(self, user_id: str, health_data: Dict[str, Any]) -> bool:
         """
         Cập nhật dữ liệu sức khỏe của user
@@ -153,25 +245,37 @@ class MongoService:
                 {"_id": object_id},
                 {"$set": health_data}
             )
+            user_profile_cache.invalidate(user_id)
             return result.modified_count > 0
         except Exception as e:
             print(f"Error updating user health data: {e}")
             return False
 
-    def save_bmi_calculation(self, user_id: str, bmi_data: Dict[str, Any]) -> bool:
+    @staticmethod
+    def build_bmi_update(bmi_data: Dict[str, Any], input_hash: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Dữ liệu $set khi lưu kết quả BMI (dùng chung cho ghi trực tiếp và write-behind)
+        """
+        update_data = {
+            "bmi": bmi_data.get("bmi"),
+            "bmi_category": bmi_data.get("bmi_category"),
+            "bmr": bmi_data.get("bmr"),
+            "calorie_need_per_day": bmi_data.get("calorie_need_per_day"),
+            "last_bmi_calculation": bmi_data,
+            "lastUpdateDate": datetime.now()
+        }
+        if input_hash:
+            update_data["bmi_input_hash"] = input_hash
+        return update_data
+
+    @traced("mongo")
+    def save_bmi_calculation(self, user_id: str, bmi_data: Dict[str, Any], input_hash: Optional[str] = None) -> bool:
         """
         Lưu kết quả tính BMI vào user profile
         """
         try:
             object_id = self._convert_to_object_id(user_id)
-            update_data = {
-                "bmi": bmi_data.get("bmi"),
-                "bmi_category": bmi_data.get("bmi_category"),
-                "bmr": bmi_data.get("bmr"),
-                "calorie_need_per_day": bmi_data.get("calorie_need_per_day"),
-                "last_bmi_calculation": bmi_data,
-                "lastUpdateDate": datetime.now()
-            }
+            update_data = self.build_bmi_update(bmi_data, input_hash)
             
             result = self.users_collection.update_one(
                 {"_id": object_id},
@@ -182,6 +286,7 @@ class MongoService:
             print(f"Error saving BMI calculation: {e}")
             return False
 
+    @traced("mongo")
     def get_all_users(self) -> list:
         """
         Lấy tất cả users (cho mục đích test)
@@ -202,25 +307,31 @@ class MongoService:
         """Lấy collection dishes"""
         return self.db.dishes
     
+    @traced("mongo")
     def create_dish(self, dish_data: Dict[str, Any]) -> Optional[str]:
         """
         Tạo món ăn mới
         """
         try:
             dishes_collection = self.get_dishes_collection()
+            if "ingredients" in dish_data:
+                dish_data["ingredient_keys"] = build_ingredient_keys(dish_data["ingredients"])
+            dish_data["lastUpdateDate"] = datetime.now()
             result = dishes_collection.insert_one(dish_data)
+            cook_methods_cache.clear()
             return str(result.inserted_id)
         except Exception as e:
             print(f"Error creating dish: {e}")
             return None
     
-    def get_dish_by_id(self, dish_id: str) -> Optional[Dict[str, Any]]:
+    @traced("mongo")
+    def get_dish_by_id(self, dish_id: str, projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
         """
-        Lấy thông tin món ăn theo ID
+        Lấy thông tin món ăn theo ID (projection để chỉ lấy các trường cần dùng)
         """
         try:
             dishes_collection = self.get_dishes_collection()
-            dish = dishes_collection.find_one({"_id": dish_id})
+            dish = dishes_collection.find_one({"_id": dish_id}, projection)
             if dish:
                 dish["_id"] = str(dish["_id"])
             return dish
@@ -228,13 +339,14 @@ class MongoService:
             print(f"Error getting dish: {e}")
             return None
     
-    def get_all_dishes(self) -> List[Dict[str, Any]]:
+    @traced("mongo")
+    def get_all_dishes(self, projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Lấy tất cả món ăn
         """
         try:
             dishes_collection = self.get_dishes_collection()
-            dishes = list(dishes_collection.find({}))
+            dishes = list(dishes_collection.find({}, projection))
             for dish in dishes:
                 dish["_id"] = str(dish["_id"])
             return dishes
@@ -266,13 +378,15 @@ class MongoService:
         
         return filtered_dishes
     
-    def get_dishes_by_ids(self, dish_ids: List[str]) -> List[Dict[str, Any]]:
+    @traced("mongo")
+    def get_dishes_by_ids(self, dish_ids: List[str], projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Lấy danh sách món ăn theo danh sách ID
+        (các node nên dùng dish_store để lấy DishRecord gọn đã cache)
         """
         try:
             dishes_collection = self.get_dishes_collection()
-            dishes = list(dishes_collection.find({"_id": {"$in": dish_ids}}))
+            dishes = list(dishes_collection.find({"_id": {"$in": dish_ids}}, projection))
             for dish in dishes:
                 dish["_id"] = str(dish["_id"])
             return dishes
@@ -280,21 +394,29 @@ class MongoService:
             print(f"Error getting dishes by IDs: {e}")
             return []
     
+    @traced("mongo")
     def update_dish(self, dish_id: str, update_data: Dict[str, Any]) -> bool:
         """
         Cập nhật thông tin món ăn
         """
         try:
             dishes_collection = self.get_dishes_collection()
+            if "ingredients" in update_data:
+                update_data["ingredient_keys"] = build_ingredient_keys(update_data["ingredients"])
+            # lastUpdateDate để cache_watcher (chế độ polling) phát hiện thay đổi
+            update_data["lastUpdateDate"] = datetime.now()
             result = dishes_collection.update_one(
                 {"_id": dish_id},
                 {"$set": update_data}
             )
+            dish_store.invalidate(dish_id)
+            cook_methods_cache.clear()
             return result.modified_count > 0
         except Exception as e:
             print(f"Error updating dish: {e}")
             return False
     
+    @traced("mongo")
     def delete_dish(self, dish_id: str) -> bool:
         """
         Xóa món ăn
@@ -302,11 +424,14 @@ class MongoService:
         try:
             dishes_collection = self.get_dishes_collection()
             result = dishes_collection.delete_one({"_id": dish_id})
+            dish_store.invalidate(dish_id)
+            cook_methods_cache.clear()
             return result.deleted_count > 0
         except Exception as e:
             print(f"Error deleting dish: {e}")
             return False
 
+    @traced("mongo")
     def get_cook_methods_by_ingredients(self, ingredients: List[str]) -> List[str]:
         """
         Lấy danh sách các phương pháp chế biến duy nhất từ các món ăn
@@ -314,68 +439,79 @@ class MongoService:
         """
         if not ingredients:
             return []
+        cache_key = cook_methods_key(ingredients)
+        cached = cook_methods_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
         try:
             dishes_collection = self.get_dishes_collection()
-            pipeline = [
-                {
-                    "$match": {
-                        "ingredients": {"$in": ingredients}
-                    }
-                },
-                {
-                    "$group": {
-                        "_id": "$cook_method"
-                    }
-                },
-                {
-                    "$project": {
-                        "cook_method": "$_id",
-                        "_id": 0
-                    }
-                }
-            ]
+            pipeline = build_cook_methods_pipeline(ingredients)
             results = list(dishes_collection.aggregate(pipeline))
-            return [result["cook_method"] for result in results if result.get("cook_method")]
+            cook_methods = [result["cook_method"] for result in results if result.get("cook_method")]
+            cook_methods_cache.set(cache_key, cook_methods)
+            return cook_methods
         except Exception as e:
             print(f"Error getting cook methods by ingredients: {e}")
             return []
 
+    @traced("mongo")
     def filter_dishes_by_ingredients(self, dish_ids: List[str], ingredients: List[str]) -> List[str]:
         """
         Lọc một danh sách các dish_ids, chỉ giữ lại những món ăn
-        chứa ít nhất một trong các nguyên liệu được cung cấp (sử dụng regex).
+        chứa ít nhất một trong các nguyên liệu được cung cấp
+        (so khớp chính xác trên trường multikey ingredient_keys đã chuẩn hóa).
         """
         if not ingredients:
             return dish_ids # Nếu không chọn nguyên liệu nào, không cần lọc
         try:
             dishes_collection = self.get_dishes_collection()
-
-            # Tạo một biểu thức regex để tìm bất kỳ nguyên liệu nào trong danh sách, không phân biệt chữ hoa/thường
-            # Ví dụ: ingredients = ["Thịt heo", "Cà tím"] -> regex = /Thịt heo|Cà tím/i
-            regex_pattern = "|".join(ingredients)
-
-            query = {
-                "neo4j_id": {"$in": dish_ids},
-                "ingredients": {"$regex": regex_pattern, "$options": "i"}
-            }
-            projection = {"neo4j_id": 1}
+            query = build_dishes_by_ingredients_query(dish_ids, ingredients)
 
             print(f"[DEBUG] MongoDB Query in filter_dishes_by_ingredients: {query}")
 
-            results = list(dishes_collection.find(query, projection))
+            results = list(dishes_collection.find(query, DISH_ID_PROJECTION))
             return [result["neo4j_id"] for result in results]
         except Exception as e:
             print(f"Error filtering dishes by ingredients: {e}")
             return []
 
+    @traced("mongo")
+    def backfill_ingredient_keys(self, batch_size: int = 500) -> int:
+        """
+        Tính lại ingredient_keys cho các món ăn đã có trong DB và tạo index multikey.
+        Trả về số món ăn đã cập nhật.
+        """
+        dishes_collection = self.get_dishes_collection()
+        updated = 0
+        operations = []
+        for dish in dishes_collection.find({}, {"ingredients": 1, "ingredient_keys": 1}):
+            keys = build_ingredient_keys(dish.get("ingredients", []))
+            if dish.get("ingredient_keys") == keys:
+                continue
+            operations.append(UpdateOne({"_id": dish["_id"]}, {"$set": {"ingredient_keys": keys}}))
+            if len(operations) >= batch_size:
+                updated += dishes_collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += dishes_collection.bulk_write(operations, ordered=False).modified_count
+        dishes_collection.create_index("ingredient_keys")
+        print(f"✅ Đã cập nhật ingredient_keys cho {updated} món ăn")
+        return updated
+
+    @traced("mongo")
     def get_all_ingredients(self) -> List[str]:
         """
         Lấy tất cả các nguyên liệu từ collection 'ingredients'
         """
+        cached = ingredient_cache.get(ALL_INGREDIENTS_KEY)
+        if cached is not None:
+            return list(cached)
         try:
             ingredients_collection = self.db.ingredients
-            ingredients = list(ingredients_collection.find({}, {"name": 1, "_id": 0}))
-            return [ingredient["name"] for ingredient in ingredients]
+            ingredients = list(ingredients_collection.find({}, INGREDIENT_NAME_PROJECTION))
+            names = [ingredient["name"] for ingredient in ingredients]
+            ingredient_cache.set(ALL_INGREDIENTS_KEY, names)
+            return list(names)
         except Exception as e:
             print(f"Error getting all ingredients: {e}")
             return []
@@ -0,0 +1,76 @@
+import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from app.config import USER_PROFILE_CACHE_TTL
+from app.services.cache_service import TieredCache
+
+# Memo theo request: trong cùng một request, mọi node dùng chung một lần đọc user
+_request_memo: ContextVar[Optional[Dict[str, Dict[str, Any]]]] = ContextVar("user_profile_request_memo", default=None)
+
+
+@contextmanager
+def request_scope():
+    """Mở một phạm vi request, các lần đọc user trong phạm vi này dùng chung kết quả"""
+    token = _request_memo.set({})
+    try:
+        yield
+    finally:
+        _request_memo.reset(token)
+
+
+class UserProfileCache:
+    """
+    Cache hồ sơ sức khỏe của user:
+    - Memo theo request (contextvar)
+    - Cache process/Redis TTL ngắn, mỗi entry ghi kèm lastUpdateDate của document
+    Được xóa chủ động khi user cập nhật dữ liệu sức khỏe.
+    """
+
+    def __init__(self, ttl: int = USER_PROFILE_CACHE_TTL):
+        self.enabled = ttl > 0
+        self._cache = TieredCache("user_profile", default_ttl=max(ttl, 1), max_entries=4096)
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        memo = _request_memo.get()
+        if memo is not None and user_id in memo:
+            return copy.deepcopy(memo[user_id])
+        if not self.enabled:
+            return None
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return None
+        if memo is not None:
+            memo[user_id] = entry["user"]
+        return copy.deepcopy(entry["user"])
+
+    def set(self, user_id: str, user: Dict[str, Any]):
+        memo = _request_memo.get()
+        if memo is not None:
+            memo[user_id] = copy.deepcopy(user)
+        if self.enabled:
+            self._cache.set(user_id, {"lastUpdateDate": user.get("lastUpdateDate"), "user": copy.deepcopy(user)})
+
+    def patch(self, user_id: str, fields: Dict[str, Any]):
+        """Cập nhật vài field trên bản đang cache (không tạo entry mới từ dữ liệu có thể đã cũ)"""
+        memo = _request_memo.get()
+        if memo is not None and user_id in memo:
+            memo[user_id] = {**memo[user_id], **fields}
+        entry = self._cache.get(user_id) if self.enabled else None
+        if entry is not None:
+            self._cache.set(user_id, {**entry, "user": {**entry["user"], **fields}})
+
+    def get_last_update_date(self, user_id: str) -> Any:
+        """lastUpdateDate của bản đang cache (None nếu không có)"""
+        entry = self._cache.get(user_id) if self.enabled else None
+        return entry["lastUpdateDate"] if entry else None
+
+    def invalidate(self, user_id: str):
+        memo = _request_memo.get()
+        if memo is not None:
+            memo.pop(user_id, None)
+        self._cache.delete(user_id)
+
+
+user_profile_cache = UserProfileCache()
@@ -0,0 +1,127 @@
+import threading
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional
+
+
+class Interner:
+    """
+    Bảng intern: gán cho mỗi giá trị (dish_id, tên phương pháp nấu, ...) một vị trí bit cố định
+    trong process. Tập hợp các giá trị được biểu diễn bằng một số nguyên Python (bitset),
+    nhờ đó giao/hợp/loại trừ là các phép toán bit trên từng word thay vì dựng set mỗi request.
+
+    Lưu ý: vị trí bit chỉ có ý nghĩa trong process hiện tại, không lưu bitset ra ngoài process.
+    """
+
+    def __init__(self):
+        self._index: Dict[Hashable, int] = {}
+        self._values: List[Hashable] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def index_of(self, value: Hashable) -> int:
+        """Lấy vị trí bit của giá trị, tự cấp phát nếu chưa có"""
+        index = self._index.get(value)
+        if index is None:
+            with self._lock:
+                index = self._index.get(value)
+                if index is None:
+                    index = len(self._values)
+                    self._values.append(value)
+                    self._index[value] = index
+        return index
+
+    def bit(self, value: Hashable) -> int:
+        return 1 << self.index_of(value)
+
+    def to_bitset(self, values: Iterable[Hashable]) -> int:
+        """Chuyển một tập giá trị thành bitset (bỏ qua giá trị rỗng)"""
+        bits = 0
+        for value in values:
+            if value:
+                bits |= 1 << self.index_of(value)
+        return bits
+
+    def contains(self, bits: int, value: Hashable) -> bool:
+        """Kiểm tra giá trị có thuộc bitset không (không cấp phát vị trí mới)"""
+        index = self._index.get(value)
+        return index is not None and bool(bits >> index & 1)
+
+    def values_of(self, bits: int) -> List[Hashable]:
+        """Chuyển bitset về danh sách giá trị (theo thứ tự intern)"""
+        return [self._values[i] for i in iter_bits(bits)]
+
+
+def iter_bits(bits: int) -> Iterator[int]:
+    """Duyệt các vị trí bit đang bật của bitset"""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def count(bits: int) -> int:
+    """Số phần tử trong bitset"""
+    return bits.bit_count()
+
+
+# Bảng intern dùng chung trong ứng dụng
+dish_ids = Interner()
+cook_methods = Interner()
+
+
+class ExclusionSet:
+    """
+    Tập các món đã gợi ý trong một session: bitset dish_id (bảng intern dish_ids) + set tên món.
+    Kiểm tra/loại trừ là O(1) mỗi món, không phụ thuộc độ dài hội thoại.
+    Khi lưu session chỉ lưu danh sách id/tên (ids(), names) vì vị trí bit chỉ có nghĩa trong process.
+    """
+
+    __slots__ = ("bits", "names")
+
+    def __init__(self, ids: Iterable[Hashable] = (), names: Iterable[str] = ()):
+        self.bits = dish_ids.to_bitset(ids)
+        self.names = {name for name in names if name}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "ExclusionSet":
+        return cls(state.get("previous_food_ids") or [], state.get("previous_food_names") or [])
+
+    @classmethod
+    def coerce(cls, excluded: Any) -> "ExclusionSet":
+        """Nhận ExclusionSet, danh sách id hoặc None"""
+        if isinstance(excluded, cls):
+            return excluded
+        return cls(excluded or [])
+
+    def __bool__(self) -> bool:
+        return bool(self.bits or self.names)
+
+    def __len__(self) -> int:
+        return count(self.bits)
+
+    def add(self, dish_id: Optional[Hashable] = None, name: Optional[str] = None):
+        if dish_id:
+            self.bits |= dish_ids.bit(dish_id)
+        if name:
+            self.names.add(name)
+
+    def contains_id(self, dish_id: Optional[Hashable]) -> bool:
+        return bool(dish_id) and dish_ids.contains(self.bits, dish_id)
+
+    def excludes(self, food: Dict[str, Any]) -> bool:
+        """Món bị loại nếu trùng id, dish_id hoặc tên với món đã gợi ý"""
+        return (
+            self.contains_id(food.get("id"))
+            or self.contains_id(food.get("dish_id"))
+            or (bool(food.get("name")) and food.get("name") in self.names)
+        )
+
+    def filter(self, foods: List[Dict[str, Any]], key: str = "dish_id") -> List[Dict[str, Any]]:
+        """Bỏ các món có id đã gợi ý (trả về nguyên list nếu không có gì để loại)"""
+        if not self.bits:
+            return foods
+        return [food for food in foods if not self.contains_id(food.get(key))]
+
+    def ids(self) -> List[Hashable]:
+        return dish_ids.values_of(self.bits)
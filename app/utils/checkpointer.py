@@ -0,0 +1,268 @@
+"""
+Checkpointer cho LangGraph workflow (thread_id = session_id).
+
+- "session" (mặc định): SessionCheckpointSaver lưu qua session backend (SESSION_BACKEND):
+  redis khi có REDIS_URL / SESSION_REDIS_URL (dùng chung giữa các worker, còn sau khi restart),
+  ngược lại memory (giới hạn số session + số byte, sweeper xóa session hết hạn)
+- "sqlite": AsyncSqliteSaver (cần langgraph-checkpoint-sqlite), dùng chung giữa các worker trên một máy
+
+Backend sqlite mở kết nối trong event loop nên được khởi tạo ở lifespan (open_checkpointer).
+"""
+import asyncio
+from contextlib import AsyncExitStack
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+    writes_sort_key,
+)
+
+from app.config import CHECKPOINT_BACKEND, CHECKPOINT_SQLITE_PATH, CHECKPOINT_TTL_MINUTES
+from app.utils.session_schema import PERSISTED_FIELDS, decode_session, encode_session, to_persisted
+from app.utils.session_store import SessionBackend, get_session_backend
+
+class SessionCheckpointSaver(BaseCheckpointSaver):
+    """
+    Checkpointer lưu trên SessionBackend, mỗi thread (và mỗi checkpoint_ns con) là một session.
+
+    Chỉ giữ checkpoint mới nhất của mỗi thread cùng các pending write của nó: đủ để dừng chờ lựa chọn,
+    tiếp tục và hỏi tiếp trong session, không có lịch sử checkpoint (get_state_history, time travel).
+    Channel state ngoài `fields` (mặc định session_schema.PERSISTED_FIELDS) bị bỏ trước khi lưu,
+    None để giữ toàn bộ channel_values.
+
+    Checkpoint là payload của session (put ghi đè), pending write là log của session (put_writes chỉ
+    thêm vào cuối, mỗi bản ghi mang id checkpoint của nó). Không có bước đọc - sửa - ghi nên nhiều worker
+    dùng chung Redis ghi cùng thread không làm mất dữ liệu của nhau, kể cả khi LangGraph gọi put và
+    put_writes của cùng checkpoint song song lúc thoát (durability="exit").
+    """
+
+    def __init__(self, backend: SessionBackend, ttl: int = CHECKPOINT_TTL_MINUTES * 60, serde=None,
+                 fields: Optional[frozenset] = PERSISTED_FIELDS):
+        super().__init__(serde=serde)
+        self.backend = backend
+        self.ttl = ttl
+        self.fields = fields
+
+    @staticmethod
+    def _session_id(thread_id: str, checkpoint_ns: str) -> str:
+        # Graph không có subgraph nên thực tế chỉ có checkpoint_ns gốc ("")
+        return f"{thread_id}:{checkpoint_ns}" if checkpoint_ns else thread_id
+
+    def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[Dict[str, Any]]:
+        """Checkpoint mới nhất của thread kèm pending write của nó, None nếu không có / hết hạn / payload hỏng"""
+        session_id = self._session_id(thread_id, checkpoint_ns)
+        payload, log = self.backend.load_with_log(session_id)
+        if payload is None:
+            return None
+        try:
+            entry = decode_session(payload)
+            records = [(item, decode_session(item)) for item in log]
+        except Exception as e:
+            print(f"WARNING: Bỏ qua checkpoint không hợp lệ của session {session_id}: {e}")
+            return None
+        writes: Dict[Tuple[str, int], list] = {}
+        stale = []
+        for item, (checkpoint_id, task_id, channel, type_, value, task_path, idx) in records:
+            if checkpoint_id != entry["id"]:
+                # Write của checkpoint cũ hơn không còn dùng đến (write của checkpoint mới hơn được giữ:
+                # put của nó đang chạy song song)
+                if checkpoint_id < entry["id"]:
+                    stale.append(item)
+                continue
+            # Write thường giữ bản đầu tiên, write đặc biệt (interrupt, resume, lỗi) giữ bản mới nhất
+            if idx < 0 or (task_id, idx) not in writes:
+                writes[(task_id, idx)] = [task_id, channel, type_, value, task_path, idx]
+        if stale:
+            self.backend.remove_from_log(session_id, stale)
+        entry["writes"] = list(writes.values())
+        return entry
+
+    @staticmethod
+    def _config(thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> RunnableConfig:
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, entry: Dict[str, Any]) -> CheckpointTuple:
+        writes = sorted(entry["writes"], key=lambda w: writes_sort_key(w[4], w[0], w[5]))
+        return CheckpointTuple(
+            config=self._config(thread_id, checkpoint_ns, entry["id"]),
+            checkpoint=self.serde.loads_typed(tuple(entry["checkpoint"])),
+            metadata=self.serde.loads_typed(tuple(entry["metadata"])),
+            parent_config=self._config(thread_id, checkpoint_ns, entry["parent_id"]) if entry["parent_id"] else None,
+            pending_writes=[(task_id, channel, self.serde.loads_typed((type_, value))) for task_id, channel, type_, value, _, _ in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        entry = self._load(thread_id, checkpoint_ns)
+        if entry is None:
+            return None
+        # Checkpoint cũ hơn checkpoint mới nhất không được giữ lại
+        checkpoint_id = get_checkpoint_id(config)
+        if checkpoint_id and checkpoint_id != entry["id"]:
+            return None
+        return self._to_tuple(thread_id, checkpoint_ns, entry)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        """Checkpoint mới nhất của thread trong checkpoint_ns của config (backend không liệt kê được mọi session nên cần config)"""
+        if config is None or limit == 0:
+            return
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns") or ""
+        entry = self._load(thread_id, checkpoint_ns)
+        if entry is None:
+            return
+        before_id = get_checkpoint_id(before) if before else None
+        if before_id and entry["id"] >= before_id:
+            return
+        checkpoint_tuple = self._to_tuple(thread_id, checkpoint_ns, entry)
+        if filter and any(checkpoint_tuple.metadata.get(k) != v for k, v in filter.items()):
+            return
+        yield checkpoint_tuple
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint = {**checkpoint, "channel_values": to_persisted(checkpoint["channel_values"], self.fields)}
+        entry = {
+            "id": checkpoint["id"],
+            "parent_id": config["configurable"].get("checkpoint_id"),
+            "checkpoint": list(self.serde.dumps_typed(checkpoint)),
+            "metadata": list(self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))),
+        }
+        # Pending write của checkpoint trước nằm lại trong log, bị bỏ qua và dọn ở lần đọc sau
+        self.backend.save(self._session_id(thread_id, checkpoint_ns), encode_session(entry), self.ttl)
+        return self._config(thread_id, checkpoint_ns, checkpoint["id"])
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        records = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, payload = self.serde.dumps_typed(value)
+            records.append(encode_session([checkpoint_id, task_id, channel, type_, payload, task_path, WRITES_IDX_MAP.get(channel, idx)]))
+        self.backend.append(self._session_id(thread_id, checkpoint_ns), records, self.ttl)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.backend.delete(thread_id)
+
+    # Backend đồng bộ (redis-py) nên bản async chạy ở thread, không chặn event loop
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.backend.stats()
+        return {**stats, "threads": stats.get("sessions")}
+
+
+_checkpointer: Optional[BaseCheckpointSaver] = None
+_exit_stack: Optional[AsyncExitStack] = None
+_backend_name = "session"
+
+
+async def open_checkpointer(name: str = CHECKPOINT_BACKEND) -> BaseCheckpointSaver:
+    """Tạo checkpointer theo cấu hình (gọi một lần ở lifespan startup)"""
+    global _checkpointer, _exit_stack, _backend_name
+    if _checkpointer is not None:
+        return _checkpointer
+    stack = AsyncExitStack()
+    if name == "sqlite":
+        try:
+            from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        except ImportError as e:
+            raise RuntimeError("CHECKPOINT_BACKEND=sqlite cần cài langgraph-checkpoint-sqlite") from e
+        saver = await stack.enter_async_context(AsyncSqliteSaver.from_conn_string(CHECKPOINT_SQLITE_PATH))
+        await saver.setup()
+    else:
+        name = "session"
+        saver = SessionCheckpointSaver(get_session_backend())
+    _checkpointer, _exit_stack, _backend_name = saver, stack, name
+    print(f"[DEBUG] Checkpoint backend: {name}")
+    return saver
+
+
+def get_checkpointer() -> BaseCheckpointSaver:
+    """Checkpointer hiện tại, chưa mở ở lifespan (script, test) thì lưu qua session backend"""
+    global _checkpointer
+    if _checkpointer is None:
+        _checkpointer = SessionCheckpointSaver(get_session_backend())
+    return _checkpointer
+
+
+def get_checkpoint_stats() -> Dict[str, Any]:
+    """Gauge session đang giữ (session backend memory), backend khác chỉ trả về tên"""
+    checkpointer = get_checkpointer()
+    if isinstance(checkpointer, SessionCheckpointSaver):
+        return checkpointer.stats()
+    return {"backend": _backend_name}
+
+
+async def close_checkpointer():
+    global _checkpointer, _exit_stack
+    if isinstance(_checkpointer, SessionCheckpointSaver):
+        _checkpointer.backend.close()
+    if _exit_stack is not None:
+        await _exit_stack.aclose()
+    _checkpointer, _exit_stack = None, None
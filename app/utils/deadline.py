@@ -0,0 +1,65 @@
+"""
+Deadline theo request: route đặt tổng thời gian cho phép, các node lấy timeout từ phần còn lại.
+
+Deadline nằm trong contextvar (như request_scope của user_profile_cache) nên đi theo
+ainvoke vào mọi node, kể cả node sync chạy ở thread pool, và không bị lưu vào checkpoint.
+Khi còn ít thời gian, node bỏ lời gọi LLM và dùng đường xử lý cục bộ (degrade).
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from app.config import LLM_MIN_BUDGET_SECONDS
+from app.services.metrics import registry
+
+# Thời điểm hết hạn theo time.monotonic(), None = không giới hạn
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+DEGRADED = registry.counter(
+    "workflow_degraded_total", "Số lần node bỏ LLM để kịp deadline", ("node", "reason")
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Hết thời gian của request (trước hoặc trong lúc gọi LLM)"""
+
+
+@contextmanager
+def request_deadline(seconds: Optional[float]):
+    """Mở phạm vi request với deadline sau `seconds` giây (None hoặc <= 0: không giới hạn)"""
+    token = _deadline.set(time.monotonic() + seconds if seconds and seconds > 0 else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Số giây còn lại, None nếu request không có deadline"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def has_budget(min_seconds: float = LLM_MIN_BUDGET_SECONDS) -> bool:
+    budget = remaining()
+    return budget is None or budget >= min_seconds
+
+
+def timeout_for(default: float) -> float:
+    """Timeout cho một lời gọi: không vượt default và phần thời gian còn lại của request"""
+    budget = remaining()
+    if budget is None:
+        return default
+    if budget <= 0:
+        raise DeadlineExceeded("Request đã hết thời gian")
+    return min(default, budget)
+
+
+def degrade(node: str, reason: str = "deadline"):
+    """Ghi nhận node chuyển sang đường xử lý không dùng LLM"""
+    DEGRADED.inc(node=node, reason=reason)
+    budget = remaining()
+    print(f"WARNING: [{node}] degrade ({reason}), còn {budget:.2f}s" if budget is not None else f"WARNING: [{node}] degrade ({reason})")
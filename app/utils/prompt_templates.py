@@ -220,4 +220,137 @@ YÊU CẦU:
 15. Nếu món ăn có chứa nguyên liệu gây dị ứng, hãy đề xuất cách thay thế hoặc điều chỉnh để an toàn
 """
     
-    return prompt
\ No newline at end of file
+    return prompt
+
+# Dữ liệu cho câu trả lời dựng sẵn (không gọi LLM), cùng đầu vào với get_natural_response_prompt
+NO_CONDITION_VALUES = {"", "không có", "không bệnh", "không có bệnh", "bình thường", "khỏe mạnh"}
+
+BMI_ADVICE = {
+    "gầy": "bạn đang hơi gầy nên nên ăn đủ bữa và bổ sung thêm đạm",
+    "thiếu cân": "bạn đang hơi gầy nên nên ăn đủ bữa và bổ sung thêm đạm",
+    "bình thường": "cân nặng của bạn đang ổn, chỉ cần giữ khẩu phần cân đối",
+    "thừa cân": "bạn nên ưu tiên món ít dầu mỡ và ăn thêm rau",
+    "béo phì": "bạn nên ưu tiên món luộc, hấp, hạn chế dầu mỡ và tinh bột",
+}
+
+RESPONSE_TEMPLATES = {
+    "intro_no_condition": "Chào {name}! Với thể trạng hiện tại, mình gợi ý cho bạn {count} món sau:",
+    "intro_single_condition": "Chào {name}! Vì bạn đang có {condition}, mình đã chọn {count} món phù hợp với tình trạng này:",
+    "intro_multiple_conditions": "Chào {name}! Mình đã chọn {count} món phù hợp đồng thời với {conditions}:",
+    "food_line": "{index}. {name}",
+    "cook_method": " ({cook_method})",
+    "bmi": "Về cân nặng, {advice}.",
+    "context": "Những món này cũng hợp với thời tiết {weather} vào buổi {time_of_day}.",
+    "allergy": "Lưu ý: bạn bị dị ứng với {allergies}, hãy kiểm tra kỹ nguyên liệu trước khi nấu.",
+    "closing": "Chúc bạn ngon miệng!",
+    "no_foods": "Chào {name}! Hiện mình chưa tìm thấy món nào phù hợp với các tiêu chí hiện tại. Bạn thử chọn cách chế biến hoặc nguyên liệu khác nhé.",
+}
+
+
+def _real_values(values: list) -> list:
+    return [value for value in values or [] if str(value).lower().strip() not in NO_CONDITION_VALUES]
+
+
+def _bmi_advice(bmi_category: str) -> str:
+    category = (bmi_category or "").lower()
+    for key, advice in BMI_ADVICE.items():
+        if category.startswith(key):
+            return advice
+    return ""
+
+
+def build_template_response(question: str, user_info: dict, food_info: list, cooking_methods: list, weather: str, time_of_day: str, topic_classification: str, constraints_info: dict = None) -> str:
+    """
+    Câu trả lời tự nhiên dựng từ RESPONSE_TEMPLATES (không gọi LLM), cùng tham số với get_natural_response_prompt.
+    Bao các trường hợp: không bệnh / một bệnh / nhiều bệnh, dị ứng, không có món.
+    """
+    templates = RESPONSE_TEMPLATES
+    name = user_info.get("name") or "bạn"
+    if not food_info:
+        return templates["no_foods"].format(name=name)
+
+    foods = food_info[:10]
+    conditions = _real_values(user_info.get("medical_conditions"))
+    if not conditions:
+        intro = templates["intro_no_condition"].format(name=name, count=len(foods))
+    elif len(conditions) == 1:
+        intro = templates["intro_single_condition"].format(name=name, count=len(foods), condition=conditions[0])
+    else:
+        intro = templates["intro_multiple_conditions"].format(name=name, count=len(foods), conditions=", ".join(conditions))
+
+    lines = [intro]
+    for index, food in enumerate(foods, 1):
+        line = templates["food_line"].format(index=index, name=food.get("name", ""))
+        if food.get("cook_method"):
+            line += templates["cook_method"].format(cook_method=food["cook_method"])
+        lines.append(line)
+
+    advice = _bmi_advice(user_info.get("bmi_category"))
+    if advice:
+        lines.append(templates["bmi"].format(advice=advice))
+    if weather and time_of_day:
+        lines.append(templates["context"].format(weather=weather, time_of_day=time_of_day))
+    allergies = _real_values(user_info.get("allergies"))
+    if allergies:
+        lines.append(templates["allergy"].format(allergies=", ".join(allergies)))
+    lines.append(templates["closing"])
+    return "\n".join(lines)
+
+
+# Structured output cho chế độ combined: một lần gọi trả về cả thứ tự món và câu trả lời
+COMBINED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "rerank_and_answer",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "ranked_ids": {"type": "array", "items": {"type": "string"}},
+                "answer": {"type": "string"},
+            },
+            "required": ["ranked_ids", "answer"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def format_food_lines(foods: list) -> str:
+    """Danh sách món gọn cho prompt: mỗi món một dòng "- id | tên | cách chế biến | chế độ ăn" """
+    return "\n".join(
+        f"- {food['id']} | {food['name']} | {food.get('cook_method') or '-'} | {food.get('diet') or '-'}"
+        for food in foods
+    )
+
+
+def get_combined_rerank_prompt(data: dict) -> str:
+    """
+    Prompt cho chế độ combined: lọc + rerank danh sách món và viết câu trả lời tự nhiên trong cùng một lần gọi.
+    data: user_name, user_question, bmi_category, conditions_text, allergies_text, cooking_text,
+    foods (id, name, cook_method, diet; đã bỏ các món gợi ý trước đó), weather, time_of_day
+    """
+    foods_list = format_food_lines(data.get("foods", []))
+    context_text = ""
+    if data.get("weather") and data.get("time_of_day"):
+        context_text = f"\n- Thời tiết: {data['weather']}, thời gian: {data['time_of_day']}"
+
+    return f"""Bạn là chuyên gia dinh dưỡng và ẩm thực Việt Nam. Chọn và sắp xếp món ăn phù hợp nhất từ danh sách cho trước, sau đó viết câu trả lời cho người dùng.
+
+**Thông tin người dùng:**
+- Tên: {data.get("user_name", "Unknown")}
+- Câu hỏi: "{data.get("user_question", "")}"
+- Phân loại BMI: {data.get("bmi_category", "")}
+- Tình trạng bệnh: {data.get("conditions_text", "")}
+- Dị ứng: {data.get("allergies_text", "")}
+- Cách chế biến ưa thích: {data.get("cooking_text", "")}{context_text}
+
+**Danh sách món ăn (id | tên | cách chế biến | chế độ ăn):**
+{foods_list}
+
+**YÊU CẦU:**
+1. Nếu câu hỏi yêu cầu một loại món (chay, tráng miệng, món chính, soup, salad...), chỉ giữ các món thuộc loại đó (món chay không có thịt, cá, hải sản, trứng). Nếu không, giữ toàn bộ danh sách.
+2. Sắp xếp theo: yêu cầu trong câu hỏi, phù hợp bệnh ({data.get("conditions_text", "")}), cách chế biến ({data.get("cooking_text", "")}), cân bằng dinh dưỡng. Bỏ món không phù hợp. Nếu người dùng chỉ định một món cụ thể, chỉ trả về một món.
+3. "ranked_ids": danh sách id (đúng như trong danh sách trên) theo thứ tự phù hợp nhất.
+4. "answer": câu trả lời tiếng Việt tự nhiên, thân thiện, 2-4 câu, nhắc tên các món đầu danh sách và vì sao phù hợp (BMI, bệnh lý, dị ứng, thời tiết nếu có). Chỉ dùng món trong danh sách. Nếu không có món phù hợp (ví dụ do dị ứng), để ranked_ids rỗng, xin lỗi và giải thích lý do trong answer.
+"""
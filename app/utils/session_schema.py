@@ -0,0 +1,70 @@
+"""
+Định dạng payload session: checkpoint LangGraph mới nhất của một thread (xem checkpointer.SessionCheckpointSaver).
+
+Payload session là entry của checkpoint gồm id checkpoint, id checkpoint cha, checkpoint và metadata đã
+serialize bằng serde của LangGraph (type, bytes). Mỗi pending write là một bản ghi riêng trong log của
+session: [id checkpoint, task_id, channel, type, bytes, task_path, idx].
+
+Checkpoint chỉ giữ các channel state trong PERSISTED_FIELDS (cùng các channel nội bộ của LangGraph).
+Dữ liệu dẫn xuất (user_data, neo4j_result, filtered_result, aggregated_result, prompt, analysis_steps,
+final_result...) không được lưu: user_data / bmi_result được đọc lại từ user_profile_cache khi tiếp tục
+(xem engine._load_profile), kết quả query, lọc và prompt được graph tính lại.
+
+Định dạng: MAGIC (2 byte) + version (1 byte) + zlib(msgpack(value))
+"""
+import zlib
+from typing import Any, Dict, Iterable, Optional
+
+import msgpack
+
+# Version 1: state rút gọn của session_store cũ, version 2: dict checkpoint_ns -> entry kèm pending write,
+# đều không còn giải mã được
+SESSION_SCHEMA_VERSION = 3
+_MAGIC = b"WS"
+
+# Các field state được lưu trong session, thêm field mới ở đây (và tăng version nếu đổi ý nghĩa field cũ)
+PERSISTED_FIELDS = frozenset({
+    "user_id",
+    "session_id",
+    "question",
+    "topic_classification",
+    "weather",
+    "time_of_day",
+    "ignore_context_filter",
+    "selected_ingredients",
+    "selected_cooking_methods",
+    "selected_emotion",
+    "previous_food_ids",
+    "previous_food_names",
+    "analysis_shown",
+    "context_analysis_shown",
+    "cooking_request_warning",
+    "step",
+})
+
+
+def _is_internal_channel(name: str) -> bool:
+    """Channel của LangGraph (__start__, branch:to:<node>...), cần để biết node nào chạy tiếp khi resume"""
+    return name.startswith("__") or ":" in name
+
+
+def to_persisted(channel_values: Dict[str, Any], fields: Optional[Iterable[str]] = PERSISTED_FIELDS) -> Dict[str, Any]:
+    """Bỏ các channel dẫn xuất khỏi channel_values của checkpoint (fields=None: giữ nguyên)"""
+    if fields is None:
+        return channel_values
+    return {name: value for name, value in channel_values.items() if name in fields or _is_internal_channel(name)}
+
+
+def encode_session(value: Any) -> bytes:
+    packed = msgpack.packb(value, use_bin_type=True)
+    return _MAGIC + bytes([SESSION_SCHEMA_VERSION]) + zlib.compress(packed)
+
+
+def decode_session(payload: bytes) -> Any:
+    if payload[:2] != _MAGIC:
+        # Payload cũ (pickle toàn bộ state) không được giải mã: pickle từ Redis dùng chung không an toàn
+        raise ValueError("Payload session không đúng định dạng")
+    version = payload[2]
+    if version != SESSION_SCHEMA_VERSION:
+        raise ValueError(f"Session schema version {version} không được hỗ trợ")
+    return msgpack.unpackb(zlib.decompress(payload[3:]), raw=False)
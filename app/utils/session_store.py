@@ -1,42 +1,338 @@
-import uuid
-import json
+from abc import ABC, abstractmethod
+import heapq
+import threading
 import time
-from typing import Dict, Any
-
-# Lưu session trong memory (tạm thời thay vì Redis)
-session_store: Dict[str, Dict[str, Any]] = {}
-session_timestamps: Dict[str, float] = {}
-
-def save_state_to_redis(state: dict, session_id: str = None, ttl: int = 3600) -> str:
-    if session_id is None:
-        session_id = str(uuid.uuid4())
-    session_store[session_id] = state
-    session_timestamps[session_id] = time.time() + ttl
-    return session_id
-
-def load_state_from_redis(session_id: str) -> dict:
-    if session_id not in session_store:
-        raise Exception("Session expired or not found")
-    
-    # Kiểm tra TTL
-    if time.time() > session_timestamps.get(session_id, 0):
-        # Xóa session hết hạn
-        del session_store[session_id]
-        if session_id in session_timestamps:
-            del session_timestamps[session_id]
-        raise Exception("Session expired")
-    
-    return session_store[session_id]
-
-# Hàm cleanup để xóa session hết hạn (có thể gọi định kỳ)
-def cleanup_expired_sessions():
-    current_time = time.time()
-    expired_sessions = [
-        session_id for session_id, timestamp in session_timestamps.items()
-        if current_time > timestamp
-    ]
-    for session_id in expired_sessions:
-        if session_id in session_store:
-            del session_store[session_id]
-        if session_id in session_timestamps:
-            del session_timestamps[session_id]
\ No newline at end of file
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+import redis
+
+from app.config import (
+    SESSION_BACKEND,
+    SESSION_REDIS_URL,
+    SESSION_REDIS_MAX_CONNECTIONS,
+    SESSION_MEMORY_MAX_SESSIONS,
+    SESSION_MEMORY_MAX_BYTES,
+    SESSION_SWEEP_INTERVAL,
+    SESSION_REDIS_STATS_INTERVAL,
+    CACHE_KEY_PREFIX,
+)
+
+SESSION_KEY_PREFIX = f"{CACHE_KEY_PREFIX}:session:"
+SESSION_LOG_KEY_PREFIX = f"{CACHE_KEY_PREFIX}:session-log:"
+
+
+class SessionBackend(ABC):
+    """
+    Interface lưu session theo session_id: một payload (bytes đã encode, ghi đè khi save) và một log
+    chỉ thêm vào cuối (append). Mỗi thao tác ghi là một lệnh nguyên tử trên backend nên nhiều worker
+    ghi cùng session không cần đọc - sửa - ghi (xem checkpointer.SessionCheckpointSaver).
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def save(self, session_id: str, payload: bytes, ttl: int):
+        """Ghi đè payload, giữ nguyên log"""
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[bytes]:
+        """Trả về payload hoặc None nếu session không tồn tại / đã hết hạn"""
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """Xóa payload và log"""
+
+    @abstractmethod
+    def append(self, session_id: str, items: List[bytes], ttl: int):
+        """Thêm bản ghi vào cuối log của session"""
+
+    @abstractmethod
+    def load_with_log(self, session_id: str) -> Tuple[Optional[bytes], List[bytes]]:
+        """Payload (None nếu chưa có) và toàn bộ log, log rỗng nếu session không tồn tại / đã hết hạn"""
+
+    @abstractmethod
+    def remove_from_log(self, session_id: str, items: List[bytes]):
+        """Bỏ các bản ghi không còn dùng khỏi log (bản ghi thêm đồng thời không bị ảnh hưởng)"""
+
+    def cleanup(self) -> int:
+        """Xóa session hết hạn (backend có TTL thật thì không cần)"""
+        return 0
+
+    def close(self):
+        """Giải phóng tài nguyên (thread sweeper, kết nối) khi tắt ứng dụng"""
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+class MemorySessionBackend(SessionBackend):
+    """
+    Lưu session trong memory của process (chỉ dùng khi dev, một worker).
+    - Giới hạn số session và tổng số byte (payload + log), vượt giới hạn thì loại session ít dùng nhất (LRU)
+    - Payload đã encode (session_schema) nên đếm byte chính xác và không chia sẻ object giữa các request
+    - Min-heap thời điểm hết hạn: mỗi lần sweep chỉ tốn O(số session hết hạn * log n)
+    - Thread sweeper chạy nền theo chu kỳ SESSION_SWEEP_INTERVAL
+    """
+
+    name = "memory"
+
+    def __init__(
+        self,
+        clock: Callable[[], float] = time.time,
+        max_sessions: int = SESSION_MEMORY_MAX_SESSIONS,
+        max_bytes: int = SESSION_MEMORY_MAX_BYTES,
+        sweep_interval: float = SESSION_SWEEP_INTERVAL,
+    ):
+        self.clock = clock
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        # session_id -> payload (None nếu mới có log), thứ tự = thứ tự dùng gần nhất (cuối = mới nhất)
+        self.session_store: "OrderedDict[str, Optional[bytes]]" = OrderedDict()
+        self.session_logs: Dict[str, List[bytes]] = {}
+        self.session_timestamps: Dict[str, float] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self.total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self._lock = threading.RLock()
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def save(self, session_id: str, payload: bytes, ttl: int):
+        with self._lock:
+            previous = self.session_store.get(session_id)
+            self._touch(session_id, ttl)
+            self.session_store[session_id] = payload
+            self.total_bytes += len(payload) - len(previous or b"")
+            self._enforce_limits()
+        self._ensure_sweeper()
+
+    def append(self, session_id: str, items: List[bytes], ttl: int):
+        with self._lock:
+            self._touch(session_id, ttl)
+            self.session_logs.setdefault(session_id, []).extend(items)
+            self.total_bytes += sum(len(item) for item in items)
+            self._enforce_limits()
+        self._ensure_sweeper()
+
+    def _touch(self, session_id: str, ttl: int):
+        """Gia hạn session (tạo mới nếu chưa có / đã hết hạn) và đánh dấu vừa dùng"""
+        if session_id in self.session_store and self._expired(session_id):
+            self._remove(session_id)
+            self.expired += 1
+        expires_at = self.clock() + ttl
+        self.session_store.setdefault(session_id, None)
+        self.session_store.move_to_end(session_id)
+        self.session_timestamps[session_id] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, session_id))
+
+    def _expired(self, session_id: str) -> bool:
+        return self.clock() > self.session_timestamps.get(session_id, 0)
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        return self.load_with_log(session_id)[0]
+
+    def load_with_log(self, session_id: str) -> Tuple[Optional[bytes], List[bytes]]:
+        with self._lock:
+            if session_id not in self.session_store:
+                return None, []
+            # Kiểm tra TTL
+            if self._expired(session_id):
+                self._remove(session_id)
+                self.expired += 1
+                return None, []
+            self.session_store.move_to_end(session_id)
+            return self.session_store[session_id], list(self.session_logs.get(session_id, ()))
+
+    def remove_from_log(self, session_id: str, items: List[bytes]):
+        with self._lock:
+            log = self.session_logs.get(session_id)
+            for item in items:
+                if log and item in log:
+                    log.remove(item)
+                    self.total_bytes -= len(item)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._remove(session_id)
+
+    def _remove(self, session_id: str):
+        # Entry trong heap được bỏ qua lười khi sweep (không khớp session_timestamps)
+        payload = self.session_store.pop(session_id, None)
+        self.total_bytes -= len(payload or b"") + sum(len(item) for item in self.session_logs.pop(session_id, ()))
+        self.session_timestamps.pop(session_id, None)
+
+    def _enforce_limits(self):
+        # Luôn giữ lại session vừa lưu (nằm cuối OrderedDict)
+        while len(self.session_store) > 1 and (
+            len(self.session_store) > self.max_sessions or self.total_bytes > self.max_bytes
+        ):
+            oldest_session_id = next(iter(self.session_store))
+            self._remove(oldest_session_id)
+            self.evicted += 1
+
+    def cleanup(self) -> int:
+        current_time = self.clock()
+        removed = 0
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < current_time:
+                expires_at, session_id = heapq.heappop(self._expiry_heap)
+                if self.session_timestamps.get(session_id) == expires_at:
+                    self._remove(session_id)
+                    removed += 1
+            # Heap chứa nhiều entry cũ (do save lại/xóa) thì dựng lại cho gọn
+            if len(self._expiry_heap) > 2 * len(self.session_timestamps) + 64:
+                self._expiry_heap = [(expires_at, sid) for sid, expires_at in self.session_timestamps.items()]
+                heapq.heapify(self._expiry_heap)
+            self.expired += removed
+        return removed
+
+    def _ensure_sweeper(self):
+        if self.sweep_interval <= 0 or (self._sweeper is not None and self._sweeper.is_alive()):
+            return
+        with self._lock:
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._stop_event.clear()
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_loop(self):
+        while not self._stop_event.wait(self.sweep_interval):
+            try:
+                removed = self.cleanup()
+                if removed:
+                    print(f"[DEBUG] Session sweeper: đã xóa {removed} session hết hạn")
+            except Exception as e:
+                print(f"Error sweeping sessions: {e}")
+
+    def close(self):
+        self._stop_event.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "sessions": len(self.session_store),
+                "bytes": self.total_bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+
+class FakeSessionBackend(MemorySessionBackend):
+    """Backend giả cho test: đồng hồ điều khiển bằng tay, không chạy thread sweeper"""
+
+    name = "fake"
+
+    def __init__(self, max_sessions: int = SESSION_MEMORY_MAX_SESSIONS, max_bytes: int = SESSION_MEMORY_MAX_BYTES):
+        self.now = 0.0
+        super().__init__(clock=lambda: self.now, max_sessions=max_sessions, max_bytes=max_bytes, sweep_interval=0)
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class RedisSessionBackend(SessionBackend):
+    """
+    Lưu session trên Redis với TTL thật (SETEX), dùng chung giữa các worker và qua các lần restart.
+    Log là một Redis list riêng (RPUSH / LREM nguyên tử), có cùng TTL với payload.
+    Mỗi thao tác là một round trip: các lệnh của cùng thao tác được gửi chung một pipeline.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, max_connections: int = SESSION_REDIS_MAX_CONNECTIONS):
+        self._pool = redis.ConnectionPool.from_url(
+            url, max_connections=max_connections, socket_timeout=2, socket_connect_timeout=2
+        )
+        self._client = redis.Redis(connection_pool=self._pool)
+        self._stats: Optional[Dict[str, Any]] = None
+        self._stats_at = 0.0
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"{SESSION_KEY_PREFIX}{session_id}"
+
+    @staticmethod
+    def _log_key(session_id: str) -> str:
+        return f"{SESSION_LOG_KEY_PREFIX}{session_id}"
+
+    def save(self, session_id: str, payload: bytes, ttl: int):
+        # Payload và TTL của log trong một MULTI: một round trip, log không sống lâu hơn payload
+        pipe = self._client.pipeline(transaction=True)
+        pipe.setex(self._key(session_id), ttl, payload)
+        pipe.expire(self._log_key(session_id), ttl)
+        pipe.execute()
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        return self._client.get(self._key(session_id))
+
+    def delete(self, session_id: str):
+        self._client.delete(self._key(session_id), self._log_key(session_id))
+
+    def append(self, session_id: str, items: List[bytes], ttl: int):
+        if not items:
+            return
+        pipe = self._client.pipeline(transaction=True)
+        pipe.rpush(self._log_key(session_id), *items)
+        pipe.expire(self._log_key(session_id), ttl)
+        pipe.execute()
+
+    def load_with_log(self, session_id: str) -> Tuple[Optional[bytes], List[bytes]]:
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(self._key(session_id))
+        pipe.lrange(self._log_key(session_id), 0, -1)
+        payload, log = pipe.execute()
+        return payload, log
+
+    def remove_from_log(self, session_id: str, items: List[bytes]):
+        pipe = self._client.pipeline(transaction=False)
+        for item in items:
+            pipe.lrem(self._log_key(session_id), 1, item)
+        pipe.execute()
+
+    def stats(self) -> Dict[str, Any]:
+        """Số session trên Redis (SCAN cả keyspace nên kết quả được giữ SESSION_REDIS_STATS_INTERVAL giây)"""
+        now = time.monotonic()
+        if self._stats is not None and now - self._stats_at < SESSION_REDIS_STATS_INTERVAL:
+            return self._stats
+        try:
+            sessions = sum(1 for _ in self._client.scan_iter(match=f"{SESSION_KEY_PREFIX}*", count=1000))
+        except redis.RedisError as e:
+            return {"backend": self.name, "error": str(e)}
+        self._stats, self._stats_at = {"backend": self.name, "sessions": sessions}, now
+        return self._stats
+
+    def close(self):
+        self._pool.disconnect()
+
+
+def create_session_backend(name: str = SESSION_BACKEND) -> SessionBackend:
+    if name == "redis":
+        if not SESSION_REDIS_URL:
+            raise ValueError("SESSION_BACKEND=redis cần REDIS_URL hoặc SESSION_REDIS_URL")
+        return RedisSessionBackend(SESSION_REDIS_URL)
+    if name == "fake":
+        return FakeSessionBackend()
+    return MemorySessionBackend()
+
+
+_backend: Optional[SessionBackend] = None
+
+
+def get_session_backend() -> SessionBackend:
+    global _backend
+    if _backend is None:
+        _backend = create_session_backend()
+        print(f"[DEBUG] Session backend: {_backend.name}")
+    return _backend
+
+
+def set_session_backend(backend: SessionBackend):
+    """Thay backend (dùng trong test)"""
+    global _backend
+    _backend = backend
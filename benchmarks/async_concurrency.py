@@ -0,0 +1,144 @@
+"""
+Benchmark khả năng chịu tải đồng thời: invoke trong thread pool (route sync cũ) so với ainvoke (route async).
+
+LLM được giả lập bằng độ trễ cố định (không gọi OpenAI). Mỗi request đi qua 3 lần gọi LLM
+như luồng thật: phân loại câu hỏi, rerank, tạo câu trả lời tự nhiên.
+Route sync của FastAPI chạy trong thread pool của anyio (mặc định 40 thread), nên mô hình cũ
+bị giới hạn ở ~40 request đang xử lý cùng lúc.
+
+Chạy:
+    python -m benchmarks.async_concurrency --latency 0.5 --concurrency 10 50 100 200 400
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Any, Dict, List, TypedDict
+
+import anyio
+from langgraph.graph import StateGraph, END
+
+from app.graph.nodes.classify_topic_node import check_mode, acheck_mode
+from app.graph.nodes.rerank_foods_node import RERANK_MODEL
+from app.services.llm.llm_service import LLMService
+
+
+class BenchState(TypedDict):
+    question: str
+    topic_classification: str
+    rerank: str
+    natural_response: str
+
+
+def _stub_llm(latency: float):
+    """Thay lời gọi OpenAI bằng độ trễ cố định"""
+
+    def create(cls, request: Dict[str, Any]) -> str:
+        time.sleep(latency)
+        return "tư vấn"
+
+    async def acreate(cls, request: Dict[str, Any]) -> str:
+        await asyncio.sleep(latency)
+        return "tư vấn"
+
+    LLMService._create = classmethod(create)
+    LLMService._acreate = classmethod(acreate)
+    LLMService.is_available = staticmethod(lambda: True)
+
+
+def build_sync_graph():
+    def classify(state: BenchState) -> BenchState:
+        return {**state, "topic_classification": check_mode(state["question"])}
+
+    def rerank(state: BenchState) -> BenchState:
+        return {**state, "rerank": LLMService.chat(state["question"], model=RERANK_MODEL)}
+
+    def respond(state: BenchState) -> BenchState:
+        return {**state, "natural_response": LLMService.get_completion(state["question"])}
+
+    return _compile(classify, rerank, respond)
+
+
+def build_async_graph():
+    async def classify(state: BenchState) -> BenchState:
+        return {**state, "topic_classification": await acheck_mode(state["question"])}
+
+    async def rerank(state: BenchState) -> BenchState:
+        return {**state, "rerank": await LLMService.achat(state["question"], model=RERANK_MODEL)}
+
+    async def respond(state: BenchState) -> BenchState:
+        return {**state, "natural_response": await LLMService.aget_completion(state["question"])}
+
+    return _compile(classify, rerank, respond)
+
+
+def _compile(classify, rerank, respond):
+    workflow = StateGraph(BenchState)
+    workflow.add_node("classify_topic", classify)
+    workflow.add_node("rerank_foods", rerank)
+    workflow.add_node("generate_natural_response", respond)
+    workflow.set_entry_point("classify_topic")
+    workflow.add_edge("classify_topic", "rerank_foods")
+    workflow.add_edge("rerank_foods", "generate_natural_response")
+    workflow.add_edge("generate_natural_response", END)
+    return workflow.compile()
+
+
+def _initial_state(i: int, run: str) -> BenchState:
+    # Câu hỏi khác nhau để không trúng cache phân loại
+    return {"question": f"{run} câu hỏi {i}", "topic_classification": "", "rerank": "", "natural_response": ""}
+
+
+async def _timed(coro_factory) -> float:
+    start = time.perf_counter()
+    await coro_factory()
+    return time.perf_counter() - start
+
+
+async def run_threadpool(graph, concurrency: int, threads: int) -> List[float]:
+    limiter = anyio.CapacityLimiter(threads)
+    return await asyncio.gather(*(
+        _timed(lambda i=i: anyio.to_thread.run_sync(graph.invoke, _initial_state(i, f"sync{concurrency}"), limiter=limiter))
+        for i in range(concurrency)
+    ))
+
+
+async def run_async(graph, concurrency: int) -> List[float]:
+    return await asyncio.gather(*(
+        _timed(lambda i=i: graph.ainvoke(_initial_state(i, f"async{concurrency}")))
+        for i in range(concurrency)
+    ))
+
+
+def _report(label: str, concurrency: int, wall: float, latencies: List[float]):
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(
+        f"{label:<12} {concurrency:>6} {wall:>9.2f}s {concurrency / wall:>9.1f} "
+        f"{statistics.median(latencies):>9.2f}s {p95:>9.2f}s"
+    )
+
+
+async def main(latency: float, concurrency_levels: List[int], threads: int):
+    _stub_llm(latency)
+    sync_graph = build_sync_graph()
+    async_graph = build_async_graph()
+    print(f"LLM latency {latency}s x 3 lần gọi/request, thread pool {threads}")
+    print(f"{'mode':<12} {'conc':>6} {'wall':>10} {'req/s':>9} {'p50':>10} {'p95':>10}")
+    for concurrency in concurrency_levels:
+        start = time.perf_counter()
+        latencies = await run_threadpool(sync_graph, concurrency, threads)
+        _report("invoke", concurrency, time.perf_counter() - start, latencies)
+
+        start = time.perf_counter()
+        latencies = await run_async(async_graph, concurrency)
+        _report("ainvoke", concurrency, time.perf_counter() - start, latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.5, help="Độ trễ giả lập mỗi lần gọi LLM (giây)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100, 200, 400])
+    parser.add_argument("--threads", type=int, default=40, help="Số thread của thread pool (anyio mặc định 40)")
+    args = parser.parse_args()
+    asyncio.run(main(args.latency, args.concurrency, args.threads))
@@ -0,0 +1,115 @@
+"""
+Benchmark bộ nhớ cấp phát mỗi request (tracemalloc): node trả về {**state, ...} (cách cũ)
+so với node chỉ trả về các key thay đổi (cách hiện tại).
+
+Graph dùng WorkflowState thật và số bước như luồng process-selections (~12 node),
+state có neo4j_result/filtered_result/aggregated_result cỡ thật (--foods món).
+
+Chạy:
+    python -m benchmarks.state_allocations --foods 200 --requests 50
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+from langgraph.graph import StateGraph, END
+
+from app.graph.engine import WorkflowState
+
+STEPS = [
+    "check_session", "identify_user", "classify_topic", "calculate_bmi", "query_neo4j",
+    "filter_by_ingredients", "filter_allergies", "aggregate_foods", "rerank_foods",
+    "generate_natural_response", "generate_result", "end_success",
+]
+
+
+def _foods(count: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "dish_id": f"dish-{i}",
+            "dish_name": f"Món ăn số {i}",
+            "cook_method": "Luộc",
+            "diet_name": "Ăn kiêng",
+            "ingredients": [f"nguyên liệu {j}" for j in range(12)],
+            "description": "Mô tả món ăn " * 10,
+        }
+        for i in range(count)
+    ]
+
+
+def _outputs(foods: int) -> Dict[str, Dict[str, Any]]:
+    """Giá trị mỗi node ghi vào state (tạo trước để chỉ đo phần copy/merge state)"""
+    food_list = _foods(foods)
+    return {
+        "identify_user": {"user_data": {"name": "A", "age": 30, "allergies": ["tôm"], "medicalConditions": ["Tiểu đường"]}},
+        "classify_topic": {"topic_classification": "tư vấn"},
+        "calculate_bmi": {"bmi_result": {"bmi": 22.5, "bmi_category": "Bình thường"}},
+        "query_neo4j": {"neo4j_result": {"status": "success", "foods": {"disease": {"advanced": food_list}}}},
+        "filter_by_ingredients": {"neo4j_result": {"status": "success", "foods": {"disease": {"advanced": food_list}}}},
+        "filter_allergies": {"filtered_result": {"foods": {"disease": {"advanced": food_list}}, "allergy_warnings": {}}},
+        "aggregate_foods": {"aggregated_result": {"status": "success", "aggregated_foods": food_list}},
+        "rerank_foods": {"rerank_result": {"status": "success", "ranked_foods": food_list[:10]}},
+        "generate_natural_response": {"natural_response": "Câu trả lời " * 50},
+        "generate_result": {"final_result": {"status": "success", "foods": food_list[:10]}},
+    }
+
+
+def build_graph(outputs: Dict[str, Dict[str, Any]], full_copy: bool):
+    workflow = StateGraph(WorkflowState)
+
+    def make_node(name: str):
+        update = {**outputs.get(name, {}), "step": name}
+        if full_copy:
+            return lambda state: {**state, **update}
+        return lambda state: update
+
+    for name in STEPS:
+        workflow.add_node(name, make_node(name))
+    workflow.set_entry_point(STEPS[0])
+    for current, following in zip(STEPS, STEPS[1:]):
+        workflow.add_edge(current, following)
+    workflow.add_edge(STEPS[-1], END)
+    return workflow.compile()
+
+
+def _initial_state() -> Dict[str, Any]:
+    return {"user_id": "u1", "question": "Tôi nên ăn gì?", "analysis_steps": [], "step": "start", "error": ""}
+
+
+def measure(graph, requests: int) -> Dict[str, float]:
+    graph.invoke(_initial_state())  # làm nóng (compile, cache nội bộ)
+    start_time = time.perf_counter()
+    for _ in range(requests):
+        graph.invoke(_initial_state())
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    try:
+        total_peak = 0
+        for _ in range(requests):
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            graph.invoke(_initial_state())
+            _, peak = tracemalloc.get_traced_memory()
+            total_peak += peak - start
+    finally:
+        tracemalloc.stop()
+    return {"peak_per_request": total_peak / requests, "ms_per_request": elapsed * 1000 / requests}
+
+
+def main(foods: int, requests: int):
+    outputs = _outputs(foods)
+    print(f"{foods} món trong state, {requests} request, {len(STEPS)} node")
+    print(f"{'mode':<14} {'peak/request':>14} {'time/request':>14}")
+    for label, full_copy in (("{**state}", True), ("partial", False)):
+        result = measure(build_graph(outputs, full_copy), requests)
+        print(f"{label:<14} {result['peak_per_request'] / 1024:>11.1f} KB {result['ms_per_request']:>11.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--foods", type=int, default=200, help="Số món trong kết quả truy vấn")
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+    main(args.foods, args.requests)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Test bản async của filter_allergies: số lời gọi LLM song song bị giới hạn bởi ALLERGY_LLM_CONCURRENCY,
+cache dị ứng được đọc/ghi ngoài event loop
+"""
+import asyncio
+import threading
+
+from app.config import ALLERGY_LLM_CONCURRENCY
+from app.graph.nodes import filter_allergies_node as node
+from app.services.cache_service import allergy_cache
+
+
+def test_llm_calls_are_bounded():
+    foods = {"source_1": {"advanced": [
+        {"name": f"Món {i}", "ingredients": ["rau", "thịt"]} for i in range(ALLERGY_LLM_CONCURRENCY * 3)
+    ]}}
+    state = {"user_data": {"allergies": ["tôm"]}, "query_result": {"foods": foods}}
+    running = 0
+    peak = 0
+
+    async def fake_analyze(ingredients, user_allergies, dish_name):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {"has_allergy": False, "dish_name": dish_name}
+
+    original = (node.aanalyze_ingredients_with_llm, node._load_dish_records, node.filter_foods_by_allergies)
+    node.aanalyze_ingredients_with_llm = fake_analyze
+    node._load_dish_records = lambda foods: {}
+    node.filter_foods_by_allergies = lambda state, analyses: {"analyses": analyses}
+    try:
+        result = asyncio.run(node.afilter_foods_by_allergies(state))
+    finally:
+        node.aanalyze_ingredients_with_llm, node._load_dish_records, node.filter_foods_by_allergies = original
+
+    assert len(result["analyses"]) == ALLERGY_LLM_CONCURRENCY * 3
+    assert peak == ALLERGY_LLM_CONCURRENCY
+
+
+def test_cached_analysis_is_read_off_the_event_loop():
+    key = node._allergy_cache_key(["cá"], ["tôm"], "Cá kho")
+    allergy_cache.set(key, {"has_allergy": False, "dish_name": "Cá kho"})
+    threads = []
+    original_get = allergy_cache.get
+
+    def tracking_get(cache_key, default=None):
+        threads.append(threading.current_thread())
+        return original_get(cache_key, default)
+
+    allergy_cache.get = tracking_get
+    try:
+        analysis = asyncio.run(node.aanalyze_ingredients_with_llm(["cá"], ["tôm"], "Cá kho"))
+    finally:
+        del allergy_cache.get
+
+    assert analysis["dish_name"] == "Cá kho"
+    assert threads and all(thread is not threading.main_thread() for thread in threads)
+
+
+if __name__ == "__main__":
+    test_llm_calls_are_bounded()
+    test_cached_analysis_is_read_off_the_event_loop()
+    print("✅ All tests completed!")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Test script cho bảng intern và các phép toán bitset
+"""
+from app.graph.nodes.aggregate_suitable_foods_node import aggregate_foods_by_intersection
+from app.utils.bitset import Interner, ExclusionSet, iter_bits, count
+
+
+def test_intersection_union_exclusion():
+    """Giao / hợp / loại trừ trên bitset cho kết quả giống set"""
+    interner = Interner()
+    bmi = interner.to_bitset(["d1", "d2", "d3", "d4"])
+    disease = interner.to_bitset(["d2", "d3", "d5"])
+    excluded = interner.to_bitset(["d3"])
+
+    assert interner.values_of(bmi & disease) == ["d2", "d3"]
+    assert sorted(interner.values_of(bmi | disease)) == ["d1", "d2", "d3", "d4", "d5"]
+    assert interner.values_of(bmi & disease & ~excluded) == ["d2"]
+    assert count(bmi) == 4
+
+
+def test_contains_does_not_intern_new_values():
+    """contains() không cấp phát vị trí bit cho giá trị lạ"""
+    interner = Interner()
+    bits = interner.to_bitset(["a", None, ""])
+    assert interner.contains(bits, "a")
+    assert not interner.contains(bits, "b")
+    assert len(interner) == 1
+
+
+def test_iter_bits():
+    assert list(iter_bits(0b101001)) == [0, 3, 5]
+    assert list(iter_bits(0)) == []
+
+
+
+def test_exclusion_set():
+    """Loại món theo id/dish_id/tên, lưu lại được dưới dạng danh sách"""
+    exclusion = ExclusionSet.from_state({"previous_food_ids": ["x1"], "previous_food_names": ["Canh chua"]})
+    foods = [{"dish_id": "x1"}, {"dish_id": "x2"}, {"id": "x3", "name": "Canh chua"}]
+    assert exclusion.filter(foods) == foods[1:]
+    assert [food for food in foods if not exclusion.excludes(food)] == [foods[1]]
+
+    exclusion.add("x2", "Rau luộc")
+    restored = ExclusionSet(exclusion.ids(), exclusion.names)
+    assert restored.contains_id("x2") and restored.contains_id("x1")
+    assert not ExclusionSet.coerce(None)
+    assert ExclusionSet.coerce(["x1"]).contains_id("x1")
+
+
+def test_aggregate_intersection_skips_excluded_and_duplicates():
+    """Giao các tiêu chí có sẵn, bỏ món đã gợi ý, mỗi dish_id chỉ giữ món đầu tiên"""
+    bmi = [{"dish_id": "d1", "cook_method": "Luộc"}, {"dish_id": "d2"}, {"dish_id": "d3"}]
+    cooking = [{"dish_id": "d2", "cook_method": "Hấp"}, {"dish_id": "d3"}, {"dish_id": "d1", "cook_method": "Hấp"}]
+    foods = aggregate_foods_by_intersection(bmi, cooking, [], "Bình thường", ["Hấp"], [], ExclusionSet(["d3"]))
+    assert foods == [{"dish_id": "d1", "cook_method": "Luộc"}, {"dish_id": "d2"}]
+    # Không có BMI: chỉ dùng tiêu chí phương pháp nấu
+    assert [food["dish_id"] for food in aggregate_foods_by_intersection([], cooking, [], "", ["Hấp"], [])] == ["d2", "d3", "d1"]
+
+
+if __name__ == "__main__":
+    test_intersection_union_exclusion()
+    test_contains_does_not_intern_new_values()
+    test_iter_bits()
+    test_exclusion_set()
+    test_aggregate_intersection_skips_excluded_and_duplicates()
+    print("✅ All tests completed!")
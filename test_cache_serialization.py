@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Test serialize cache L2: msgpack + kiểu đăng ký (DishRecord, datetime), không giải mã pickle;
+TieredCache.get_many / set_many đọc, ghi L2 trong một round trip
+"""
+import pickle
+from datetime import datetime
+
+from bson import ObjectId
+
+from app.services import cache_service
+from app.services.cache_service import TieredCache, deserialize, serialize
+from app.services.dish_store import DishRecord, DishStore
+
+
+def test_roundtrip_supported_types():
+    user = {"_id": "u1", "lastUpdateDate": datetime(2024, 5, 1, 8, 30), "allergies": ["tôm"], "bmi": 21.5}
+    assert deserialize(serialize(user)) == user
+    assert deserialize(serialize({"oid": ObjectId("65a1b2c3d4e5f60718293a4b")}))["oid"] == ObjectId("65a1b2c3d4e5f60718293a4b")
+    # Payload lớn được nén
+    foods = [{"dish_id": f"d{i}", "dish_name": "Canh chua cá lóc"} for i in range(100)]
+    assert deserialize(serialize(foods)) == foods
+
+    record = DishRecord({"_id": "d1", "name": "Cá kho", "ingredients": ["cá"], "instructions": ["kho"]}, heavy_loaded=True)
+    restored = deserialize(serialize([record]))[0]
+    assert isinstance(restored, DishRecord)
+    assert (restored.id, restored.name, restored.ingredients, restored.instructions) == ("d1", "Cá kho", ["cá"], ["kho"])
+
+
+def test_rejects_unregistered_types_and_pickle_payloads():
+    class Unknown:
+        pass
+
+    try:
+        serialize({"x": Unknown()})
+        assert False, "Kiểu chưa đăng ký không được serialize"
+    except TypeError:
+        pass
+    for header in (b"\x00", b"\x01"):
+        try:
+            deserialize(header + pickle.dumps({"a": 1}))
+            assert False, "Payload pickle không được giải mã"
+        except ValueError:
+            pass
+    assert TieredCache._decode("k", b"\x00" + pickle.dumps({"a": 1})) is None
+
+
+class _StubRedis:
+    """Redis giả lập tối thiểu (get/setex/pttl + pipeline), đếm số round trip"""
+
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.round_trips += 1
+        self.data[key] = value
+
+    def pipeline(self, transaction=False):
+        stub = self
+        replies = []
+
+        class Pipe:
+            def get(self, key):
+                replies.append(stub.data.get(key))
+
+            def pttl(self, key):
+                replies.append(60000 if key in stub.data else -2)
+
+            def setex(self, key, ttl, value):
+                stub.data[key] = value
+                replies.append(True)
+
+            def execute(self):
+                stub.round_trips += 1
+                return list(replies)
+
+        return Pipe()
+
+
+def test_get_many_reads_l2_in_one_round_trip():
+    stub = _StubRedis()
+    connection = cache_service._redis_connection
+    original = (connection.url, connection._client, connection._disabled_until)
+    connection.url, connection._client, connection._disabled_until = "redis://stub", stub, 0.0
+    try:
+        writer = TieredCache("test_get_many")
+        for i in range(5):
+            writer.set(f"d{i}", DishRecord({"_id": f"d{i}", "name": f"Món {i}"}))
+        reader = TieredCache("test_get_many")
+        reader.get("d0")  # d0 nằm sẵn ở L1 của reader
+        stub.round_trips = 0
+
+        found = reader.get_many([f"d{i}" for i in range(6)] + ["d1"])
+        assert stub.round_trips == 1
+        assert sorted(found) == ["d0", "d1", "d2", "d3", "d4"]
+        assert found["d3"].name == "Món 3"
+        assert (reader.hits_l2, reader.misses) == (5, 1)
+
+        # Các key vừa đọc đã vào L1, lần sau không cần gọi Redis
+        reader.get_many(["d1", "d2"])
+        assert stub.round_trips == 1
+    finally:
+        connection.url, connection._client, connection._disabled_until = original
+
+
+def test_dish_store_remembers_records_in_one_round_trip():
+    """DishStore ghi cache cả lô (theo _id và neo4j_id) bằng một pipeline"""
+    stub = _StubRedis()
+    connection = cache_service._redis_connection
+    original = (connection.url, connection._client, connection._disabled_until)
+    connection.url, connection._client, connection._disabled_until = "redis://stub", stub, 0.0
+    try:
+        store = DishStore()
+        store._cache.get("warm-up")  # đọc version namespace một lần
+        stub.round_trips = 0
+        store._remember([DishRecord({"_id": f"d{i}", "name": f"Món {i}", "neo4j_id": f"n{i}"}) for i in range(3)])
+        assert stub.round_trips == 1
+        assert len(stub.data) == 6
+
+        reader = TieredCache("dish_record")
+        found = reader.get_many(["_id:d1", "neo4j_id:n2"])
+        assert found["_id:d1"].name == "Món 1"
+        assert found["neo4j_id:n2"].id == "d2"
+    finally:
+        connection.url, connection._client, connection._disabled_until = original
+
+
+if __name__ == "__main__":
+    test_roundtrip_supported_types()
+    test_rejects_unregistered_types_and_pickle_payloads()
+    test_get_many_reads_l2_in_one_round_trip()
+    test_dish_store_remembers_records_in_one_round_trip()
+    print("✅ All tests completed!")
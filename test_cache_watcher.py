@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Test cache_watcher xóa đúng các cache dẫn xuất: danh sách nguyên liệu và phương pháp chế biến
+"""
+from app.services.cache_watcher import cache_watcher
+from app.services.graph_schema_service import GraphSchemaService
+from app.services.mongo_service import (
+    ALL_INGREDIENTS_KEY,
+    cook_methods_cache,
+    cook_methods_key,
+    ingredient_cache,
+)
+
+
+def test_ingredient_change_refreshes_all_ingredients():
+    ingredient_cache.set(ALL_INGREDIENTS_KEY, ["cá", "tôm"])
+    assert GraphSchemaService.get_all_ingredients() == ["cá", "tôm"]
+
+    cache_watcher.invalidate("ingredients", "i1")
+    assert ingredient_cache.get(ALL_INGREDIENTS_KEY) is None
+
+
+def test_dish_change_evicts_cook_methods():
+    key = cook_methods_key(["tôm", "cá"])
+    assert key == cook_methods_key(["cá", "tôm"])
+    cook_methods_cache.set(key, ["Luộc", "Kho"])
+    assert GraphSchemaService.get_cook_methods_by_ingredients(["cá", "tôm"]) == ["Luộc", "Kho"]
+
+    cache_watcher.invalidate("dishes", "d1")
+    assert cook_methods_cache.get(key) is None
+
+
+if __name__ == "__main__":
+    test_ingredient_change_refreshes_all_ingredients()
+    test_dish_change_evicts_cook_methods()
+    print("✅ All tests completed!")
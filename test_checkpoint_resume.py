@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Test pause/resume bằng checkpointer lưu qua session backend (backend fake, không cần Neo4j/MongoDB/OpenAI/Redis)
+"""
+import asyncio
+
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.types import Command
+
+from app.graph import engine
+from app.utils.bitset import ExclusionSet
+from app.utils import checkpointer
+from app.utils.checkpointer import SessionCheckpointSaver
+from app.utils.session_schema import PERSISTED_FIELDS
+from app.utils.session_store import FakeSessionBackend
+
+# Node thật được thay bằng node giả chỉ ghi lại lượt gọi và chuyển sang step kế tiếp
+NEXT_STEP = {
+    "identify_user": "user_identified",
+    "classify_topic": "topic_classified",
+    "calculate_bmi": "bmi_calculated",
+    "query_neo4j": "neo4j_queried",
+    "filter_by_ingredients": "ingredients_filtered",
+    "filter_allergies": "allergies_filtered",
+    "aggregate_foods": "foods_aggregated",
+    "rerank_foods_wrapper": "foods_reranked",
+    "generate_natural_response_wrapper": "natural_response_generated",
+}
+
+
+def _build_graph(calls, checkpointer, nodes=None):
+    """nodes: node thay cho node giả mặc định (tên hàm trong engine -> hàm)"""
+    originals = {name: getattr(engine, name) for name in [*NEXT_STEP, "generate_selection_prompts", "generate_final_result"]}
+
+    def fake(name, step):
+        def node(state):
+            calls.append(name)
+            return {"step": step, "user_data": {"name": "A"}} if name == "identify_user" else {"step": step}
+        return node
+
+    def generate_selection_prompts(state):
+        calls.append("generate_selection_prompts")
+        return {"step": "awaiting_selections", "final_result": {"status": "awaiting_selections", "session_id": state["session_id"]}}
+
+    def generate_final_result(state):
+        calls.append("generate_final_result")
+        return {
+            "step": "result_generated",
+            "final_result": {"status": "success", "cooking_methods": state["selected_cooking_methods"]},
+        }
+
+    try:
+        for name, step in NEXT_STEP.items():
+            setattr(engine, name, fake(name, step))
+        engine.generate_selection_prompts = generate_selection_prompts
+        engine.generate_final_result = generate_final_result
+        for name, node in (nodes or {}).items():
+            setattr(engine, name, node)
+        return engine.create_workflow().compile(checkpointer=checkpointer)
+    finally:
+        for name, node in originals.items():
+            setattr(engine, name, node)
+
+
+def _start_input(thread_id):
+    return {"user_id": "u1", "question": "Tôi nên ăn gì?", "session_id": thread_id, "step": "start", "analysis_steps": []}
+
+
+def test_resume_continues_from_checkpoint():
+    """Lượt đầu dừng ở await_selections, resume đi thẳng query_neo4j, không đọc lại user"""
+    calls = []
+    backend = FakeSessionBackend()
+    graph = _build_graph(calls, SessionCheckpointSaver(backend))
+    config = {"configurable": {"thread_id": "s1"}}
+
+    async def run():
+        paused = await graph.ainvoke(_start_input("s1"), config, durability=engine._DURABILITY)
+        assert paused["final_result"]["status"] == "awaiting_selections"
+        snapshot = await graph.aget_state(config)
+        assert snapshot.next == ("await_selections",)
+        assert snapshot.interrupts
+
+        calls.clear()
+        return await graph.ainvoke(
+            Command(resume={"ingredients": [], "cooking_methods": ["Luộc"]}), config, durability=engine._DURABILITY
+        )
+
+    result = asyncio.run(run())
+    assert result["final_result"]["status"] == "success"
+    assert result["final_result"]["cooking_methods"] == ["Luộc"]
+    assert result["final_result"]["session_id"] == "s1"
+    assert calls[0] == "query_neo4j"
+    assert "identify_user" not in calls and "classify_topic" not in calls
+    # user_data không được lưu ở checkpoint (engine đọc lại qua _load_profile khi resume)
+    assert "user_data" not in result
+    # Mỗi session chỉ giữ checkpoint mới nhất
+    assert backend.stats()["sessions"] == 1
+
+
+def test_saver_keeps_only_latest_checkpoint():
+    saver = SessionCheckpointSaver(FakeSessionBackend())
+    graph = _build_graph([], saver)
+    config = {"configurable": {"thread_id": "s1"}}
+
+    async def run():
+        await graph.ainvoke(_start_input("s1"), config)  # ghi checkpoint sau mỗi node
+        latest = await saver.aget_tuple(config)
+        assert [item.config async for item in saver.alist(config)] == [latest.config]
+        assert latest.parent_config is not None
+        assert await saver.aget_tuple(latest.parent_config) is None
+        assert (await graph.aget_state(config)).next == ("await_selections",)
+
+    asyncio.run(run())
+
+
+def test_writes_are_kept_when_put_runs_concurrently():
+    """Hai worker dùng chung backend: write đến trước put của cùng checkpoint vẫn được giữ, write cũ được dọn"""
+    backend = FakeSessionBackend()
+    worker_a, worker_b = SessionCheckpointSaver(backend), SessionCheckpointSaver(backend)
+    config = {"configurable": {"thread_id": "s1", "checkpoint_ns": ""}}
+    first, second = empty_checkpoint(), empty_checkpoint()
+
+    worker_a.put(config, first, {}, {})
+    worker_a.put_writes({**config, "configurable": {**config["configurable"], "checkpoint_id": first["id"]}}, [("step", "old")], "t0")
+    # Lúc thoát LangGraph gọi put và put_writes song song: write của checkpoint mới có thể đến trước
+    second_config = {**config, "configurable": {**config["configurable"], "checkpoint_id": second["id"]}}
+    worker_b.put_writes(second_config, [("step", "a"), ("question", "b")], "t1")
+    worker_a.put_writes(second_config, [("step", "again")], "t1")
+    assert worker_a.get_tuple(config).checkpoint["id"] == first["id"]
+    worker_a.put({**config, "configurable": {**config["configurable"], "checkpoint_id": first["id"]}}, second, {}, {})
+
+    latest = worker_b.get_tuple(config)
+    assert latest.checkpoint["id"] == second["id"]
+    assert latest.pending_writes == [("t1", "step", "a"), ("t1", "question", "b")]
+    # Write của checkpoint đầu đã bị bỏ khỏi log
+    assert len(backend.load_with_log("s1")[1]) == 3
+
+
+def test_session_limits_apply_to_checkpoints():
+    """Giới hạn số session / số byte và TTL của session backend áp dụng cho checkpoint"""
+    backend = FakeSessionBackend(max_sessions=2)
+    saver = SessionCheckpointSaver(backend, ttl=100)
+    graph = _build_graph([], saver)
+
+    async def start(thread_id):
+        await graph.ainvoke(_start_input(thread_id), {"configurable": {"thread_id": thread_id}}, durability=engine._DURABILITY)
+
+    async def values(thread_id):
+        return (await graph.aget_state({"configurable": {"thread_id": thread_id}})).values
+
+    async def run():
+        await start("a")
+        await start("b")
+        await start("c")
+        assert await values("a") == {}
+        assert await values("b")
+        # Session quá TTL được sweeper (cleanup) xóa, không cần chờ checkpoint mới
+        backend.advance(200)
+        assert backend.cleanup() == 2
+        assert await values("c") == {}
+
+        size = backend.stats()["bytes"]
+        await start("d")
+        one_session = backend.stats()["bytes"] - size
+        small = FakeSessionBackend(max_bytes=one_session + one_session // 2)
+        small_graph = _build_graph([], SessionCheckpointSaver(small))
+        for thread_id in ("x", "y"):
+            await small_graph.ainvoke(_start_input(thread_id), {"configurable": {"thread_id": thread_id}}, durability=engine._DURABILITY)
+        assert small.stats()["sessions"] == 1
+        assert small.stats()["bytes"] <= small.max_bytes
+        assert small.stats()["evicted"] == 1
+
+    asyncio.run(run())
+    assert backend.stats()["evicted"] == 1
+    assert saver.stats()["threads"] == 1
+
+
+def test_checkpoint_keeps_only_persisted_fields():
+    """Channel dẫn xuất (prompt, analysis_steps, final_result...) không được lưu, resume vẫn chạy được"""
+    catalog = {"status": "awaiting_selections", "ingredients": [f"Nguyên liệu {i}" for i in range(300)]}
+
+    def generate_selection_prompts(state):
+        return {
+            "step": "awaiting_selections",
+            "ingredient_prompt": catalog,
+            "analysis_steps": [{"step": "disease_analysis", "message": "Chế độ ăn ít muối"}] * 20,
+            "final_result": catalog,
+        }
+
+    def query_neo4j(state):
+        return {"step": "neo4j_queried", "neo4j_result": {"foods": [{"dish_id": f"d{i}"} for i in range(200)]}}
+
+    nodes = {"generate_selection_prompts": generate_selection_prompts, "query_neo4j": query_neo4j}
+    full, slim = FakeSessionBackend(), FakeSessionBackend()
+    full_graph = _build_graph([], SessionCheckpointSaver(full, fields=None), nodes)
+    slim_saver = SessionCheckpointSaver(slim)
+    slim_graph = _build_graph([], slim_saver, nodes)
+    config = {"configurable": {"thread_id": "s1"}}
+
+    def persisted_fields():
+        channels = slim_saver.get_tuple(config).checkpoint["channel_values"]
+        return {name for name in channels if not name.startswith("__") and ":" not in name}
+
+    async def run():
+        await full_graph.ainvoke(_start_input("s1"), config, durability=engine._DURABILITY)
+        await slim_graph.ainvoke(_start_input("s1"), config, durability=engine._DURABILITY)
+        assert persisted_fields() == {"user_id", "question", "session_id", "step"}
+        assert slim.stats()["bytes"] * 2 < full.stats()["bytes"]
+        assert (await slim_graph.aget_state(config)).interrupts
+
+        result = await slim_graph.ainvoke(
+            Command(resume={"ingredients": [], "cooking_methods": ["Luộc"]}), config, durability=engine._DURABILITY
+        )
+        assert result["final_result"]["status"] == "success"
+        assert persisted_fields() == {"user_id", "question", "session_id", "step", "selected_ingredients", "selected_cooking_methods"}
+        assert persisted_fields() <= PERSISTED_FIELDS
+
+    asyncio.run(run())
+
+
+def test_follow_up_reloads_user_profile():
+    """Resume và hỏi tiếp trong session dùng hồ sơ user mới nhất, không dùng bản trong checkpoint"""
+    saver = SessionCheckpointSaver(FakeSessionBackend())
+    profile = {"name": "B", "weight": 60, "height": 170, "age": 30}
+    seen = []
+
+    async def get_user_health_data(user_id):
+        return dict(profile)
+
+    def query_neo4j(state):
+        seen.append((state.get("user_data"), state.get("bmi_result")))
+        return {"step": "neo4j_queried"}
+
+    original_checkpointer = checkpointer._checkpointer
+    checkpointer._checkpointer = saver
+    engine._workflow_graph = _build_graph([], saver, {"query_neo4j": query_neo4j})
+    engine.async_mongo_service.get_user_health_data = get_user_health_data
+    try:
+        async def run():
+            paused = await engine.run_langgraph_workflow_until_selection("u1", "Tôi nên ăn gì?", "nóng", "trưa")
+            session_id = paused["session_id"]
+            config = {"configurable": {"thread_id": session_id}}
+            assert "user_data" not in (await saver.aget_tuple(config)).checkpoint["channel_values"]
+
+            await engine.continue_workflow_with_selections(session_id, [], ["Luộc"], "u1")
+            assert seen[-1][0]["name"] == "B"
+
+            profile["weight"] = 90
+            result = await engine.run_langgraph_workflow_until_selection("u1", "Món khác?", "nóng", "tối", session_id=session_id)
+            assert result["status"] == "success"
+            user_data, bmi_result = seen[-1]
+            assert user_data["weight"] == 90
+            assert bmi_result["bmi_category"] == "Béo phì"
+            values = (await engine._workflow_graph.aget_state(config)).values
+            assert values["selected_cooking_methods"] == ["Luộc"]
+
+        asyncio.run(run())
+    finally:
+        del engine.async_mongo_service.get_user_health_data
+        checkpointer._checkpointer = original_checkpointer
+        engine._workflow_graph = None
+
+
+def test_follow_up_excludes_foods_suggested_by_name():
+    """Món đã gợi ý ở lượt 1 (kể cả món khác id nhưng trùng tên) không được gợi ý lại ở lượt 2 cùng session"""
+    saver = SessionCheckpointSaver(FakeSessionBackend())
+    turns = iter([
+        [{"dish_id": "d1", "dish_name": "Canh chua cá"}, {"dish_id": "d2", "dish_name": "Rau muống luộc"}],
+        [{"dish_id": "d9", "dish_name": "Canh chua cá"}, {"dish_id": "d3", "dish_name": "Cá kho tộ"}],
+    ])
+
+    def rerank_foods_wrapper(state):
+        # Loại món như các node thật: theo previous_food_ids / previous_food_names đọc lại từ checkpoint
+        exclusion = ExclusionSet.from_state(state)
+        foods = [food for food in next(turns) if not exclusion.excludes({"dish_id": food["dish_id"], "name": food["dish_name"]})]
+        return {"step": "foods_reranked", "filtered_result": {}, "rerank_result": {"status": "success", "ranked_foods": foods}}
+
+    async def get_user_health_data(user_id):
+        return {"name": "A"}
+
+    original_checkpointer = checkpointer._checkpointer
+    checkpointer._checkpointer = saver
+    engine._workflow_graph = _build_graph([], saver, {
+        "rerank_foods_wrapper": rerank_foods_wrapper,
+        "generate_final_result": engine.generate_final_result,
+    })
+    engine.async_mongo_service.get_user_health_data = get_user_health_data
+    try:
+        async def run():
+            paused = await engine.run_langgraph_workflow_until_selection("u1", "Tôi nên ăn gì?", "nóng", "trưa")
+            session_id = paused["session_id"]
+            first = await engine.continue_workflow_with_selections(session_id, [], ["Luộc"], "u1")
+            second = await engine.run_langgraph_workflow_until_selection("u1", "Món khác?", "nóng", "tối", session_id=session_id)
+            values = (await engine._workflow_graph.aget_state({"configurable": {"thread_id": session_id}})).values
+            return first, second, values
+
+        first, second, values = asyncio.run(run())
+    finally:
+        del engine.async_mongo_service.get_user_health_data
+        checkpointer._checkpointer = original_checkpointer
+        engine._workflow_graph = None
+
+    assert [food["name"] for food in first["foods"]] == ["Canh chua cá", "Rau muống luộc"]
+    assert [food["name"] for food in second["foods"]] == ["Cá kho tộ"]
+    assert values["previous_food_names"] == ["Canh chua cá", "Cá kho tộ", "Rau muống luộc"]
+
+
+if __name__ == "__main__":
+    test_resume_continues_from_checkpoint()
+    test_saver_keeps_only_latest_checkpoint()
+    test_writes_are_kept_when_put_runs_concurrently()
+    test_session_limits_apply_to_checkpoints()
+    test_checkpoint_keeps_only_persisted_fields()
+    test_follow_up_reloads_user_profile()
+    test_follow_up_excludes_foods_suggested_by_name()
+    print("✅ All tests completed!")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Test chế độ combined: một lần gọi LLM trả về cả thứ tự món và câu trả lời
+"""
+import asyncio
+import json
+
+from app.graph.nodes.generate_natural_response_node import agenerate_natural_response
+from app.graph.nodes.rerank_foods_node import arerank_foods
+from app.services.llm.llm_service import LLMService
+
+FOODS = [
+    {"dish_id": "d1", "dish_name": "Cá kho tộ", "cook_method": "Kho"},
+    {"dish_id": "d2", "dish_name": "Rau muống luộc", "cook_method": "Luộc"},
+    {"dish_id": "d3", "dish_name": "Gà hấp lá chanh", "cook_method": "Hấp"},
+]
+
+
+def test_combined_mode_uses_single_llm_call():
+    requests = []
+
+    async def fake_acreate(cls, request):
+        requests.append(request)
+        return json.dumps({"ranked_ids": ["d2", "d9", "d3", "d2"], "answer": "Bạn thử Rau muống luộc nhé."})
+
+    original_acreate, original_available = LLMService._acreate, LLMService.is_available
+    LLMService._acreate = classmethod(fake_acreate)
+    LLMService.is_available = staticmethod(lambda: True)
+    state = {
+        "question": "Tôi nên ăn gì?",
+        "user_data": {"name": "A", "allergies": []},
+        "previous_food_ids": ["d3"],
+        "aggregated_result": {"status": "success", "aggregated_foods": FOODS},
+        "response_mode": "combined",
+    }
+    try:
+        rerank_result = asyncio.run(arerank_foods(state))["rerank_result"]
+        natural = asyncio.run(agenerate_natural_response({**state, "rerank_result": rerank_result}))
+    finally:
+        LLMService._acreate, LLMService.is_available = original_acreate, original_available
+
+    assert len(requests) == 1
+    assert requests[0]["response_format"]["type"] == "json_schema"
+    assert "d1 | Cá kho tộ | Kho" in requests[0]["messages"][1]["content"]
+    # id lạ và món đã gợi ý (d3) bị bỏ, id trùng chỉ giữ một lần
+    assert [food["dish_id"] for food in rerank_result["ranked_foods"]] == ["d2"]
+    assert natural["natural_response"] == "Bạn thử Rau muống luộc nhé."
+
+
+if __name__ == "__main__":
+    test_combined_mode_uses_single_llm_call()
+    print("✅ All tests completed!")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Test deadline theo request: timeout LLM lấy theo thời gian còn lại, node degrade khi hết ngân sách
+"""
+import asyncio
+
+from app.graph.nodes.generate_natural_response_node import agenerate_natural_response
+from app.graph.nodes.rerank_foods_node import arerank_foods
+from app.services.llm.llm_service import LLMService
+from app.utils import deadline
+from app.utils.deadline import DeadlineExceeded, request_deadline
+
+FOODS = [
+    {"dish_id": "d1", "dish_name": "Cá kho tộ", "cook_method": "Kho"},
+    {"dish_id": "d2", "dish_name": "Rau muống luộc", "cook_method": "Luộc"},
+    {"dish_id": "d3", "dish_name": "Gà hấp lá chanh", "cook_method": "Hấp"},
+]
+
+
+def _no_llm(cls, request):
+    raise AssertionError("Không được gọi LLM khi đã hết ngân sách")
+
+
+def test_timeout_follows_remaining_budget():
+    assert deadline.remaining() is None
+    assert deadline.timeout_for(30) == 30
+    with request_deadline(5):
+        assert 4 < deadline.timeout_for(30) <= 5
+        assert deadline.timeout_for(2) == 2
+    with request_deadline(0.001):
+        asyncio.run(asyncio.sleep(0.01))
+        try:
+            deadline.timeout_for(30)
+            assert False, "Hết deadline phải raise DeadlineExceeded"
+        except DeadlineExceeded:
+            pass
+
+
+def test_nodes_degrade_without_llm_when_budget_is_low():
+    original_acreate, original_available = LLMService._acreate, LLMService.is_available
+    LLMService._acreate = classmethod(_no_llm)
+    LLMService.is_available = staticmethod(lambda: True)
+    state = {
+        "question": "Tôi nên ăn gì?",
+        "user_data": {"name": "A", "allergies": []},
+        "selected_cooking_methods": ["Luộc"],
+        "previous_food_ids": ["d3"],
+        "aggregated_result": {"status": "success", "aggregated_foods": FOODS},
+    }
+    try:
+        with request_deadline(0.5):
+            rerank_result = asyncio.run(arerank_foods(state))["rerank_result"]
+            natural = asyncio.run(agenerate_natural_response({**state, "rerank_result": rerank_result}))
+    finally:
+        LLMService._acreate, LLMService.is_available = original_acreate, original_available
+
+    assert rerank_result["degraded"]
+    assert [food["dish_id"] for food in rerank_result["ranked_foods"]] == ["d2", "d1"]
+    assert "Rau muống luộc" in natural["natural_response"]
+    assert deadline.DEGRADED.value(node="rerank_foods", reason="deadline") >= 1
+
+
+if __name__ == "__main__":
+    test_timeout_follows_remaining_budget()
+    test_nodes_degrade_without_llm_when_budget_is_low()
+    print("✅ All tests completed!")
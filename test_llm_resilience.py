@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Test lớp chịu lỗi của LLMService với server giả lập OpenAI (http.server cục bộ):
+retry theo Retry-After, circuit breaker chuyển node sang đường xử lý cục bộ, hedged request
+"""
+import asyncio
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.graph.nodes.rerank_foods_node import RERANK_MODEL, arerank_foods
+from app.services.llm.llm_service import LLMService
+from app.services.llm.resilience import HEDGED, RETRIES, CircuitBreaker, CircuitOpenError, resilience
+from app.services.llm.single_flight import single_flight
+
+
+def _completion(content):
+    return {
+        "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": "stub",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+    }
+
+
+@contextmanager
+def _stub_server(script, fallback=(500, {}, "upstream error", 0)):
+    """
+    Server trả lời lần lượt theo script: (status, headers, content, delay giây); hết script thì dùng fallback.
+    Trả về danh sách request đã nhận (body JSON)
+    """
+    received = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with lock:
+                received.append(body)
+                status, headers, content, delay = script.pop(0) if script else fallback
+            time.sleep(delay)
+            payload = json.dumps(_completion(content) if status == 200 else {"error": {"message": content}}).encode()
+            try:
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # client đã hủy request (hedge thua)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    original = (LLMService.base_url, LLMService.api_key)
+    settings = {name: getattr(resilience, name) for name in ("max_retries", "base_delay", "hedge_delay", "failure_threshold", "reset_seconds")}
+    LLMService.configure(f"http://127.0.0.1:{server.server_address[1]}/v1", "sk-stub")
+    resilience.base_delay = 0.01
+    resilience.reset()
+    single_flight.clear()
+    try:
+        yield received
+    finally:
+        server.shutdown()
+        server.server_close()
+        LLMService.configure(*original)
+        for name, value in settings.items():
+            setattr(resilience, name, value)
+        resilience.reset()
+        single_flight.clear()
+
+
+def test_retries_transient_errors_and_honours_retry_after():
+    script = [
+        (503, {}, "overloaded", 0),
+        (429, {"Retry-After": "0.2"}, "rate limited", 0),
+        (200, {}, "Xin chào", 0),
+    ]
+    with _stub_server(script) as received:
+        start = time.perf_counter()
+        answer = LLMService.chat("Retry", model="stub-retry")
+        elapsed = time.perf_counter() - start
+
+    assert answer == "Xin chào"
+    assert len(received) == 3
+    assert elapsed >= 0.2
+    assert RETRIES.value(model="stub-retry", reason="503") == 1
+    assert RETRIES.value(model="stub-retry", reason="429") == 1
+
+
+def test_open_circuit_fails_fast_to_local_fallback():
+    state = {
+        "question": "Tôi nên ăn gì?",
+        "user_data": {"name": "A", "allergies": []},
+        "selected_cooking_methods": ["Luộc"],
+        "aggregated_result": {"status": "success", "aggregated_foods": [
+            {"dish_id": "d1", "dish_name": "Cá kho tộ", "cook_method": "Kho"},
+            {"dish_id": "d2", "dish_name": "Rau muống luộc", "cook_method": "Luộc"},
+        ]},
+    }
+    script = []
+    with _stub_server(script) as received:
+        resilience.max_retries = 1
+        resilience.failure_threshold = 2
+        resilience.reset_seconds = 0.2
+        first = asyncio.run(arerank_foods(state))["rerank_result"]
+        assert len(received) == 2
+        assert resilience.breaker(RERANK_MODEL).state == CircuitBreaker.OPEN
+
+        second = asyncio.run(arerank_foods(state))["rerank_result"]
+        assert len(received) == 2, "Circuit mở thì không gửi request"
+
+        # Hết reset_seconds: lời gọi thử thành công thì đóng mạch
+        time.sleep(0.25)
+        script.append((200, {}, "Rau muống luộc", 0))
+        LLMService.configure(LLMService.base_url)
+        assert asyncio.run(LLMService.achat("Probe", model=RERANK_MODEL)) == "Rau muống luộc"
+        assert resilience.breaker(RERANK_MODEL).state == CircuitBreaker.CLOSED
+
+    for result in (first, second):
+        assert result["degraded"]
+        assert [food["dish_id"] for food in result["ranked_foods"]] == ["d2", "d1"]
+
+
+def test_half_open_allows_single_probe():
+    breaker = CircuitBreaker("stub-probe", failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    try:
+        breaker.check()
+        assert False, "Circuit vừa mở phải từ chối"
+    except CircuitOpenError:
+        pass
+    time.sleep(0.06)
+    breaker.check()  # lời gọi thử
+    try:
+        breaker.check()
+        assert False, "Chỉ cho một lời gọi thử khi half_open"
+    except CircuitOpenError:
+        pass
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_hedged_request_returns_faster_copy():
+    script = [(200, {}, "chậm", 0.5), (200, {}, "nhanh", 0)]
+    with _stub_server(script) as received:
+        resilience.hedge_delay = 0.05
+        start = time.perf_counter()
+        answer = asyncio.run(LLMService.achat("Hedge", model="stub-hedge", hedge=True))
+        elapsed = time.perf_counter() - start
+
+    assert answer == "nhanh"
+    assert len(received) == 2
+    assert elapsed < 0.4
+    assert HEDGED.value(model="stub-hedge", winner="hedge") == 1
+
+
+if __name__ == "__main__":
+    test_retries_transient_errors_and_honours_retry_after()
+    test_open_circuit_fails_fast_to_local_fallback()
+    test_half_open_allows_single_probe()
+    test_hedged_request_returns_faster_copy()
+    print("✅ All tests completed!")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Test metrics: node được bọc ghi thời gian / step / lỗi, lời gọi ngoài gắn vào node đang chạy
+"""
+import asyncio
+import uuid
+
+from app.services import graph_schema_service, metrics
+from app.services.metrics import MetricsRegistry, instrument_node, span
+
+
+def test_instrument_node_records_step_and_external_calls():
+    def query(state):
+        with span("neo4j", "get_foods_by_bmi"):
+            pass
+        return {"step": "neo4j_queried"}
+
+    async def failing(state):
+        return {"error": "boom", "step": "error"}
+
+    instrument_node("test_query", query)({})
+    asyncio.run(instrument_node("test_failing", failing)({}))
+
+    assert metrics.NODE_DURATION.count(node="test_query") == 1
+    assert metrics.NODE_STEPS.value(node="test_query", step="neo4j_queried") == 1
+    assert metrics.EXTERNAL_CALL_DURATION.count(kind="neo4j", name="get_foods_by_bmi", node="test_query") == 1
+    assert metrics.NODE_ERRORS.value(node="test_failing") == 1
+    assert metrics.NODE_ERRORS.value(node="test_query") == 0
+
+
+class _FakeNeo4jSession:
+    def __init__(self, records):
+        self.records = records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, query, **params):
+        if isinstance(self.records, Exception):
+            raise self.records
+        return iter(self.records)
+
+
+class _FakeNeo4jDriver:
+    def __init__(self, records):
+        self.records = records
+
+    def session(self):
+        return _FakeNeo4jSession(self.records)
+
+
+def test_neo4j_span_covers_only_the_query():
+    """Cache hit không tính là lời gọi Neo4j, query lỗi được ghi là lỗi dù hàm trả về giá trị mặc định"""
+    service = graph_schema_service.GraphSchemaService
+    original_driver = graph_schema_service.get_neo4j_driver
+    bmi_category = f"bmi-{uuid.uuid4()}"
+    try:
+        graph_schema_service.get_neo4j_driver = lambda: _FakeNeo4jDriver([{"cook_method": "Luộc"}])
+        assert service.get_cook_methods_by_bmi(bmi_category) == ["Luộc"]
+        assert service.get_cook_methods_by_bmi(bmi_category) == ["Luộc"]
+        assert metrics.EXTERNAL_CALL_DURATION.count(kind="neo4j", name="cook_methods_by_bmi", node="") == 1
+
+        errors = metrics.EXTERNAL_CALL_ERRORS.value(kind="neo4j", name="diseases_by_food")
+        graph_schema_service.get_neo4j_driver = lambda: _FakeNeo4jDriver(RuntimeError("neo4j down"))
+        assert service.get_diseases_by_food(f"food-{uuid.uuid4()}") == []
+        assert metrics.EXTERNAL_CALL_ERRORS.value(kind="neo4j", name="diseases_by_food") == errors + 1
+    finally:
+        graph_schema_service.get_neo4j_driver = original_driver
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("demo_seconds", "Demo", ("node",), buckets=(0.1, 1.0))
+    histogram.observe(0.5, node="a")
+    registry.counter("demo_total", "Demo", ("model",)).inc(3, model='gpt"4')
+    registry.gauge_callback("demo_sessions", "Demo", lambda: 7)
+
+    text = registry.render()
+    assert '# TYPE demo_seconds histogram' in text
+    assert 'demo_seconds_bucket{node="a",le="0.1"} 0' in text
+    assert 'demo_seconds_bucket{node="a",le="1.0"} 1' in text
+    assert 'demo_seconds_bucket{node="a",le="+Inf"} 1' in text
+    assert 'demo_seconds_count{node="a"} 1' in text
+    assert 'demo_total{model="gpt\\"4"} 3' in text
+    assert 'demo_sessions 7' in text
+
+
+if __name__ == "__main__":
+    test_instrument_node_records_step_and_external_calls()
+    test_neo4j_span_covers_only_the_query()
+    test_registry_renders_prometheus_text()
+    print("✅ All tests completed!")
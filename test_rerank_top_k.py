@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Test chấm điểm cục bộ top-K trước khi rerank bằng LLM và định dạng prompt gọn
+"""
+import asyncio
+
+from app.graph.nodes.rerank_foods_node import arerank_foods, pre_rank
+from app.services.llm.llm_service import LLMService
+
+
+def _catalog(size):
+    foods = [{"dish_id": f"d{i}", "dish_name": f"Món số {i}", "cook_method": "Xào", "diet_name": "Ăn mặn"} for i in range(size)]
+    foods[70] = {"dish_id": "d70", "dish_name": "Đậu hũ sốt cà", "cook_method": "Sốt", "diet_name": "Chay"}
+    foods[90] = {"dish_id": "d90", "dish_name": "Canh bí đao", "cook_method": "Luộc", "diet_name": "Ăn mặn"}
+    return foods
+
+
+def test_pre_rank_scores_and_keeps_top_k():
+    foods = _catalog(100)
+    ranked = pre_rank(foods, "Gợi ý món chay cho tôi", ["Luộc"], limit=5)
+    assert [food["dish_id"] for food in ranked] == ["d90", "d70", "d0", "d1", "d2"]
+    # Không có tín hiệu nào thì giữ nguyên thứ tự gốc
+    assert pre_rank(foods, "Tôi nên ăn gì?", [], limit=3) == foods[:3]
+    assert len(pre_rank(foods, "", [], limit=0)) == 100
+
+
+def test_rerank_prompt_is_bounded_by_top_k():
+    requests = []
+
+    async def fake_acreate(cls, request):
+        requests.append(request)
+        return "Đậu hũ sốt cà"
+
+    original_acreate, original_available = LLMService._acreate, LLMService.is_available
+    LLMService._acreate = classmethod(fake_acreate)
+    LLMService.is_available = staticmethod(lambda: True)
+    state = {
+        "question": "Món chay nào ngon?",
+        "user_data": {"name": "A", "allergies": []},
+        "previous_food_ids": ["d0"],
+        "aggregated_result": {"status": "success", "aggregated_foods": _catalog(100)},
+    }
+    try:
+        rerank_result = asyncio.run(arerank_foods(state))["rerank_result"]
+    finally:
+        LLMService._acreate, LLMService.is_available = original_acreate, original_available
+
+    prompt = requests[0]["messages"][1]["content"]
+    assert prompt.count("\n- d") == 30
+    assert "- d70 | Đậu hũ sốt cà | Sốt | Chay" in prompt
+    assert "- d0 |" not in prompt
+    assert [food["dish_id"] for food in rerank_result["ranked_foods"]] == ["d70"]
+
+
+if __name__ == "__main__":
+    test_pre_rank_scores_and_keeps_top_k()
+    test_rerank_prompt_is_bounded_by_top_k()
+    print("✅ All tests completed!")
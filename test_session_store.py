@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Test script cho session store (backend fake, không cần Redis)
+"""
+import os
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from app.utils.session_store import FakeSessionBackend, RedisSessionBackend, SessionBackend
+from app.utils.session_schema import encode_session, decode_session
+
+
+def test_save_and_load_roundtrip():
+    backend = FakeSessionBackend()
+    payload = encode_session({"": {"id": "c1", "writes": [["t1", "step", "msgpack", b"\x01", "", 0]]}})
+    backend.save("s1", payload, ttl=60)
+    assert decode_session(backend.load("s1")) == {"": {"id": "c1", "writes": [["t1", "step", "msgpack", b"\x01", "", 0]]}}
+    backend.delete("s1")
+    assert backend.load("s1") is None
+
+
+def _check_log(backend):
+    backend.append("s1", [b"w1", b"w2"], ttl=60)
+    assert backend.load_with_log("s1") == (None, [b"w1", b"w2"])
+    backend.save("s1", b"payload", ttl=60)
+    backend.append("s1", [b"w3"], ttl=60)
+    assert backend.load_with_log("s1") == (b"payload", [b"w1", b"w2", b"w3"])
+    backend.remove_from_log("s1", [b"w1"])
+    backend.save("s1", b"payload2", ttl=60)
+    assert backend.load_with_log("s1") == (b"payload2", [b"w2", b"w3"])
+    backend.delete("s1")
+    assert backend.load_with_log("s1") == (None, [])
+
+
+def test_log_is_kept_apart_from_payload():
+    """save ghi đè payload nhưng giữ log, log tính vào số byte của session"""
+    backend = FakeSessionBackend()
+    _check_log(backend)
+    backend.append("s2", [b"12345"], ttl=10)
+    backend.save("s2", b"123", ttl=10)
+    assert backend.stats()["bytes"] == 8
+    backend.advance(11)
+    assert backend.load_with_log("s2") == (None, [])
+    assert backend.stats()["bytes"] == 0
+
+
+def test_redis_backend_log():
+    if fakeredis is None:
+        print("⚠️ fakeredis chưa được cài, bỏ qua test Redis backend")
+        return
+    backend = RedisSessionBackend("redis://localhost:6379/0")
+    backend._client = fakeredis.FakeRedis()
+    _check_log(backend)
+    backend.save("a", b"payload", ttl=60)
+    backend.append("b", [b"w1"], ttl=60)
+    assert backend.stats() == {"backend": "redis", "sessions": 1}
+    # Log cũng có TTL (không sống mãi khi chưa có payload)
+    assert 0 < backend._client.ttl(backend._log_key("b")) <= 60
+
+
+def test_session_expires_after_ttl():
+    backend = FakeSessionBackend()
+    backend.save("s1", b"payload", ttl=10)
+
+    backend.advance(5)
+    assert backend.load("s1") == b"payload"
+    backend.advance(6)
+    assert backend.load("s1") is None
+    assert backend.stats()["expired"] == 1
+
+
+def test_lru_eviction_by_count_and_bytes():
+    """Vượt giới hạn thì loại session ít dùng nhất, load() đánh dấu session vừa dùng"""
+    backend = FakeSessionBackend(max_sessions=2)
+    backend.save("s1", b"u1", ttl=60)
+    backend.save("s2", b"u2", ttl=60)
+    backend.load("s1")
+    backend.save("s3", b"u3", ttl=60)
+    assert backend.load("s2") is None
+    assert backend.load("s1") == b"u1"
+    assert backend.stats()["evicted"] == 1
+
+    small = FakeSessionBackend(max_bytes=300)
+    small.save("a", os.urandom(200), ttl=60)
+    small.save("b", os.urandom(200), ttl=60)
+    assert small.load("a") is None
+    assert small.stats()["bytes"] <= 300
+
+
+def test_cleanup_removes_only_expired():
+    backend = FakeSessionBackend()
+    backend.save("short", b"u1", ttl=5)
+    backend.save("long", b"u2", ttl=100)
+    # Lưu lại làm entry cũ trong heap không còn hợp lệ
+    backend.save("short", b"u1", ttl=50)
+    backend.advance(10)
+    assert backend.cleanup() == 0
+    backend.advance(50)
+    assert backend.cleanup() == 1
+    assert backend.stats()["sessions"] == 1
+
+
+def test_schema_rejects_unknown_payloads():
+    """Payload có version tag, version lạ hoặc định dạng cũ bị từ chối"""
+    payload = encode_session({"": {"id": "c1"}})
+    for bad in (payload[:2] + bytes([1]) + payload[3:], b"\x80\x04legacy"):
+        try:
+            decode_session(bad)
+            assert False, "Payload không đúng định dạng phải bị từ chối"
+        except ValueError:
+            pass
+
+
+def test_backend_must_implement_interface():
+    class Incomplete(SessionBackend):
+        def save(self, session_id, payload, ttl):
+            pass
+
+    try:
+        Incomplete()
+        assert False, "Backend thiếu load/delete không được khởi tạo"
+    except TypeError:
+        pass
+
+
+if __name__ == "__main__":
+    test_save_and_load_roundtrip()
+    test_log_is_kept_apart_from_payload()
+    test_redis_backend_log()
+    test_session_expires_after_ttl()
+    test_lru_eviction_by_count_and_bytes()
+    test_cleanup_removes_only_expired()
+    test_schema_rejects_unknown_payloads()
+    test_backend_must_implement_interface()
+    print("✅ All tests completed!")
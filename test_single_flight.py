@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Test single-flight: lời gọi LLM giống hệt nhau đến cùng lúc chỉ gửi một request
+"""
+import asyncio
+import threading
+import time
+
+from app.services.llm.llm_service import LLMService
+from app.services.llm.single_flight import COALESCED, single_flight
+
+
+def _patch_acreate(fake):
+    original = LLMService._acreate
+    LLMService._acreate = classmethod(fake)
+    return original
+
+
+def test_concurrent_async_calls_share_one_request():
+    calls = []
+
+    async def fake_acreate(cls, request):
+        prompt = request["messages"][1]["content"]
+        calls.append(prompt)
+        await asyncio.sleep(0.05)
+        return f"trả lời: {prompt}"
+
+    async def run():
+        same = [LLMService.achat("Ăn gì tốt cho người tiểu đường?", model="test-sf") for _ in range(5)]
+        results = await asyncio.gather(*same, LLMService.achat("Câu hỏi khác", model="test-sf"))
+        reused = await LLMService.achat("Ăn gì tốt cho người tiểu đường?", model="test-sf")
+        return results, reused
+
+    single_flight.clear()
+    original = _patch_acreate(fake_acreate)
+    try:
+        results, reused = asyncio.run(run())
+    finally:
+        LLMService._acreate = original
+        single_flight.clear()
+
+    assert len(calls) == 2
+    assert len(set(results[:5])) == 1 and results[5] != results[0]
+    assert reused == results[0]
+    assert COALESCED.value(model="test-sf", source="inflight") == 4
+    assert COALESCED.value(model="test-sf", source="recent") == 1
+
+
+def test_errors_are_shared_but_not_reused():
+    calls = []
+
+    async def failing_acreate(cls, request):
+        calls.append(request)
+        await asyncio.sleep(0.02)
+        raise RuntimeError("upstream 500")
+
+    async def run():
+        return await asyncio.gather(*[LLMService.achat("Lỗi", model="test-sf-error") for _ in range(3)], return_exceptions=True)
+
+    single_flight.clear()
+    original = _patch_acreate(failing_acreate)
+    try:
+        errors = asyncio.run(run())
+        asyncio.run(run())
+    finally:
+        LLMService._acreate = original
+
+    assert all(isinstance(error, RuntimeError) for error in errors)
+    assert len(calls) == 2
+
+
+def test_sync_threads_share_one_request():
+    calls = []
+
+    def slow_create(cls, request):
+        calls.append(request)
+        time.sleep(0.05)
+        return "ok"
+
+    original = LLMService._create
+    LLMService._create = classmethod(slow_create)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(LLMService.chat("Sync", model="test-sf-sync"))) for _ in range(4)]
+    single_flight.clear()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        LLMService._create = original
+        single_flight.clear()
+
+    assert results == ["ok"] * 4
+    assert len(calls) == 1
+
+
+if __name__ == "__main__":
+    test_concurrent_async_calls_share_one_request()
+    test_errors_are_shared_but_not_reused()
+    test_sync_threads_share_one_request()
+    print("✅ All tests completed!")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Test câu trả lời dựng sẵn (template), không gọi LLM
+"""
+import asyncio
+
+from app.graph.nodes.generate_natural_response_node import agenerate_natural_response
+from app.services.llm.llm_service import LLMService
+from app.utils.prompt_templates import build_template_response
+
+FOODS = [{"name": "Canh bí đao", "cook_method": "Nấu canh"}, {"name": "Cá hấp gừng", "cook_method": "Hấp"}]
+
+
+def _response(user_info, food_info=FOODS, weather="", time_of_day=""):
+    return build_template_response("Tôi nên ăn gì?", user_info, food_info, [], weather, time_of_day, "tư vấn", {})
+
+
+def test_template_cases():
+    no_condition = _response({"name": "An", "medical_conditions": ["Không có"], "bmi_category": "Bình thường"})
+    assert no_condition.startswith("Chào An! Với thể trạng hiện tại")
+    assert "1. Canh bí đao (Nấu canh)" in no_condition
+    assert "2. Cá hấp gừng (Hấp)" in no_condition
+    assert "cân nặng của bạn đang ổn" in no_condition
+
+    single = _response({"name": "An", "medical_conditions": ["Tiểu đường"]}, weather="nóng", time_of_day="trưa")
+    assert "Vì bạn đang có Tiểu đường" in single
+    assert "thời tiết nóng vào buổi trưa" in single
+
+    multiple = _response({"name": "An", "medical_conditions": ["Tiểu đường", "Gout"], "allergies": ["tôm"]})
+    assert "phù hợp đồng thời với Tiểu đường, Gout" in multiple
+    assert "dị ứng với tôm" in multiple
+
+    assert "chưa tìm thấy món nào" in _response({"name": "An"}, food_info=[])
+
+
+def test_template_mode_skips_llm():
+    original_acreate = LLMService._acreate
+
+    async def no_llm(cls, request):
+        raise AssertionError("Chế độ template không được gọi LLM")
+
+    LLMService._acreate = classmethod(no_llm)
+    state = {
+        "question": "Tôi nên ăn gì?",
+        "user_data": {"name": "An", "medicalConditions": [], "allergies": []},
+        "rerank_result": {"status": "success", "ranked_foods": [{"dish_name": "Canh bí đao", "cook_method": "Nấu canh"}]},
+        "filtered_result": {"allergy_warnings": {"s1": [{"dish_name": "Canh bí đao", "warnings": ["có tôm khô"]}]}},
+        "response_mode": "template",
+    }
+    try:
+        result = asyncio.run(agenerate_natural_response(state))
+    finally:
+        LLMService._acreate = original_acreate
+
+    assert result["step"] == "natural_response_generated"
+    assert result["natural_response"].startswith("\n⚠️ CẢNH BÁO DỊ ỨNG:")
+    assert "1. Canh bí đao (Nấu canh)" in result["natural_response"]
+
+
+if __name__ == "__main__":
+    test_template_cases()
+    test_template_mode_skips_llm()
+    print("✅ All tests completed!")